@@ -13,15 +13,20 @@ class Config():
     SNAPSHOT_SAVE_DIR= os.path.join(DATA_BASE_DIR , 'Models/')
     META_SAVE_DIR = os.path.join(DATA_BASE_DIR, 'ModelsMeta/')
     TARGET_IMAGE_DIR= os.path.join(DATA_BASE_DIR, 'AVD_and_BigBIRD_targets_v1/')
+    TARGET_BANK_DIR = os.path.join(DATA_BASE_DIR, 'TargetBank/')
+    SCENE_CACHE_DIR = os.path.join(DATA_BASE_DIR, 'SceneCache/')
+    SCENE_FEATURE_BANK_DIR = os.path.join(DATA_BASE_DIR, 'SceneFeatureBank/')
     TEST_OUTPUT_DIR = os.path.join(DATA_BASE_DIR, 'TestOutputs/')
     TEST_GROUND_TRUTH_BOXES = os.path.join(DATA_BASE_DIR, 'GT/AVD_split1_test.json')
     VAL_GROUND_TRUTH_BOXES = os.path.join(DATA_BASE_DIR ,'GT/AVD_part3_val.json')
+    GT_CACHE_DIR = os.path.join(DATA_BASE_DIR, 'GTCache/')
 
 
     #Model Loading and saving 
     FEATURE_NET_NAME= 'vgg16_bn'
     PYTORCH_FEATURE_NET= True
     USE_PRETRAINED_WEIGHTS = True
+    FREEZE_FEATURES = False
     FULL_MODEL_LOAD_NAME= 'TDID_AVD1_02_40_72201_0.90867_0.33934.h5'
     LOAD_FULL_MODEL= True 
     MODEL_BASE_SAVE_NAME = 'TDID_AVD1_03'
@@ -37,16 +42,26 @@ class Config():
     WEIGHT_DECAY = .0005
     DISPLAY_INTERVAL = 10
     NUM_WORKERS = 4 
+    ANCHOR_TARGETS_IN_WORKERS = True
     RESIZE_IMG = 0 
     RESIZE_IMG_FACTOR = .5 
+    TRAIN_CROP_SIZE = None
     CHOOSE_PRESENT_TARGET = .6
+    TARGETS_PER_SCENE = 1
     DET4CLASS = False 
 
     #Target Images
     PRELOAD_TARGET_IMAGES= False
+    TARGET_IMAGE_CACHE_MB = 512
+    TARGET_CATALOG_DIR = None
+    TARGET_CATALOG_NORMALIZED = False
     AUGMENT_TARGET_IMAGES= .9 
     AUGMENT_TARGET_ILLUMINATION= .3 
+    AUGMENT_SEED = None
     MIN_TARGET_SIZE = 32
+    TARGET_MAX_SIDE = None
+    TARGET_BUCKET_MAX_PADDING = None
+    USE_TARGET_BANK = True
 
     #Training Data
     ID_MAP_FNAME= 'all_instance_id_map.txt'
@@ -57,6 +72,8 @@ class Config():
     TRAIN_OBJ_IDS=[cid for cid in range(1,33) if cid not in OBJ_IDS_TO_EXCLUDE] 
     FRACTION_OF_NO_BOX_IMAGES = .1 
     MAX_OBJ_DIFFICULTY= 4
+    USE_SCENE_CACHE = False
+    SCENE_CACHE_SCALE = 1
     TRAIN_LIST= [
                  'Home_002_1',
                  'Home_003_1',
@@ -86,6 +103,8 @@ class Config():
     MAX_DETS_PER_TARGET = 5
     SCORE_THRESH = .01
     TEST_NMS_OVERLAP_THRESH = .7
+    EVAL_NUM_WORKERS = 1
+    SAVE_VAL_DETECTIONS = True
 
     TEST_OBJ_IDS= TRAIN_OBJ_IDS
     TEST_FRACTION_OF_NO_BOX_IMAGES =  1 
@@ -95,6 +114,8 @@ class Config():
                  'Home_008_1',
                 ]
     TEST_ONE_AT_A_TIME = False 
+    TEST_BATCH_TARGETS = True
+    TEST_BATCH_TARGETS_MEMORY_MB = 2048
     ###############################################
     #Model paramters
     ANCHOR_SCALES = [1,2,4]
@@ -104,9 +125,11 @@ class Config():
     USE_DIFF_FEATS = True 
     USE_CC_FEATS = True 
 
+    TORCH_PROPOSAL_LAYER = True
     PRE_NMS_TOP_N = 6000
     POST_NMS_TOP_N = 300
     NMS_THRESH = .7
+    NMS_BACKEND = 'auto'
     PROPOSAL_MIN_BOX_SIZE = 8 
     PROPOSAL_CLOBBER_POSITIVES = False 
     PROPOSAL_NEGATIVE_OVERLAP = .3
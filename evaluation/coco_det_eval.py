@@ -1,33 +1,103 @@
 from .cocoapi.PythonAPI.pycocotools.coco import COCO
 from .cocoapi.PythonAPI.pycocotools.cocoeval import COCOeval
 import numpy as np
+import os
+import json
+import pickle
+import hashlib
+
+#ground truth apis loaded by this process, see load_coco_gt
+_gt_cache = {}
+
+
+def load_coco_gt(gt_path, cache_dir=None):
+    '''
+    Returns the COCO api of a ground truth file, built once per process
+
+    The api is kept for the life of the process, and built again only if
+    the file changes. If cache_dir is given the api is also pickled there,
+    so other processes skip parsing the json and building the index.
+
+    Input parameters:
+        gt_path: (str) path to ground truth bounding box json file
+
+        cache_dir (optional): (str) where to keep pickled apis. If None
+                              apis are only kept in memory. Default: None
+
+    Returns:
+        (COCO) the ground truth api, shared by all callers. Do not change it.
+    '''
+    stat = os.stat(gt_path)
+    key = (os.path.abspath(gt_path), stat.st_mtime, stat.st_size)
+    if key in _gt_cache:
+        return _gt_cache[key]
+
+    cocoGt = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, hashlib.md5(
+                                   json.dumps(key).encode()).hexdigest()+'.pkl')
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as f:
+                cocoGt = pickle.load(f)
+    if cocoGt is None:
+        cocoGt = COCO(gt_path)
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            #write to a temp file first so readers never see a partial cache
+            with open(cache_file + '.tmp', 'wb') as f:
+                pickle.dump(cocoGt, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(cache_file + '.tmp', cache_file)
+    _gt_cache[key] = cocoGt
+    return cocoGt
 
 
 def coco_det_eval(gt_path, det_path, catIds,
                   iouThrs=.5,
-                  maxDets=[1,10,100]):
+                  maxDets=[1,10,100],
+                  num_procs=1,
+                  gt_cache_dir=None):
     ''' 
     Performs coco detection mAP evaluation
 
+    Ground truth and detections can be given in memory, so nothing is
+    read from disk. Ground truth given by path is loaded with 
+    load_coco_gt, so it is only parsed once per process.
+
     Example:
         coco_det_eval('/path/to/ground_truth.json','/path/to/detection.json')
+        coco_det_eval('/path/to/ground_truth.json', test_net(...), catIds)
 
     Input parameters:
-        gt_path: (str) path to ground truth bounding box json file
-        det_path: (str) path to detection output json file
+        gt_path: (str or COCO) path to ground truth bounding box json file,
+                 or its COCO api
+        det_path: (str, list or ndarray) path to detection output json file,
+                  or the detections. An Nx7 array, i.e. as returned from
+                  test_net, is evaluated without making a dict per
+                  detection, see COCO.loadResArray
         catIds: (list of int) class ids to evaluate
 
         iouThrs: (int) iou threshold for a correct detection Default: .5
         maxDets (optional): (list of int) Default: [1,10,100]
+        num_procs (optional): (int) number of processes to match detections
+                              in, each gets a shard of the images. Default: 1
+        gt_cache_dir (optional): (str) where to keep pickled ground truth,
+                                 see load_coco_gt. Default: None
 
     Returns:
         (float) m_ap result
     ''' 
 
     #initialize COCO ground truth api
-    cocoGt=COCO(gt_path)
+    if isinstance(gt_path, COCO):
+        cocoGt = gt_path
+    else:
+        cocoGt = load_coco_gt(gt_path, cache_dir=gt_cache_dir)
     #initialize COCO detections api
-    cocoDt=cocoGt.loadRes(det_path)
+    if isinstance(det_path, np.ndarray):
+        cocoDt=cocoGt.loadResArray(det_path)
+    else:
+        cocoDt=cocoGt.loadRes(det_path)
 
     # setup parameters 
     annType = 'bbox' 
@@ -41,7 +111,7 @@ def coco_det_eval(gt_path, det_path, catIds,
     cocoEval.params.useSegs = [0]
 
     #run evaluation
-    cocoEval.evaluate()
+    cocoEval.evaluate(numProcs=num_procs)
     cocoEval.accumulate()
     cocoEval.summarize()
 
@@ -30,6 +30,7 @@ __version__ = '2.0'
 #  annToMask  - Convert segmentation in an annotation to binary mask.
 #  showAnns   - Display the specified annotations.
 #  loadRes    - Load algorithm results and create API for accessing them.
+#  loadResArray - Load bbox results from an array, kept as arrays for COCOeval.
 #  download   - Download COCO images from mscoco.org server.
 # Throughout the API "ann"=annotation, "cat"=category, and "img"=image.
 # Help on each functions can be accessed by: "help COCO>function".
@@ -305,7 +306,7 @@ class COCO:
 
         print('Loading and preparing results...')
         tic = time.time()
-        if type(resFile) == str or type(resFile) == unicode:
+        if type(resFile) == str or (PYTHON_VERSION == 2 and type(resFile) == unicode):
             anns = json.load(open(resFile))
         elif type(resFile) == np.ndarray:
             anns = self.loadNumpyAnnotations(resFile)
@@ -355,6 +356,22 @@ class COCO:
         res.createIndex()
         return res
 
+    def loadResArray(self, data):
+        """
+        Load bbox results from a numpy array [Nx7] where each row contains {imageID,x1,y1,w,h,score,class}.
+        Unlike loadRes no annotation dicts are made, the results are kept as arrays
+        which COCOeval reads directly. Ids are given as in loadRes.
+        :param   data (numpy.ndarray) : bbox results
+        :return: res (BboxResults)    : result arrays
+        """
+        print('Loading and preparing results...')
+        tic = time.time()
+        res = BboxResults(data)
+        assert np.all(np.isin(np.unique(res.imgIds), self.getImgIds())), \
+               'Results do not correspond to current coco set'
+        print('DONE (t={:0.2f}s)'.format(time.time()- tic))
+        return res
+
     def download(self, tarDir = None, imgIds = [] ):
         '''
         Download COCO images from mscoco.org server.
@@ -431,3 +448,51 @@ class COCO:
         rle = self.annToRLE(ann)
         m = maskUtils.decode(rle)
         return m
+
+
+class BboxResults:
+    def __init__(self, data):
+        """
+        Bbox results as arrays, sorted by image and category, see COCO.loadResArray.
+        Rows of an image and category keep the order they were given in.
+        :param data (numpy.ndarray): [Nx7] rows of {imageID,x1,y1,w,h,score,class}
+        :return:
+        """
+        data = np.asarray(data, dtype=np.float64).reshape(-1, 7)
+        imgIds = data[:, 0].astype(np.int64)
+        catIds = data[:, 6].astype(np.int64)
+        order = np.lexsort((catIds, imgIds))
+        self.imgIds = imgIds[order]
+        self.catIds = catIds[order]
+        self.bboxes = data[order, 1:5]
+        self.scores = data[order, 5]
+        self.areas = self.bboxes[:, 2] * self.bboxes[:, 3]
+        self.ids = order + 1
+
+        # rows [start, end) of each image and category
+        self.offsets = {}
+        if len(order) > 0:
+            starts = np.flatnonzero((np.diff(self.imgIds) != 0) |
+                                    (np.diff(self.catIds) != 0)) + 1
+            starts = np.concatenate(([0], starts))
+            ends = np.concatenate((starts[1:], [len(order)]))
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                self.offsets[int(self.imgIds[start]), int(self.catIds[start])] = (start, end)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def getRows(self, imgId, catIds):
+        """
+        Get rows of the results of an image in the given categories.
+        :param imgId  (int)       : image id
+               catIds (int array) : category ids, rows are in this order
+        :return: rows (int array) : rows in the result arrays
+        """
+        catIds = catIds if _isArrayLike(catIds) else [catIds]
+        ranges = [self.offsets[imgId, catId] for catId in catIds
+                  if (imgId, catId) in self.offsets]
+        if len(ranges) == 1:
+            return np.arange(*ranges[0])
+        return np.concatenate([np.arange(start, end) for start, end in ranges]
+                              + [np.zeros(0, dtype=np.int64)])
@@ -5,7 +5,16 @@ import datetime
 import time
 from collections import defaultdict
 from . import mask as maskUtils
+from .coco import BboxResults
 import copy
+import multiprocessing
+
+# the COCOeval forked evaluate() workers use, see _evaluateShard
+_shardEval = None
+
+def _evaluateShard(imgIds):
+    ious, imgResults = _shardEval._evaluateImgs(imgIds)
+    return ious, _shardEval._packResults(imgResults)
 
 class COCOeval:
     # Interface for evaluating detection on the Microsoft COCO dataset.
@@ -61,7 +70,8 @@ class COCOeval:
         '''
         Initialize CocoEval using coco APIs for gt and dt
         :param cocoGt: coco object with ground truth annotations
-        :param cocoDt: coco object with detection results
+        :param cocoDt: coco object with detection results, or BboxResults
+                       from cocoGt.loadResArray for bbox evaluation
         :return: None
         '''
         if not iouType:
@@ -73,10 +83,12 @@ class COCOeval:
         self.eval     = {}                  # accumulated evaluation results
         self._gts = defaultdict(list)       # gt for evaluation
         self._dts = defaultdict(list)       # dt for evaluation
+        self._dtRes = None                  # dt arrays, if cocoDt is BboxResults
         self.params = Params(iouType=iouType) # parameters
         self._paramsEval = {}               # parameters for evaluation
         self.stats = []                     # result summarization
         self.ious = {}                      # ious between all gts and dts
+        self._imgArrays = {}                # per image gt and dt arrays for evaluateImg
         if not cocoGt is None:
             self.params.imgIds = sorted(cocoGt.getImgIds())
             self.params.catIds = sorted(cocoGt.getCatIds())
@@ -95,10 +107,19 @@ class COCOeval:
         p = self.params
         if p.useCats:
             gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
-            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
         else:
             gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
-            dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
+        if isinstance(self.cocoDt, BboxResults):
+            # dts are read from the arrays, see _getDtRows
+            assert p.iouType == 'bbox', 'array results only support bbox evaluation'
+            self._dtRes = self.cocoDt
+            dts = []
+        else:
+            self._dtRes = None
+            if p.useCats:
+                dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
+            else:
+                dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
 
         # convert ground truth to mask if iouType == 'segm'
         if p.iouType == 'segm':
@@ -118,10 +139,14 @@ class COCOeval:
             self._dts[dt['image_id'], dt['category_id']].append(dt)
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
         self.eval     = {}                  # accumulated evaluation results
+        self._imgArrays = {}                # per image gt and dt arrays for evaluateImg
 
-    def evaluate(self):
+    def evaluate(self, numProcs=1):
         '''
         Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        :param numProcs: number of processes to evaluate images in. If more than 1,
+                         images are split in shards for a pool of forked
+                         processes, which share the gts and dts copy-on-write
         :return: None
         '''
         tic = time.time()
@@ -139,27 +164,130 @@ class COCOeval:
         self.params=p
 
         self._prepare()
+        self._iouThrs = np.minimum(np.asarray(p.iouThrs, dtype=np.float64), 1-1e-10)
         # loop through images, area range, max detection number
         catIds = p.catIds if p.useCats else [-1]
 
+        numProcs = min(numProcs, len(p.imgIds))
+        if numProcs > 1:
+            # a few shards per process, so slow shards do not hold up the rest
+            shards = [list(shard) for shard in
+                      np.array_split(p.imgIds, numProcs*4) if len(shard) > 0]
+            global _shardEval
+            _shardEval = self
+            pool = multiprocessing.get_context('fork').Pool(numProcs)
+            try:
+                results = pool.map(_evaluateShard, shards, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+                _shardEval = None
+            results = [(ious, self._unpackResults(packed))
+                       for ious, packed in results]
+        else:
+            results = [self._evaluateImgs(p.imgIds)]
+
+        # all area ranges of an image are evaluated together, results are
+        # stored in [KxAxI] order
+        makeEvals = self._makeEvals
+        maxDet = p.maxDets[-1]
+        A = len(p.areaRng)
+        I = len(p.imgIds)
+        self.ious = {}
+        self.evalImgs = [None] * (len(catIds) * A * I)
+        i = 0
+        for ious, imgResults in results:
+            self.ious.update(ious)
+            for catResults in imgResults:
+                for k, catId in enumerate(catIds):
+                    self.evalImgs[k*A*I + i:(k+1)*A*I:I] = makeEvals(
+                            p.imgIds[i], catId, p.areaRng, maxDet, catResults[k])
+                i += 1
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+    def _evaluateImgs(self, imgIds):
+        '''
+        Compute ious and match dts of every category and area range of some images
+        :return: ious (dict), and for each image a list with, for each
+                 category, the results of _matchImgAreas
+        '''
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
         if p.iouType == 'segm' or p.iouType == 'bbox':
             computeIoU = self.computeIoU
         elif p.iouType == 'keypoints':
             computeIoU = self.computeOks
         self.ious = {(imgId, catId): computeIoU(imgId, catId) \
-                        for imgId in p.imgIds
+                        for imgId in imgIds
                         for catId in catIds}
 
-        evaluateImg = self.evaluateImg
+        matchImgAreas = self._matchImgAreas
         maxDet = p.maxDets[-1]
-        self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
-                 for catId in catIds
-                 for areaRng in p.areaRng
-                 for imgId in p.imgIds
-             ]
-        self._paramsEval = copy.deepcopy(self.params)
-        toc = time.time()
-        print('DONE (t={:0.2f}s).'.format(toc-tic))
+        imgResults = [[matchImgAreas(imgId, catId, p.areaRng, maxDet)
+                       for catId in catIds]
+                      for imgId in imgIds]
+        return self.ious, imgResults
+
+    def _packResults(self, imgResults):
+        '''
+        Pack the arrays of results from _evaluateImgs into a few flat arrays
+        Many small arrays are slow to pickle, so results are sent between
+        processes packed. See _unpackResults.
+        :return: tuple of the results without arrays, and the flat arrays
+        '''
+        flat = [[], [], [], []]
+        packed = []
+        for catResults in imgResults:
+            for results in catResults:
+                if results is None:
+                    packed.append(None)
+                    continue
+                dtIds, dtScores, gtIgnore, dtIgnore, matchInds, matches = results
+                flat[0].append(gtIgnore.ravel())
+                flat[1].append(dtIgnore.ravel())
+                for gtIds, dtm, gtm in matches:
+                    flat[2].append(dtm.ravel())
+                    flat[3].append(gtm.ravel())
+                packed.append((dtIds, dtScores, matchInds,
+                               [gtIds for gtIds, _, _ in matches]))
+        dtypes = [np.int64, bool, np.float64, np.float64]
+        flat = [np.concatenate(arrays) if len(arrays) > 0 else np.zeros(0, dtype)
+                for arrays, dtype in zip(flat, dtypes)]
+        return len(imgResults), packed, flat
+
+    def _unpackResults(self, packedResults):
+        '''
+        Rebuild results packed by _packResults, arrays are views of the flat arrays
+        '''
+        numImgs, packed, flat = packedResults
+        T = len(self.params.iouThrs)
+        A = len(self.params.areaRng)
+        gtIgs, dtIgs, dtms, gtms = flat
+        gtIgStart = dtIgStart = dtmStart = gtmStart = 0
+        results = []
+        for entry in packed:
+            if entry is None:
+                results.append(None)
+                continue
+            dtIds, dtScores, matchInds, gtIdLists = entry
+            D = len(dtIds)
+            G = len(gtIdLists[0])
+            gtIgnore = gtIgs[gtIgStart:gtIgStart + A*G].reshape(A,G)
+            gtIgStart += A*G
+            dtIgnore = dtIgs[dtIgStart:dtIgStart + A*T*D].reshape(A,T,D)
+            dtIgStart += A*T*D
+            matches = []
+            for gtIds in gtIdLists:
+                matches.append((gtIds,
+                                dtms[dtmStart:dtmStart + T*D].reshape(T,D),
+                                gtms[gtmStart:gtmStart + T*G].reshape(T,G)))
+                dtmStart += T*D
+                gtmStart += T*G
+            results.append((dtIds, dtScores, gtIgnore, dtIgnore, matchInds, matches))
+        K = len(results) // numImgs if numImgs > 0 else 0
+        return [results[i*K:(i+1)*K] for i in range(numImgs)]
 
     def computeIoU(self, imgId, catId):
         p = self.params
@@ -169,6 +297,14 @@ class COCOeval:
         else:
             gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
             dt = [_ for cId in p.catIds for _ in self._dts[imgId,cId]]
+        if self._dtRes is not None:
+            rows = self._getDtRows(imgId, catId)
+            if len(gt) == 0 and len(rows) == 0:
+                return []
+            d = self._dtRes.bboxes[rows[0:p.maxDets[-1]]]
+            g = [g['bbox'] for g in gt]
+            iscrowd = [int(o['iscrowd']) for o in gt]
+            return maskUtils.iou(d,g,iscrowd)
         if len(gt) == 0 and len(dt) ==0:
             return []
         inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
@@ -233,11 +369,16 @@ class COCOeval:
                 ious[i, j] = np.sum(np.exp(-e)) / e.shape[0]
         return ious
 
-    def evaluateImg(self, imgId, catId, aRng, maxDet):
+    def _getImgArrays(self, imgId, catId):
         '''
-        perform evaluation for single category and image
-        :return: dict (single image results)
+        Gather the fields evaluateImg needs of the gts and dts of an image as arrays
+        dts are sorted highest score first, as in computeIoU. Arrays are
+        cached, so they are built once for all area ranges.
+        :return: dict of arrays, or None if the image has no gts and dts
         '''
+        key = (imgId, catId)
+        if key in self._imgArrays:
+            return self._imgArrays[key]
         p = self.params
         if p.useCats:
             gt = self._gts[imgId,catId]
@@ -245,73 +386,214 @@ class COCOeval:
         else:
             gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
             dt = [_ for cId in p.catIds for _ in self._dts[imgId,cId]]
-        if len(gt) == 0 and len(dt) ==0:
+        if self._dtRes is not None:
+            rows = self._getDtRows(imgId, catId)
+            D = len(rows)
+        else:
+            D = len(dt)
+        if len(gt) == 0 and D == 0:
+            self._imgArrays[key] = None
             return None
+        arrays = {
+                'gtIds':     np.array([g['id'] for g in gt], dtype=np.int64),
+                'gtAreas':   np.array([g['area'] for g in gt], dtype=np.float64),
+                'gtIgnore':  np.array([bool(g['ignore']) for g in gt], dtype=bool),
+                'gtCrowd':   np.array([bool(g['iscrowd']) for g in gt], dtype=bool),
+            }
+        if self._dtRes is not None:
+            arrays['dtIds'] = self._dtRes.ids[rows]
+            arrays['dtAreas'] = self._dtRes.areas[rows]
+            arrays['dtScores'] = self._dtRes.scores[rows].tolist()
+        else:
+            dtScores = np.array([d['score'] for d in dt], dtype=np.float64)
+            dtind = np.argsort(-dtScores, kind='mergesort')
+            arrays['dtIds'] = np.array([dt[i]['id'] for i in dtind], dtype=np.int64)
+            arrays['dtAreas'] = np.array([dt[i]['area'] for i in dtind], dtype=np.float64)
+            arrays['dtScores'] = [dt[i]['score'] for i in dtind]
+        self._imgArrays[key] = arrays
+        return arrays
+
+    def _getDtRows(self, imgId, catId):
+        '''
+        Rows of the dts of an image in the BboxResults arrays
+        Rows are sorted highest score first, in the same order computeIoU
+        sorts dt dicts in.
+        :return: rows (int array)
+        '''
+        p = self.params
+        rows = self._dtRes.getRows(imgId, catId if p.useCats else p.catIds)
+        inds = np.argsort(-self._dtRes.scores[rows], kind='mergesort')
+        return rows[inds]
 
-        for g in gt:
-            if g['ignore'] or (g['area']<aRng[0] or g['area']>aRng[1]):
-                g['_ignore'] = 1
+    def matchDetections(self, ious, gtIg, iscrowd):
+        '''
+        Greedily match dts to gts at every IoU threshold at once
+        Each dt, highest score first, takes the unmatched gt it overlaps
+        most, ties going to the later gt, preferring gts that are not
+        ignored. Crowd gts can match many dts. This gives the same matches
+        as the loop over thresholds, dts and gts of the Matlab code.
+        :param ious: [DxG] ious of score sorted dts and ignore sorted gts
+        :param gtIg: [G] bool ignore flag of each gt, ignored gts last
+        :param iscrowd: [G] bool crowd flag of each gt
+        :return: dtm [TxD] matched gt index or -1, gtm [TxG] matched dt index or -1
+        '''
+        thrs = self._iouThrs
+        T = len(thrs)
+        D, G = ious.shape
+        dtm = -np.ones((T,D), dtype=np.int64)
+        gtm = -np.ones((T,G), dtype=np.int64)
+        if G == 1:
+            # the first dt over the threshold gets the gt, or all do if crowd
+            hits = ious[:, 0] >= thrs[:, None]
+            tinds = np.flatnonzero(hits.any(axis=1))
+            if iscrowd[0]:
+                dtm[hits] = 0
+                gtm[tinds, 0] = D - 1 - np.argmax(hits[tinds, ::-1], axis=1)
             else:
-                g['_ignore'] = 0
+                first = np.argmax(hits[tinds], axis=1)
+                dtm[tinds, first] = 0
+                gtm[tinds, 0] = first
+            return dtm, gtm
+
+        # dts that do not overlap any gt enough can not match
+        cands = np.flatnonzero(ious.max(axis=1) >= thrs.min())
+        # gts reversed, so argmax finds the last gt with the highest iou
+        over = ious[cands, None, ::-1] >= thrs[None, :, None]
+        revIous = ious[cands, ::-1]
+        revIg = gtIg[::-1]
+        revCrowd = iscrowd[::-1]
+        taken = np.zeros((T,G), dtype=bool)
+        hasIg = gtIg.any()
+        for cind, dind in enumerate(cands):
+            # gts that can still be matched, and overlap enough
+            valid = over[cind] & ~taken
+            if hasIg:
+                # a match to a regular gt beats any match to an ignored one
+                hasReg = (valid & ~revIg).any(axis=1)
+                valid &= ~(hasReg[:, None] & revIg)
+            tinds = np.flatnonzero(valid.any(axis=1))
+            if len(tinds) == 0:
+                continue
+            m = np.argmax(np.where(valid[tinds], revIous[cind], -1), axis=1)
+            taken[tinds, m] = ~revCrowd[m]
+            dtm[tinds, dind] = G - 1 - m
+            gtm[tinds, G - 1 - m] = dind
+        return dtm, gtm
 
-        # sort dt highest score first, sort gt ignore last
-        gtind = np.argsort([g['_ignore'] for g in gt], kind='mergesort')
-        gt = [gt[i] for i in gtind]
-        dtind = np.argsort([-d['score'] for d in dt], kind='mergesort')
-        dt = [dt[i] for i in dtind[0:maxDet]]
-        iscrowd = [int(o['iscrowd']) for o in gt]
+    def evaluateImg(self, imgId, catId, aRng, maxDet):
+        '''
+        perform evaluation for single category and image
+        :return: dict (single image results)
+        '''
+        return self.evaluateImgAreas(imgId, catId, [aRng], maxDet)[0]
+
+    def evaluateImgAreas(self, imgId, catId, areaRngs, maxDet):
+        '''
+        perform evaluation for single category and image, for every area range
+        :return: list of dict (single image results), one for each area range
+        '''
+        return self._makeEvals(imgId, catId, areaRngs, maxDet,
+                               self._matchImgAreas(imgId, catId, areaRngs, maxDet))
+
+    def _matchImgAreas(self, imgId, catId, areaRngs, maxDet):
+        '''
+        Match the dts of a single category and image, for every area range
+        Area ranges only differ in which gts are ignored, and which unmatched
+        dts are. dts are matched once for each distinct set of ignored gts,
+        which is often once for all ranges, as ignoring all gts or none
+        gives the same matches.
+        :return: tuple of the results of all area ranges, see _makeEvals, or
+                 None if the image has no gts and dts
+        '''
+        arrays = self._getImgArrays(imgId, catId)
+        if arrays is None:
+            return None
+        T = len(self.params.iouThrs)
+        A = len(areaRngs)
+
+        rngs = np.asarray(areaRngs, dtype=np.float64)
+        gtAreas = arrays['gtAreas']
+        gtIgs = arrays['gtIgnore'] | (gtAreas < rngs[:, 0:1]) | (gtAreas > rngs[:, 1:2])
+        dtIds = arrays['dtIds'][0:maxDet]
+        dtAreas = arrays['dtAreas'][0:maxDet]
+        dtOut = (dtAreas < rngs[:, 0:1]) | (dtAreas > rngs[:, 1:2])
         # load computed ious
-        ious = self.ious[imgId, catId][:, gtind] if len(self.ious[imgId, catId]) > 0 else self.ious[imgId, catId]
-
-        T = len(p.iouThrs)
-        G = len(gt)
-        D = len(dt)
-        gtm  = np.zeros((T,G))
-        dtm  = np.zeros((T,D))
-        gtIg = np.array([g['_ignore'] for g in gt])
-        dtIg = np.zeros((T,D))
-        if not len(ious)==0:
-            for tind, t in enumerate(p.iouThrs):
-                for dind, d in enumerate(dt):
-                    # information about best match so far (m=-1 -> unmatched)
-                    iou = min([t,1-1e-10])
-                    m   = -1
-                    for gind, g in enumerate(gt):
-                        # if this gt already matched, and not a crowd, continue
-                        if gtm[tind,gind]>0 and not iscrowd[gind]:
-                            continue
-                        # if dt matched to reg gt, and on ignore gt, stop
-                        if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
-                            break
-                        # continue to next gt unless better match made
-                        if ious[dind,gind] < iou:
-                            continue
-                        # if match successful and best so far, store appropriately
-                        iou=ious[dind,gind]
-                        m=gind
-                    # if match made store id of match for both dt and gt
-                    if m ==-1:
-                        continue
-                    dtIg[tind,dind] = gtIg[m]
-                    dtm[tind,dind]  = gt[m]['id']
-                    gtm[tind,m]     = d['id']
-        # set unmatched detections outside of area range to ignore
-        a = np.array([d['area']<aRng[0] or d['area']>aRng[1] for d in dt]).reshape((1, len(dt)))
-        dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
-        # store results for given image and category
-        return {
-                'image_id':     imgId,
-                'category_id':  catId,
-                'aRng':         aRng,
-                'maxDet':       maxDet,
-                'dtIds':        [d['id'] for d in dt],
-                'gtIds':        [g['id'] for g in gt],
-                'dtMatches':    dtm,
-                'gtMatches':    gtm,
-                'dtScores':     [d['score'] for d in dt],
-                'gtIgnore':     gtIg,
-                'dtIgnore':     dtIg,
-            }
+        ious = self.ious[imgId, catId]
+
+        G = len(arrays['gtIds'])
+        D = len(dtIds)
+        anyIg = gtIgs.any(axis=1)
+        allIg = gtIgs.all(axis=1)
+        keys = {}
+        matches = []
+        matchInds = []
+        gtIgnore = np.empty((A,G), dtype=np.int64)
+        dtIgnore = np.empty((A,T,D), dtype=bool)
+        for aind in range(A):
+            gtIg = gtIgs[aind]
+            mixed = anyIg[aind] and not allIg[aind]
+            key = gtIg.tobytes() if mixed else None
+            if key not in keys:
+                # sort gt ignore last, dts are already sorted highest score first
+                gtind = np.argsort(gtIg, kind='mergesort') if mixed else slice(None)
+                gtIds = arrays['gtIds'][gtind]
+                gtm = np.zeros((T,G))
+                dtm = np.zeros((T,D))
+                # [T,D] index of the gt matched by each dt
+                matched = (np.zeros(0, dtype=np.int64),) * 2
+                dtMatch = np.zeros(0, dtype=np.int64)
+                if not len(ious)==0:
+                    dtMatch, gtMatch = self.matchDetections(ious[0:D, gtind],
+                                                            gtIg[gtind],
+                                                            arrays['gtCrowd'][gtind])
+                    matched = np.nonzero(dtMatch > -1)
+                    dtMatch = dtMatch[matched]
+                    dtm[matched] = gtIds[dtMatch]
+                    gtMatched = gtMatch > -1
+                    gtm[gtMatched] = dtIds[gtMatch[gtMatched]]
+                keys[key] = (len(matches), gtind, dtm==0, matched, dtMatch)
+                matches.append((gtIds.tolist(), dtm, gtm))
+            matchInd, gtind, unmatched, matched, dtMatch = keys[key]
+            matchInds.append(matchInd)
+            gtIg = gtIg[gtind]
+            gtIgnore[aind] = gtIg
+
+            # set unmatched detections outside of area range to ignore
+            dtIg = np.logical_and(unmatched, dtOut[aind], out=dtIgnore[aind])
+            if len(dtMatch) > 0:
+                dtIg[matched] = gtIg[dtMatch]
+        return (dtIds.tolist(), arrays['dtScores'][0:maxDet], gtIgnore, dtIgnore,
+                matchInds, matches)
+
+    def _makeEvals(self, imgId, catId, areaRngs, maxDet, results):
+        '''
+        Make the evalImgs entries of a single category and image
+        The results of all area ranges from _matchImgAreas are kept in a few
+        arrays, so they are cheap to send between processes. Entries
+        share these arrays.
+        :return: list of dict (single image results), one for each area range
+        '''
+        if results is None:
+            return [None] * len(areaRngs)
+        dtIds, dtScores, gtIgnore, dtIgnore, matchInds, matches = results
+        evals = []
+        for aind, aRng in enumerate(areaRngs):
+            gtIds, dtm, gtm = matches[matchInds[aind]]
+            # store results for given image and category
+            evals.append({
+                    'image_id':     imgId,
+                    'category_id':  catId,
+                    'aRng':         aRng,
+                    'maxDet':       maxDet,
+                    'dtIds':        dtIds,
+                    'gtIds':        gtIds,
+                    'dtMatches':    dtm,
+                    'gtMatches':    gtm,
+                    'dtScores':     dtScores,
+                    'gtIgnore':     gtIgnore[aind],
+                    'dtIgnore':     dtIgnore[aind],
+                })
+        return evals
 
     def accumulate(self, p = None):
         '''
@@ -504,8 +786,8 @@ class Params:
         self.imgIds = []
         self.catIds = []
         # np.arange causes trouble.  the data point on arange is slightly larger than the true value
-        self.iouThrs = np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
-        self.recThrs = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         self.maxDets = [1, 10, 100]
         self.areaRng = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'small', 'medium', 'large']
@@ -515,8 +797,8 @@ class Params:
         self.imgIds = []
         self.catIds = []
         # np.arange causes trouble.  the data point on arange is slightly larger than the true value
-        self.iouThrs = np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
-        self.recThrs = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         self.maxDets = [20]
         self.areaRng = [[0 ** 2, 1e5 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'medium', 'large']
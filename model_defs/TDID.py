@@ -7,6 +7,7 @@ import numpy as np
 import sys
 
 from .anchors.proposal_layer import proposal_layer as proposal_layer_py
+from .anchors.torch_proposal_layer import proposal_layer as proposal_layer_torch
 from .anchors.anchor_target_layer import anchor_target_layer as anchor_target_layer_py
 from utils import *
 
@@ -54,7 +55,7 @@ class TDID(torch.nn.Module):
         return self.class_cross_entropy_loss + self.box_regression_loss * 10
 
     def forward(self, target_data, img_data, img_info, gt_boxes=None,
-                features_given=False):
+                features_given=False, anchor_data=None, scene_inds=None):
         '''
         Forward pass through TDID network.
 
@@ -64,7 +65,9 @@ class TDID(torch.nn.Module):
         W = width
 
         Input parameters:
-            target_data: (torch.FloatTensor) (B*2)xCxHxW tensor of target data 
+            target_data: (torch.FloatTensor) (B*2)xCxHxW tensor of target data,
+                         or a list of buckets of target images, see
+                         get_target_features
             img_data: (torch.FloatTensor) BxCxHxW tensor of scene image data 
             img_info: (tuple) shape of original scene image
             
@@ -75,6 +78,20 @@ class TDID(torch.nn.Module):
                                        are assumed to be feature maps. The feature
                                        extraction portion of the forward pass
                                        is skipped. Default: False
+            anchor_data (optional): (tuple of ndarray) output of
+                                    anchor_target_layer for this batch, if it
+                                    was already computed (i.e. in DataLoader
+                                    workers). Only used for training.
+                                    Default: None
+            scene_inds (optional): (ndarray) pairs each target with a scene.
+                                   Gives, for each of the P pairings, the
+                                   index of its scene in img_data. Scene
+                                   features are computed once and shared
+                                   by all their pairings, only the head runs
+                                   P times. gt_boxes and anchor_data are
+                                   then per pairing. If None, the i-th
+                                   target goes with the i-th scene.
+                                   Default: None
 
         Returns:
             scores: (torch.autograd.variable.Variable) Bxcfg.PROPOSAL_BATCH_SIZEx1
@@ -86,54 +103,18 @@ class TDID(torch.nn.Module):
             target_features = target_data 
         else:
             img_features = self.features(img_data)
-            target_features = self.features(target_data)
-
-
-        all_corrs = []
-        all_diffs = []
-        for batch_ind in range(img_features.size()[0]):
-            img_ind = np_to_variable(np.asarray([batch_ind]),
-                                     is_cuda=True, dtype=torch.LongTensor)
-            cur_img_feats = torch.index_select(img_features,0,img_ind)
-
-            cur_diffs = []
-            cur_corrs = []
-            for target_type in range(self.cfg.NUM_TARGETS):
-                target_ind = np_to_variable(np.asarray([batch_ind*
-                                            self.cfg.NUM_TARGETS+target_type]),
-                                            is_cuda=True,dtype=torch.LongTensor)
-                cur_target_feats = torch.index_select(target_features,0,
-                                                      target_ind[0])
-                cur_target_feats = cur_target_feats.view(-1,1,
-                                                     cur_target_feats.size()[2],
-                                                     cur_target_feats.size()[3])
-                pooled_target_feats = F.max_pool2d(cur_target_feats,
-                                         (cur_target_feats.size()[2],
-                                          cur_target_feats.size()[3]))
-
-                cur_diffs.append(cur_img_feats -
-                    pooled_target_feats.permute(1,0,2,3).expand_as(cur_img_feats))
-                if self.cfg.CORR_WITH_POOLED:
-                    cur_corrs.append(F.conv2d(cur_img_feats,
-                                             pooled_target_feats,
-                                             groups=self.num_feature_channels))
-                else:
-                    target_conv_padding = (max(0,int(
-                                          target_features.size()[2]/2)), 
-                                           max(0,int(
-                                           target_features.size()[3]/2)))
-                    cur_corrs.append(F.conv2d(cur_img_feats,cur_target_feats,
-                                             padding=target_conv_padding,
-                                             groups=self.num_feature_channels))
-                
-
-            cur_corrs = torch.cat(cur_corrs,1)
-            cur_corrs = self.select_to_match_dimensions(cur_corrs,cur_img_feats)
-            all_corrs.append(cur_corrs)
-            all_diffs.append(torch.cat(cur_diffs,1))
-
-        corr = self.corr_conv(torch.cat(all_corrs,0))
-        diff = self.diff_conv(torch.cat(all_diffs,0))
+            target_features = self.get_target_features(target_data)
+
+        if scene_inds is not None:
+            scene_inds = Variable(torch.from_numpy(
+                                  np.asarray(scene_inds, dtype=np.int64)))
+            if img_features.is_cuda:
+                scene_inds = scene_inds.cuda()
+            img_features = torch.index_select(img_features, 0, scene_inds)
+
+        corrs, diffs = self.correlate_targets(img_features, target_features)
+        corr = self.corr_conv(corrs)
+        diff = self.diff_conv(diffs)
       
         if self.cfg.USE_IMG_FEATS and self.cfg.USE_DIFF_FEATS:
             if self.cfg.USE_CC_FEATS: 
@@ -156,13 +137,23 @@ class TDID(torch.nn.Module):
         embedding_feats = self.embedding_conv(concat_feats)
         class_score = self.score_conv(embedding_feats)
         class_score_reshape = self.reshape_layer(class_score, 2)
-        class_prob = F.softmax(class_score_reshape)
-        class_prob_reshape = self.reshape_layer(class_prob, len(self.anchor_scales)*3*2)
-
         bbox_pred = self.bbox_conv(embedding_feats)
 
         # proposal layer
-        rois, scores, anchor_inds, labels = self.proposal_layer(
+        if self.cfg.TORCH_PROPOSAL_LAYER:
+            rois, scores, anchor_inds, labels = self.proposal_layer_torch(
+                                                           class_score,
+                                                           bbox_pred,
+                                                           img_info,
+                                                           self.cfg,
+                                                           self._feat_stride,
+                                                           self.anchor_scales,
+                                                           gt_boxes)
+        else:
+            class_prob = F.softmax(class_score_reshape)
+            class_prob_reshape = self.reshape_layer(class_prob, 
+                                                len(self.anchor_scales)*3*2)
+            rois, scores, anchor_inds, labels = self.proposal_layer(
                                                            class_prob_reshape,
                                                            bbox_pred,
                                                            img_info,
@@ -173,10 +164,13 @@ class TDID(torch.nn.Module):
     
         if self.training:
             assert gt_boxes is not None
-            anchor_data = self.anchor_target_layer(class_score,gt_boxes, 
-                                                img_info, self.cfg,
-                                                self._feat_stride, 
-                                                self.anchor_scales)
+            if anchor_data is None:
+                anchor_data = anchor_target_layer_py(class_score.size(),
+                                                     gt_boxes, img_info,
+                                                     self.cfg,
+                                                     self._feat_stride,
+                                                     self.anchor_scales)
+            anchor_data = self.anchor_data_to_variables(anchor_data)
             self.class_cross_entropy_loss, self.box_regression_loss = \
                     self.build_loss(class_score_reshape, bbox_pred, anchor_data)
 
@@ -186,6 +180,112 @@ class TDID(torch.nn.Module):
         return scores, rois
 
 
+    def get_target_features(self, target_data):
+        '''
+        Runs target images through the feature net, maybe in size buckets
+
+        Each bucket of target images goes through the feature net on its
+        own, so small targets are not padded to the size of the largest
+        one. Feature maps of all buckets are then zero padded to the same
+        size, or pooled if cfg.CORR_WITH_POOLED, and put back in order.
+        Features are non negative, so zero padding does not change the 
+        pooled features.
+
+        Input parameters:
+            target_data: (torch.autograd.variable.Variable) NxCxhxw target
+                         images, or a list of buckets, each a tuple of
+                         (Variable) nxCxhxw images and (ndarray) their
+                         indices in 0..N-1, as from TDIDTrainSet.collate
+
+        Returns:
+            (torch.autograd.variable.Variable) NxCxh'xw' target features
+        '''
+        if not isinstance(target_data, (list, tuple)):
+            return self.features(target_data)
+        if len(target_data) == 1:
+            #a single bucket holds all targets in order
+            return self.features(target_data[0][0])
+
+        bucket_features = [self.features(data) for data, _ in target_data]
+        if self.cfg.CORR_WITH_POOLED:
+            bucket_features = [F.max_pool2d(features, features.size()[2:])
+                               for features in bucket_features]
+        else:
+            height = max(features.size()[2] for features in bucket_features)
+            width = max(features.size()[3] for features in bucket_features)
+            bucket_features = [F.pad(features,
+                                     (0, width - features.size()[3],
+                                      0, height - features.size()[2]))
+                               for features in bucket_features]
+        target_features = torch.cat(bucket_features, 0)
+
+        order = np.concatenate([inds for _, inds in target_data])
+        inverse_order = torch.from_numpy(np.argsort(order))
+        inverse_order = Variable(inverse_order)
+        if target_features.is_cuda:
+            inverse_order = inverse_order.cuda()
+        return torch.index_select(target_features, 0, inverse_order)
+
+
+    def correlate_targets(self, img_features, target_features):
+        '''
+        Compute correlation and difference features for a batch
+
+        Every scene in the batch is paired with its cfg.NUM_TARGETS target
+        feature maps. All pairs are handled at once: targets are pooled in
+        a single op and correlated with one grouped convolution that has a
+        group for every (scene, target, channel).
+
+        B = batch size
+        T = cfg.NUM_TARGETS
+        C = number of channels
+
+        Input parameters:
+            img_features: (torch.autograd.variable.Variable) BxCxHxW
+            target_features: (torch.autograd.variable.Variable) (B*T)xCxhxw
+
+        Returns:
+            corrs: (torch.autograd.variable.Variable) Bx(T*C)xHxW
+            diffs: (torch.autograd.variable.Variable) Bx(T*C)xHxW
+        '''
+        batch_size, num_channels, height, width = img_features.size()
+        num_targets = self.cfg.NUM_TARGETS
+        target_height, target_width = target_features.size()[2:]
+
+        pooled_target_feats = F.max_pool2d(target_features,
+                                           (target_height, target_width))
+        pooled_target_feats = pooled_target_feats.view(batch_size, num_targets,
+                                                       num_channels, 1, 1)
+        #features of permuted NHWC images may not be contiguous
+        img_features = img_features.contiguous().unsqueeze(1)
+
+        diffs = (img_features - pooled_target_feats).view(batch_size,
+                                                   num_targets*num_channels,
+                                                   height, width)
+        if self.cfg.CORR_WITH_POOLED:
+            #correlating with a 1x1 kernel per channel is a product
+            corrs = (img_features * pooled_target_feats).view(batch_size,
+                                                   num_targets*num_channels,
+                                                   height, width)
+        else:
+            num_groups = batch_size*num_targets*num_channels
+            img_features = img_features.expand(batch_size, num_targets,
+                                               num_channels, height, width)
+            img_features = img_features.contiguous().view(1, num_groups,
+                                                          height, width)
+            target_conv_padding = (max(0,int(target_height/2)),
+                                   max(0,int(target_width/2)))
+            corrs = F.conv2d(img_features,
+                             target_features.contiguous().view(num_groups, 1,
+                                                               target_height,
+                                                               target_width),
+                             padding=target_conv_padding,
+                             groups=num_groups)
+            corrs = corrs.view(batch_size, num_targets*num_channels,
+                               corrs.size()[2], corrs.size()[3])
+            corrs = self.select_to_match_dimensions(corrs, img_features)
+        return corrs, diffs
+
 
     def build_loss(self, class_score_reshape, bbox_pred, anchor_data):
         '''
@@ -289,16 +389,10 @@ class TDID(torch.nn.Module):
         '''
 
         if a.size()[2] > b.size()[2]:
-            a = torch.index_select(a, 2, 
-                                  np_to_variable(np.arange(0,
-                                        b.size()[2]).astype(np.int32),
-                                         is_cuda=True,dtype=torch.LongTensor))
+            a = a[:, :, :b.size()[2]]
         if a.size()[3] > b.size()[3]:
-            a = torch.index_select(a, 3, 
-                                  np_to_variable(np.arange(0,
-                                    b.size()[3]).astype(np.int32),
-                                          is_cuda=True,dtype=torch.LongTensor))
-        return a 
+            a = a[:, :, :, :b.size()[3]]
+        return a
 
 
     @staticmethod
@@ -343,19 +437,42 @@ class TDID(torch.nn.Module):
 
 
     @staticmethod
-    def anchor_target_layer(class_score, gt_boxes, img_info,
-                            cfg, _feat_stride, anchor_scales):
-        ''' 
-        Assigns fg/bg label to anchor boxes.      
+    def proposal_layer_torch(class_score, bbox_pred, img_info, cfg, 
+                             _feat_stride, anchor_scales, gt_boxes=None):
+        '''
+        Get top scoring detections without leaving the device
 
+        Wrapper for proposal_layer_torch. Takes the score logits, not the
+        softmax probabilities. 
 
         Input parameters:
-            class_score:  (torch.autograd.variable.Variable)
-            gt_boxes:  (ndarray)
-            img_info:  (tuple of int)
+            class_score: (torch.autograd.variable.Variable)
+            bbox_pred: (torch.autograd.variable.Variable)
+            img_info: (tuple)
             cfg: (Config) from ../configs
             _feat_stride:  (int)
             anchor_scales: (list of int)
+            
+            gt_boxes (optional): (ndarray) Defatul: None
+        '''
+        rois, scores, anchor_inds, labels = proposal_layer_torch(
+                                                       class_score,
+                                                       bbox_pred,
+                                                       img_info, cfg,
+                                                       _feat_stride=_feat_stride,
+                                                       anchor_scales=anchor_scales,
+                                                       gt_boxes=gt_boxes)
+        return (Variable(rois), Variable(scores), Variable(anchor_inds),
+                Variable(labels))
+
+
+    @staticmethod
+    def anchor_data_to_variables(anchor_data):
+        ''' 
+        Puts fg/bg labels and box targets of anchor boxes on the gpu
+
+        Input parameters:
+            anchor_data: (tuple of ndarray) output of anchor_target_layer
 
         Returns:
             labels: (torch.autograd.variable.Variable)
@@ -363,10 +480,8 @@ class TDID(torch.nn.Module):
             bbox_inside_weights:(torch.autograd.variable.Variable)
             bbox_outside_weights:(torch.autograd.variable.Variable)
         ''' 
-        class_score = class_score.data.cpu().numpy()
         labels, bbox_targets, bbox_inside_weights, bbox_outside_weights = \
-            anchor_target_layer_py(class_score, gt_boxes, img_info,
-                                   cfg, _feat_stride, anchor_scales)
+                                                                  anchor_data
 
         labels = np_to_variable(labels, is_cuda=True, dtype=torch.LongTensor)
         bbox_targets = np_to_variable(bbox_targets, is_cuda=True)
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from .generate_anchors import generate_anchors
+
+#max number of grids/masks kept, AVD frames come in only a few sizes
+ANCHOR_GRID_CACHE_SIZE = 16
+
+
+class _LRUCache(object):
+    '''
+    Holds at most max_size read-only ndarrays or tensors, dropping the
+    least recently used one when full. Tensors can not be made read-only,
+    do not change them.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        '''
+        Returns the cached value for key, calling compute() if it is missing
+        '''
+        if key in self._entries:
+            self.hits += 1
+            value = self._entries.pop(key)
+        else:
+            self.misses += 1
+            value = compute()
+            for array in (value if isinstance(value, tuple) else (value,)):
+                if isinstance(array, np.ndarray):
+                    array.flags.writeable = False
+            if len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+        self._entries[key] = value
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_anchor_grids = _LRUCache(ANCHOR_GRID_CACHE_SIZE)
+_inside_anchors = _LRUCache(ANCHOR_GRID_CACHE_SIZE)
+_anchor_grid_tensors = _LRUCache(ANCHOR_GRID_CACHE_SIZE)
+
+
+def get_anchor_grid(height, width, feat_stride, anchor_scales):
+    '''
+    Gets all shifted anchor boxes for a feature map
+
+    Input parameters:
+        height: (int) height of the feature map
+        width: (int) width of the feature map
+        feat_stride: (int) scaling factor between feature map and image
+        anchor_scales: (list of int) scale for size of anchor boxes
+
+    Returns:
+        (ndarray) (H*W*A)x4 read-only float32 anchor boxes, rows ordered
+        by (h, w, a) in slowest to fastest order
+    '''
+    key = (int(height), int(width), feat_stride, tuple(anchor_scales))
+    return _anchor_grids.get(key, lambda: _make_anchor_grid(*key))
+
+
+def get_anchor_grid_tensor(height, width, feat_stride, anchor_scales, like):
+    '''
+    Gets the anchor grid of get_anchor_grid as a tensor
+
+    A copy is kept for each tensor type and device, so the grid is moved
+    to the gpu once.
+
+    Input parameters:
+        height, width, feat_stride, anchor_scales: see get_anchor_grid
+        like: (torch tensor) the grid has its type and device
+
+    Returns:
+        (torch tensor) (H*W*A)x4 anchor boxes, shared, do not change it
+    '''
+    key = (int(height), int(width), feat_stride, tuple(anchor_scales),
+           like.type(), like.get_device() if like.is_cuda else -1)
+
+    def compute():
+        grid = get_anchor_grid(height, width, feat_stride, anchor_scales)
+        return torch.from_numpy(np.array(grid)).type_as(like)
+
+    return _anchor_grid_tensors.get(key, compute)
+
+
+def get_inside_anchors(height, width, feat_stride, anchor_scales,
+                       img_height, img_width, allowed_border=0):
+    '''
+    Gets the shifted anchor boxes that lie inside an image
+
+    Input parameters:
+        height: (int) height of the feature map
+        width: (int) width of the feature map
+        feat_stride: (int) scaling factor between feature map and image
+        anchor_scales: (list of int) scale for size of anchor boxes
+        img_height: (int) height of the image
+        img_width: (int) width of the image
+
+        allowed_border (optional): (int) how far anchors can sit over the
+                                   edge of the image. Default: 0
+
+    Returns:
+        inds_inside: (ndarray) read-only indices into the full anchor grid
+        anchors: (ndarray) read-only float32 anchors inside the image
+    '''
+    key = (int(height), int(width), feat_stride, tuple(anchor_scales),
+           int(img_height), int(img_width), allowed_border)
+
+    def compute():
+        all_anchors = get_anchor_grid(height, width, feat_stride,
+                                      anchor_scales)
+        inds_inside = np.where(
+            (all_anchors[:, 0] >= -allowed_border) &
+            (all_anchors[:, 1] >= -allowed_border) &
+            (all_anchors[:, 2] < img_width + allowed_border) &  # width
+            (all_anchors[:, 3] < img_height + allowed_border)  # height
+        )[0]
+        return inds_inside, all_anchors[inds_inside, :]
+
+    return _inside_anchors.get(key, compute)
+
+
+def _make_anchor_grid(height, width, feat_stride, anchor_scales):
+    _anchors = generate_anchors(scales=np.array(anchor_scales))
+    A = _anchors.shape[0]
+
+    # Enumerate all shifts
+    shift_x = np.arange(0, width) * feat_stride
+    shift_y = np.arange(0, height) * feat_stride
+    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
+                        shift_x.ravel(), shift_y.ravel())).transpose()
+
+    # add A anchors (1, A, 4) to
+    # cell K shifts (K, 1, 4) to get
+    # shift anchors (K, A, 4)
+    # reshape to (K*A, 4) shifted anchors
+    K = shifts.shape[0]
+    anchors = (_anchors.reshape((1, A, 4)) +
+               shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
+    return anchors.reshape((K * A, 4)).astype(np.float32)
@@ -11,17 +11,16 @@ import yaml
 import numpy as np
 import numpy.random as npr
 
-from .generate_anchors import generate_anchors
-from .cython_bbox import bbox_overlaps, bbox_intersections
-from .bbox_transform import bbox_transform
+from .anchor_grid import get_inside_anchors
 
-def anchor_target_layer(cls_score, gt_boxes, img_info, cfg, _feat_stride=16,
+def anchor_target_layer(score_shape, gt_boxes, img_info, cfg, _feat_stride=16,
                         anchor_scales=[2, 4, 8,]):
     ''' 
     Produces anchor classification labels and bounding-box regression targets.
     
     Input parameters:
-        cls_score:  (ndarray) network output score map
+        score_shape:  (tuple of int) BxCxHxW shape of the network output
+                      score map, only its shape is needed
         gt_boxes: (ndarray) ground truth bounding boxes
         img_info:  (tuple of int)
         cfg: (Config)
@@ -46,198 +45,186 @@ def anchor_target_layer(cls_score, gt_boxes, img_info, cfg, _feat_stride=16,
     #   apply predicted bbox deltas at cell i to each of the 9 anchors
     # filter out-of-image anchors
     # measure GT overlap
+    #
+    # every batch item has a single gt box, so all items are handled at once
 
-    batch_size = cls_score.shape[0]
+    batch_size = score_shape[0]
 
-    _anchors = generate_anchors(scales=np.array(anchor_scales))
-    _num_anchors = _anchors.shape[0]
+    _num_anchors = 3 * len(anchor_scales)
 
     # allow boxes to sit over the edge by a small amount
     _allowed_border = 0
 
     # map of shape (..., H, W)
     # pytorch (bs, c, h, w)
-    height, width = cls_score.shape[2:4]
-
-    # 1. Generate proposals from bbox deltas and shifted anchors
-    shift_x = np.arange(0, width) * _feat_stride
-    shift_y = np.arange(0, height) * _feat_stride
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)  # in W H order
-    # K is H x W
-    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                        shift_x.ravel(), shift_y.ravel())).transpose()
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
+    height, width = score_shape[2:4]
+
+    # all (K*A) shifted anchors, K is H x W. Only keep anchors inside the 
+    # image, the grid and mask are shared with proposal_layer
     A = _num_anchors
-    K = shifts.shape[0]
-    all_anchors = (_anchors.reshape((1, A, 4)) +
-                   shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
-    all_anchors = all_anchors.reshape((K * A, 4))
-    total_anchors = int(K * A)
-
-    # only keep anchors inside the image
-    inds_inside = np.where(
-        (all_anchors[:, 0] >= -_allowed_border) &
-        (all_anchors[:, 1] >= -_allowed_border) &
-        (all_anchors[:, 2] < img_info[1] + _allowed_border) &  # width
-        (all_anchors[:, 3] < img_info[0] + _allowed_border)  # height
-    )[0]
-
-    # keep only inside anchors
-    anchors = all_anchors[inds_inside, :]
-
-    all_labels = None 
-    all_bbox_targets = None 
-    all_bbox_inside_weights = None
-    all_bbox_outside_weights = None 
-
-    for batch_ind in range(batch_size):
-
-        # label: 1 is positive, 0 is negative, -1 is dont care
-        labels = np.empty((len(inds_inside),), dtype=np.float32)
-        labels.fill(-1)
-
-        #get rid of background gt_boxes
-        gt_box = np.expand_dims(gt_boxes[batch_ind,:], 0)
-        if gt_box[0,-1] == 0:
-            #if target is not present(no gt box) all boxes are bg (0)
-            labels.fill(0)
-        else:
-            # overlaps between the anchors and the gt boxes
-            # overlaps (ex, gt), shape is A x G
-            overlaps = bbox_overlaps(
-                np.ascontiguousarray(anchors, dtype=np.float),
-                np.ascontiguousarray(gt_box, dtype=np.float))
-            argmax_overlaps = overlaps.argmax(axis=1)  # (A)
-            max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
-            gt_argmax_overlaps = overlaps.argmax(axis=0)  # G
-            gt_max_overlaps = overlaps[gt_argmax_overlaps,
-                                       np.arange(overlaps.shape[1])]
-            gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
-
-            if not cfg.PROPOSAL_CLOBBER_POSITIVES:
-                # assign bg labels first so that positive labels can clobber them
-                labels[max_overlaps < cfg.PROPOSAL_NEGATIVE_OVERLAP] = 0
-
-            # fg label: for each gt, anchor with highest overlap
-            labels[gt_argmax_overlaps] = 1
-            # fg label: above threshold IOU
-            labels[max_overlaps >= cfg.PROPOSAL_POSITIVE_OVERLAP] = 1
-
-            if cfg.PROPOSAL_CLOBBER_POSITIVES:
-                # assign bg labels last so that negative labels can clobber positives
-                labels[max_overlaps < cfg.PROPOSAL_NEGATIVE_OVERLAP] = 0
-
-
-        # subsample positive labels if we have too many
-        num_fg = int(cfg.PROPOSAL_FG_FRACTION * cfg.PROPOSAL_BATCH_SIZE)
-        fg_inds = np.where(labels == 1)[0]
-        if len(fg_inds) > num_fg:
-            disable_inds = npr.choice(
-                fg_inds, size=(len(fg_inds) - num_fg), replace=False)
-            labels[disable_inds] = -1
-
-        # subsample negative labels if we have too many
-        num_bg = cfg.PROPOSAL_BATCH_SIZE - np.sum(labels == 1)
-        bg_inds = np.where(labels == 0)[0]
-        if len(bg_inds) > num_bg:
-
-            disable_inds = npr.choice(
-                bg_inds, size=(len(bg_inds) - num_bg), replace=False)
-            labels[disable_inds] = -1
-
-        #if the gt_box is a dummy bg, there are no bbox_targets
-        if gt_box[0,-1] == 0:
-            bbox_targets = np.zeros((len(inds_inside), 4), dtype=np.float32)
-        else:
-            bbox_targets = _compute_targets(anchors, gt_box[argmax_overlaps, :])
-
-        bbox_inside_weights = np.zeros((len(inds_inside), 4), dtype=np.float32)
-        bbox_inside_weights[labels == 1, :] = np.array(cfg.PROPOSAL_BBOX_INSIDE_WEIGHTS)
-
-        bbox_outside_weights = np.zeros((len(inds_inside), 4), dtype=np.float32)
-        if cfg.PROPOSAL_POSITIVE_WEIGHT < 0:
-            # uniform weighting of examples (given non-uniform sampling)
-            positive_weights = np.ones((1, 4))
-            negative_weights = np.zeros((1, 4))
-        else:
-            assert ((cfg.PROPOSAL_POSITIVE_WEIGHT > 0) &
-                    (cfg.PROPOSAL_POSITIVE_WEIGHT < 1))
-            positive_weights = (cfg.PROPOSAL_POSITIVE_WEIGHT /
-                                (np.sum(labels == 1)) + 1)
-            negative_weights = ((1.0 - cfg.PROPOSAL_POSITIVE_WEIGHT) /
-                                (np.sum(labels == 0)) + 1)
-        bbox_outside_weights[labels == 1, :] = positive_weights
-        bbox_outside_weights[labels == 0, :] = negative_weights
-
-        # map up to original set of anchors
-        labels = _unmap(labels, total_anchors, inds_inside, fill=-1)
-        bbox_targets = _unmap(bbox_targets, total_anchors, inds_inside, fill=0)
-        bbox_inside_weights = _unmap(bbox_inside_weights, total_anchors, inds_inside, fill=0)
-        bbox_outside_weights = _unmap(bbox_outside_weights, total_anchors, inds_inside, fill=0)
-
-        # labels
-        labels = labels.reshape((1, height, width, A))
-        labels = labels.transpose(0, 3, 1, 2)
-        labels = labels.reshape((1, 1, A * height, width)).transpose(0, 2, 3, 1)
-        #labels = labels
-
-        # bbox_targets
-        bbox_targets = bbox_targets \
-            .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-
-        bbox_targets = bbox_targets
-        # bbox_inside_weights
-        bbox_inside_weights = bbox_inside_weights \
-            .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-
-        bbox_inside_weights = bbox_inside_weights
-
-        # bbox_outside_weights
-        bbox_outside_weights = bbox_outside_weights \
-            .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-
-        bbox_outside_weights = bbox_outside_weights
-
-        #finished one batch, update data structs
-        if all_labels is None:
-            all_labels = labels
-            all_bbox_targets = bbox_targets
-            all_bbox_inside_weights = bbox_inside_weights
-            all_bbox_outside_weights = bbox_outside_weights
-        else:
-            all_labels = np.concatenate((all_labels,labels),0)
-            all_bbox_targets = np.concatenate((all_bbox_targets,
-                                                  bbox_targets), 0)
-            all_bbox_inside_weights = np.concatenate((all_bbox_inside_weights,
-                                                          bbox_inside_weights),0)
-            all_bbox_outside_weights = np.concatenate((all_bbox_outside_weights,
-                                                           bbox_outside_weights),0)
+    inds_inside, anchors = get_inside_anchors(height, width, _feat_stride,
+                                              anchor_scales,
+                                              img_info[0], img_info[1],
+                                              _allowed_border)
+
+    gt_boxes = np.asarray(gt_boxes, dtype=np.float64).reshape(batch_size, -1)
+    #if target is not present (dummy bg gt box) all boxes are bg (0)
+    has_gt = gt_boxes[:, -1] != 0
+
+    # overlaps between the anchors and each item's gt box, BxN
+    overlaps = _gt_overlaps(anchors, gt_boxes[:, :4])
+
+    # label: 1 is positive, 0 is negative, -1 is dont care
+    labels = np.empty(overlaps.shape, dtype=np.float32)
+    labels.fill(-1)
+    is_bg = overlaps < cfg.PROPOSAL_NEGATIVE_OVERLAP
+    # fg label: anchors with highest overlap, or above threshold IOU
+    is_fg = ((overlaps == overlaps.max(axis=1, keepdims=True)) |
+             (overlaps >= cfg.PROPOSAL_POSITIVE_OVERLAP))
+    if cfg.PROPOSAL_CLOBBER_POSITIVES:
+        # negative labels clobber positives
+        is_fg &= ~is_bg
+    else:
+        # positive labels clobber negatives
+        is_bg &= ~is_fg
+    labels[is_bg] = 0
+    labels[is_fg] = 1
+    labels[~has_gt] = 0
+
+    # subsample positive labels if we have too many
+    num_fg = int(cfg.PROPOSAL_FG_FRACTION * cfg.PROPOSAL_BATCH_SIZE)
+    _subsample_labels(labels, 1, np.full(batch_size, num_fg, dtype=np.int64))
+
+    # subsample negative labels if we have too many
+    num_bg = cfg.PROPOSAL_BATCH_SIZE - np.sum(labels == 1, axis=1)
+    _subsample_labels(labels, 0, num_bg)
+
+    #if the gt_box is a dummy bg, there are no bbox_targets
+    bbox_targets = _compute_targets(anchors, gt_boxes[:, :4])
+    bbox_targets[~has_gt] = 0
+
+    # map up to original set of anchors, straight into the output layout.
+    # anchors are ordered (h, w, a), outputs are (a, h, w)
+    num_cells = height * width
+    out_inds = (inds_inside % A) * num_cells + inds_inside // A
+
+    # labels, Bx(A*H)xWx1
+    all_labels = np.empty((batch_size, A * num_cells), dtype=np.float32)
+    all_labels.fill(-1)
+    all_labels[:, out_inds] = labels
+
+    # bbox_targets, Bx(A*4)xHxW, box params are ordered (a, k, h, w)
+    out_inds = ((out_inds + (out_inds // num_cells) * 3 * num_cells)[:, None] +
+                np.arange(4) * num_cells).ravel()
+    all_bbox_targets = np.zeros((batch_size, A * 4 * num_cells),
+                                dtype=np.float32)
+    all_bbox_targets[:, out_inds] = bbox_targets.reshape((batch_size, -1))
+    all_bbox_targets = all_bbox_targets.reshape((batch_size, A * 4,
+                                                 height, width))
+
+    # weights only depend on the labels, so build them in the output layout
+    is_pos = all_labels.reshape((batch_size, A, 1, num_cells)) == 1
+    is_neg = all_labels.reshape((batch_size, A, 1, num_cells)) == 0
+    weights_shape = (batch_size, A * 4, height, width)
+
+    inside_weights = np.array(cfg.PROPOSAL_BBOX_INSIDE_WEIGHTS,
+                              dtype=np.float32).reshape((1, 1, 4, 1))
+    all_bbox_inside_weights = (is_pos * inside_weights).reshape(weights_shape)
+
+    if cfg.PROPOSAL_POSITIVE_WEIGHT < 0:
+        # uniform weighting of examples (given non-uniform sampling)
+        positive_weights = np.ones(batch_size)
+        negative_weights = np.zeros(batch_size)
+    else:
+        assert ((cfg.PROPOSAL_POSITIVE_WEIGHT > 0) &
+                (cfg.PROPOSAL_POSITIVE_WEIGHT < 1))
+        # only used where there is at least one label of the kind
+        positive_weights = (cfg.PROPOSAL_POSITIVE_WEIGHT /
+                            np.maximum(np.sum(labels == 1, axis=1), 1) + 1)
+        negative_weights = ((1.0 - cfg.PROPOSAL_POSITIVE_WEIGHT) /
+                            np.maximum(np.sum(labels == 0, axis=1), 1) + 1)
+    positive_weights = positive_weights.astype(np.float32).reshape((-1, 1, 1, 1))
+    negative_weights = negative_weights.astype(np.float32).reshape((-1, 1, 1, 1))
+    all_bbox_outside_weights = np.broadcast_to(
+                            is_pos * positive_weights + is_neg * negative_weights,
+                            (batch_size, A, 4, num_cells)).reshape(weights_shape)
+
+    all_labels = all_labels.reshape((batch_size, A * height, width, 1))
 
     return all_labels, all_bbox_targets, all_bbox_inside_weights, all_bbox_outside_weights
 
 
-def _unmap(data, count, inds, fill=0):
-    """ Unmap a subset of item (data) back to the original set of items (of
-    size count) """
-    if len(data.shape) == 1:
-        ret = np.empty((count,), dtype=np.float32)
-        ret.fill(fill)
-        ret[inds] = data
-    else:
-        ret = np.empty((count,) + data.shape[1:], dtype=np.float32)
-        ret.fill(fill)
-        ret[inds, :] = data
-    return ret
+def _gt_overlaps(anchors, gt_boxes):
+    '''
+    IoU of Nx4 anchors with one gt box per batch item, same as cython
+    bbox_overlaps
 
+    Input parameters:
+        anchors: (ndarray) Nx4 boxes
+        gt_boxes: (ndarray) Bx4 boxes
 
-def _compute_targets(ex_rois, gt_rois):
-    """Compute bounding-box regression targets for an image."""
+    Returns:
+        (ndarray) BxN float64 overlaps
+    '''
+    anchors = anchors.astype(np.float64)
+    gt_boxes = gt_boxes[:, None, :]
+    iw = (np.minimum(anchors[:, 2], gt_boxes[:, :, 2]) -
+          np.maximum(anchors[:, 0], gt_boxes[:, :, 0]) + 1).clip(min=0)
+    ih = (np.minimum(anchors[:, 3], gt_boxes[:, :, 3]) -
+          np.maximum(anchors[:, 1], gt_boxes[:, :, 1]) + 1).clip(min=0)
+    inter = iw * ih
+    anchor_areas = ((anchors[:, 2] - anchors[:, 0] + 1) *
+                    (anchors[:, 3] - anchors[:, 1] + 1))
+    gt_areas = ((gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1) *
+                (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1))
+    return inter / (anchor_areas + gt_areas - inter)
+
+
+def _subsample_labels(labels, label, max_per_row):
+    '''
+    Randomly sets labels equal to label to -1 so each row keeps at most
+    max_per_row of them, in place
+
+    The kept entries are a uniform random subset, found by partially
+    ordering random keys instead of shuffling all the candidates.
 
-    assert ex_rois.shape[0] == gt_rois.shape[0]
-    assert ex_rois.shape[1] == 4
-    assert gt_rois.shape[1] == 5
+    Input parameters:
+        labels: (ndarray) BxN labels
+        label: (int) the label to subsample
+        max_per_row: (ndarray of int) max number of label to keep in each row
+    '''
+    is_label = labels == label
+    counts = is_label.sum(axis=1)
+    for row in np.where(counts > max_per_row)[0]:
+        num_keep = max(0, int(max_per_row[row]))
+        # non candidates get keys above all candidates
+        keys = npr.random_sample(labels.shape[1])
+        keys[~is_label[row]] = 2
+        keep_inds = np.argpartition(keys, num_keep)[:num_keep]
+        labels[row, is_label[row]] = -1
+        labels[row, keep_inds] = label
 
-    return bbox_transform(ex_rois, gt_rois[:, :4]).astype(np.float32, copy=False)
+
+def _compute_targets(ex_rois, gt_rois):
+    """Compute bounding-box regression targets for every anchor and each
+    batch item's gt box, BxNx4."""
+    ex_rois = ex_rois.astype(np.float64)
+    ex_widths = ex_rois[:, 2] - ex_rois[:, 0] + 1.0
+    ex_heights = ex_rois[:, 3] - ex_rois[:, 1] + 1.0
+    ex_ctr_x = ex_rois[:, 0] + 0.5 * ex_widths
+    ex_ctr_y = ex_rois[:, 1] + 0.5 * ex_heights
+
+    gt_widths = (gt_rois[:, 2] - gt_rois[:, 0] + 1.0)[:, None]
+    gt_heights = (gt_rois[:, 3] - gt_rois[:, 1] + 1.0)[:, None]
+    gt_ctr_x = gt_rois[:, 0:1] + 0.5 * gt_widths
+    gt_ctr_y = gt_rois[:, 1:2] + 0.5 * gt_heights
+
+    targets = np.empty((gt_rois.shape[0], ex_rois.shape[0], 4),
+                       dtype=np.float32)
+    targets[:, :, 0] = (gt_ctr_x - ex_ctr_x) / ex_widths
+    targets[:, :, 1] = (gt_ctr_y - ex_ctr_y) / ex_heights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #dummy bg gt boxes can be degenerate, their targets are zeroed
+        targets[:, :, 2] = np.log(gt_widths / ex_widths)
+        targets[:, :, 3] = np.log(gt_heights / ex_heights)
+    return targets
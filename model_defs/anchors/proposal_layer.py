@@ -9,7 +9,7 @@
 import numpy as np
 import yaml
 
-from .generate_anchors import generate_anchors
+from .anchor_grid import get_anchor_grid
 from .bbox_transform import bbox_transform_inv, clip_boxes
 from ..nms.nms_wrapper import nms
 from .cython_bbox import bbox_overlaps, bbox_intersections
@@ -69,8 +69,7 @@ def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride=16
     ''' 
 
     batch_size = class_prob_reshape.shape[0]
-    _anchors = generate_anchors(scales=np.array(anchor_scales))
-    _num_anchors = _anchors.shape[0]
+    _num_anchors = 3 * len(anchor_scales)
 
     # the first set of _num_anchors channels are bg probs
     # the second set are the fg probs, which we want
@@ -80,25 +79,10 @@ def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride=16
     # 1. Generate proposals from bbox deltas and shifted anchors
     height, width = scores.shape[-2:]
 
-    # Enumerate all shifts
-    shift_x = np.arange(0, width) * _feat_stride
-    shift_y = np.arange(0, height) * _feat_stride
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                        shift_x.ravel(), shift_y.ravel())).transpose()
-
-    # Enumerate all shifted anchors:
-    #
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
-    A = _num_anchors
-    K = shifts.shape[0]
-    anchors = _anchors.reshape((1, A, 4)) + \
-              shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-    anchors = anchors.reshape((K * A, 4))
-    anchors = np.tile(anchors, (batch_size,1,1))
+    # (K*A, 4) shifted anchors, shared with anchor_target_layer. They are
+    # float32 but exact, and bbox_transform_inv decodes in the dtype of the
+    # deltas, so proposals are the same as with float64 anchors
+    anchors = get_anchor_grid(height, width, _feat_stride, anchor_scales)
 
     # Transpose and reshape predicted bbox transformations to get them
     # into the same order as the anchors:
@@ -116,140 +100,114 @@ def proposal_layer(class_prob_reshape, bbox_pred, img_info, cfg, _feat_stride=16
     # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
     scores = scores.transpose((0, 2, 3, 1)).reshape((batch_size,-1))
 
-    # Convert anchors into proposals via bbox transformations
-    proposals = bbox_transform_inv(anchors, bbox_deltas)
-
-    # 2. clip predicted boxes to image
-    proposals = clip_boxes(proposals, img_info[:2])
-
-    # 3. remove predicted boxes with either height or width < threshold
-    # (NOTE: convert min_size to input image scale stored in img_info[2])
-    lose = _filter_boxes(proposals, cfg.PROPOSAL_MIN_BOX_SIZE * img_info[2])
-    proposals[lose[0],lose[1],:] = 0
-    scores[lose[0],lose[1]] = 0
-
-    # 4. sort all (proposal, score) pairs by score from highest to lowest
-    # 5. take top cfg.PRE_NMS_TOP_N (e.g. 6000)
-    order = scores.argsort(1)[:,::-1]
-    anchor_inds = np.tile(np.arange(order.shape[1]),(batch_size,1))
+    # 2.-5. decode, clip and filter only the highest scoring anchors,
+    # then take the top cfg.PRE_NMS_TOP_N (e.g. 6000) of those
+    num_anchors = scores.shape[1]
+    num_pre_nms = num_anchors
     if cfg.PRE_NMS_TOP_N > 0:
-        order = order[:,:cfg.PRE_NMS_TOP_N]
-    b_select = np.arange(batch_size)
-    proposals = np.take(proposals,order,axis=1)[b_select,b_select,:,:]
-    scores = np.take(scores,order,axis=1)[b_select,b_select,:]
-    anchor_inds = np.take(anchor_inds,order,axis=1)[b_select,b_select,:]
-
-    all_proposals = None
-    all_scores = None
-    all_anchor_inds = None
-    all_labels = None
+        num_pre_nms = min(cfg.PRE_NMS_TOP_N, num_anchors)
+    b_select = np.arange(batch_size)[:, np.newaxis]
+    num_candidates = num_pre_nms
+    while True:
+        if num_candidates < num_anchors:
+            order = np.argpartition(-scores, num_candidates-1,
+                                    axis=1)[:, :num_candidates]
+        else:
+            order = np.tile(np.arange(num_anchors), (batch_size,1))
+        proposals = bbox_transform_inv(anchors[order, :],
+                                       bbox_deltas[b_select, order, :])
+        proposals = clip_boxes(proposals, img_info[:2])
+        # (NOTE: convert min_size to input image scale stored in img_info[2])
+        lose = _filter_boxes(proposals, cfg.PROPOSAL_MIN_BOX_SIZE * img_info[2])
+
+        # boxes that are removed get a score of 0. If that leaves fewer than
+        # num_pre_nms boxes, lower scoring anchors may make the top, so
+        # decode more of them
+        if (num_candidates == num_anchors or 
+                (num_candidates - lose.sum(1)).min() >= num_pre_nms):
+            break
+        num_candidates = min(2*num_candidates, num_anchors)
+
+    candidate_scores = scores[b_select, order]
+    candidate_scores[lose] = 0
+    proposals[lose] = 0
 
+    # 4. sort all (proposal, score) pairs by score from highest to lowest
+    sort_inds = np.argsort(-candidate_scores, axis=1)[:, :num_pre_nms]
+    proposals = proposals[b_select, sort_inds, :]
+    scores = candidate_scores[b_select, sort_inds]
+    anchor_inds = order[b_select, sort_inds] + b_select*num_anchors
+
+    # 6. apply nms (e.g. threshold = 0.7)
+    # 7. take after_nms_topN (e.g. 300)
+    all_keep = []
     for batch_ind in range(batch_size):
-
-        b_proposals = proposals[batch_ind,:,:]
-        b_scores = np.expand_dims(scores[batch_ind,:], 1)
-        b_anchor_inds = (np.expand_dims(anchor_inds[batch_ind,:],1) + 
-                         batch_ind*anchors.shape[1])
-
-        # 6. apply nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
-        # 8. return the top proposals (-> RoIs top)
-        keep = nms(np.hstack((b_proposals, b_scores)), cfg.NMS_THRESH)
+        keep = nms(np.hstack((proposals[batch_ind],
+                              scores[batch_ind][:, np.newaxis])),
+                   cfg.NMS_THRESH, backend=cfg.NMS_BACKEND)
         if cfg.POST_NMS_TOP_N > 0:
             keep = keep[:cfg.POST_NMS_TOP_N]
-
-        b_proposals = b_proposals[keep, :]
-        b_scores = b_scores[keep]
-        b_anchor_inds = b_anchor_inds[keep]
-
-        assert(b_anchor_inds.shape[0] == b_scores.shape[0])
-
-        if b_proposals.shape[0] == 0:
-            b_proposals = np.zeros((1,4))
-            b_scores = np.zeros((1,1))
-            b_anchor_inds = np.zeros(1)
+        all_keep.append(keep)
+
+    # 8. return the top proposals (-> RoIs top), zero padded to the 
+    # same number of proposals for each batch
+    num_keep = max([1] + [len(keep) for keep in all_keep])
+    all_proposals = np.zeros((batch_size, num_keep, 4), dtype=np.float32)
+    all_scores = np.zeros((batch_size, num_keep, 1), dtype=np.float32)
+    all_anchor_inds = np.zeros((batch_size, num_keep, 1), dtype=np.int64)
+    all_labels = np.zeros((batch_size, num_keep), dtype=np.int64)
+
+    for batch_ind, keep in enumerate(all_keep):
+        b_num_keep = max(1, len(keep))
+        all_proposals[batch_ind, :len(keep)] = proposals[batch_ind, keep]
+        all_scores[batch_ind, :len(keep), 0] = scores[batch_ind, keep]
+        all_anchor_inds[batch_ind, :len(keep), 0] = anchor_inds[batch_ind, keep]
+        b_proposals = all_proposals[batch_ind, :b_num_keep]
 
         #match anchor inds with gt boxes
-        b_labels = -1*np.ones(b_anchor_inds.size)
-        if gt_boxes is not None:
-            b_labels.fill(0)
-             #get rid of background gt_boxes
-            gt_box = np.expand_dims(gt_boxes[batch_ind,:],axis=0)
-            if gt_box[0,-1] == 0:#this is a bg box
-                b_labels.fill(0)
-            else:
-                # overlaps between the anchors and the gt boxes
-                # overlaps (ex, gt), shape is A x G
-                overlaps = bbox_overlaps(
-                    np.ascontiguousarray(b_proposals, dtype=np.float),
-                    np.ascontiguousarray(gt_box, dtype=np.float))
-                argmax_overlaps = overlaps.argmax(axis=1)  # (A)
-                max_overlaps = overlaps[np.arange(len(b_anchor_inds)), argmax_overlaps]
-                gt_argmax_overlaps = overlaps.argmax(axis=0)  # G 
-                gt_max_overlaps = overlaps[gt_argmax_overlaps,
-                                           np.arange(overlaps.shape[1])]
-                gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
-
-                if not cfg.PROPOSAL_CLOBBER_POSITIVES:
-                    # assign bg labels first so that positive labels can clobber them
-                    #labels[max_overlaps < cfg.TRAIN.PROPOSAL_NEGATIVE_OVERLAP] = 0 
-                    b_labels[max_overlaps < .2] = 0 
-
-                # fg label: for each gt, anchor with highest overlap
-                b_labels[gt_argmax_overlaps] = 1 
-                # fg label: above threshold IOU
-                b_labels[max_overlaps >= .5] = 1 
-
-                if True:#cfg.TRAIN.PROPOSAL_CLOBBER_POSITIVES:
-                    # assign bg labels last so that negative labels can clobber positives
-                    b_labels[max_overlaps < .2] = 0 
-
-        #finshed with one batch, update data structs
-        if all_proposals is None:
-            all_proposals = np.expand_dims(b_proposals, axis=0)
-            all_scores = np.expand_dims(b_scores, axis=0)
-            all_anchor_inds = np.expand_dims(b_anchor_inds, axis=0)
-            all_labels = np.expand_dims(b_labels, axis=0)
-        else:
-            all_proposals = _append_and_pad(all_proposals,b_proposals)
-            all_scores = _append_and_pad(all_scores,b_scores)
-            all_anchor_inds = _append_and_pad(all_anchor_inds,b_anchor_inds)
-            all_labels = _append_and_pad(all_labels,b_labels)
+        b_labels = all_labels[batch_ind, :b_num_keep]
+        if gt_boxes is None:
+            b_labels.fill(-1)
+            continue
+        #get rid of background gt_boxes
+        gt_box = np.expand_dims(gt_boxes[batch_ind,:],axis=0)
+        if gt_box[0,-1] == 0:#this is a bg box
+            continue
+
+        # overlaps between the anchors and the gt boxes
+        # overlaps (ex, gt), shape is A x G
+        overlaps = bbox_overlaps(
+            np.ascontiguousarray(b_proposals, dtype=np.float64),
+            np.ascontiguousarray(gt_box, dtype=np.float64))
+        argmax_overlaps = overlaps.argmax(axis=1)  # (A)
+        max_overlaps = overlaps[np.arange(b_num_keep), argmax_overlaps]
+        gt_argmax_overlaps = overlaps.argmax(axis=0)  # G 
+        gt_max_overlaps = overlaps[gt_argmax_overlaps,
+                                   np.arange(overlaps.shape[1])]
+        gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
+
+        if not cfg.PROPOSAL_CLOBBER_POSITIVES:
+            # assign bg labels first so that positive labels can clobber them
+            #labels[max_overlaps < cfg.TRAIN.PROPOSAL_NEGATIVE_OVERLAP] = 0 
+            b_labels[max_overlaps < .2] = 0 
+
+        # fg label: for each gt, anchor with highest overlap
+        b_labels[gt_argmax_overlaps] = 1 
+        # fg label: above threshold IOU
+        b_labels[max_overlaps >= .5] = 1 
+
+        if True:#cfg.TRAIN.PROPOSAL_CLOBBER_POSITIVES:
+            # assign bg labels last so that negative labels can clobber positives
+            b_labels[max_overlaps < .2] = 0 
 
     return all_proposals, all_scores,all_anchor_inds,all_labels 
 
 
-def _append_and_pad(all_batches, single_batch):
-    """ appends a1 to a2 at axis 0, padding the shorter of a1,a2"""
-    if all_batches.shape[1] < single_batch.shape[0]:
-        num_to_add = single_batch.shape[0] - all_batches.shape[1]
-        all_batches = _pad_to_match(all_batches, num_to_add, axis=1)
-    elif all_batches.shape[1] > single_batch.shape[0]:
-        num_to_add = all_batches.shape[1] - single_batch.shape[0]
-        single_batch = _pad_to_match(single_batch,num_to_add, axis=0)
-    single_batch = np.expand_dims(single_batch,0)
-
-    return np.concatenate((all_batches,single_batch))
-
-
-def _pad_to_match(to_pad, num_to_add, axis=0):
-        pad_dims = []
-        for dim, dim_size in enumerate(to_pad.shape):
-            if (dim==axis):
-                pad_dims.append(num_to_add)
-            else: 
-                pad_dims.append(dim_size)
-        padding = np.zeros(pad_dims)
-        return np.concatenate((to_pad,padding),axis=axis)
-    
-
-
 def _filter_boxes(boxes, min_size):
-    """Remove all boxes with any side smaller than min_size."""
+    """Mask of all boxes with any side smaller than min_size."""
     ws = boxes[:,:, 2] - boxes[:,:, 0] + 1
     hs = boxes[:,:, 3] - boxes[:,:, 1] + 1
-    lose = np.where((ws < min_size) & (hs < min_size))
-    return lose 
+    return (ws < min_size) & (hs < min_size)
 
 
 
@@ -0,0 +1,180 @@
+import numpy as np
+import torch
+
+from .anchor_grid import get_anchor_grid_tensor
+from ..nms.torch_nms import torch_nms
+
+
+def proposal_layer(class_score, bbox_pred, img_info, cfg, _feat_stride=16,
+                   anchor_scales=[2, 4, 8], gt_boxes=None):
+    '''
+    Outputs object detection proposals, staying in torch the whole time
+
+    Same algorithm and outputs as proposal_layer.proposal_layer, but all
+    work is done on the device of the network outputs, so nothing is copied
+    to the host and back. Foreground probabilities are computed straight
+    from the score logits, a softmax over a (bg,fg) pair is a sigmoid of
+    their difference.
+
+    fg = foreground (the target object)
+    bg = background (not the target)
+
+    Input parameters:
+
+        class_score: (torch.autograd.variable.Variable) Bx(2*A)xHxW score
+                     logits, first A channels are bg, next A are fg
+        bbox_pred:  (torch.autograd.variable.Variable) Bx(4*A)xHxW
+        img_info:  (tuple of int)
+        cfg: (Config)
+
+        _feat_stride(optional): (int) scaling factor between input feature
+                                map (class_score) and original image.
+                                Default: 16
+        anchor_scales (optional):  (list of int) scale for size of anchor boxes
+                                   Default: [2,4,8]
+        gt_boxes (optional): (ndarray) If not None, return value all_labels
+                             will have fg/bg label of each anchor box. If None
+                             all_labels will be meaningless. Default: None
+
+    Returns:
+        all_proposals: (torch.FloatTensor) BxNx4 the proposed bounding boxes
+        all_scores: (torch.FloatTensor) BxNx1 the fg score for each box
+        all_anchor_inds: (torch.LongTensor) BxNx1 The index of the anchor box
+                         that corresponds to the proposed bounding box
+        all_labels: (torch.LongTensor) BxN ground truth fg/bg label for
+                    each proposed bounding box.
+    '''
+    class_score = class_score.data
+    bbox_pred = bbox_pred.data
+    batch_size, _, height, width = class_score.size()
+
+    A = 3 * len(anchor_scales)
+
+    # the first set of A channels are bg logits, the second set are fg
+    scores = torch.sigmoid(class_score[:, A:] - class_score[:, :A])
+
+    # 1. Generate proposals from bbox deltas and shifted anchors
+    # (K*A, 4) shifted anchors, shared with the other anchor layers
+    anchors = get_anchor_grid_tensor(height, width, _feat_stride,
+                                     anchor_scales, class_score)
+
+    # rows ordered by (h, w, a), same as the anchors
+    bbox_deltas = bbox_pred.permute(0, 2, 3, 1).contiguous().view(
+                                                           batch_size, -1, 4)
+    scores = scores.permute(0, 2, 3, 1).contiguous().view(batch_size, -1)
+
+    proposals = bbox_transform_inv(anchors, bbox_deltas)
+
+    # 2. clip predicted boxes to image
+    proposals = clip_boxes(proposals, img_info[:2])
+
+    # 3. remove predicted boxes with either height or width < threshold
+    # (NOTE: convert min_size to input image scale stored in img_info[2])
+    lose = _filter_boxes(proposals, cfg.PROPOSAL_MIN_BOX_SIZE * img_info[2])
+    proposals.masked_fill_(lose.unsqueeze(2).expand_as(proposals), 0)
+    scores.masked_fill_(lose, 0)
+
+    # 4. sort all (proposal, score) pairs by score from highest to lowest
+    # 5. take top cfg.PRE_NMS_TOP_N (e.g. 6000)
+    num_pre_nms = scores.size(1)
+    if cfg.PRE_NMS_TOP_N > 0:
+        num_pre_nms = min(cfg.PRE_NMS_TOP_N, num_pre_nms)
+    scores, order = torch.topk(scores, num_pre_nms, dim=1)
+    proposals = torch.gather(proposals, 1,
+                      order.unsqueeze(2).expand(batch_size, num_pre_nms, 4))
+
+    # 6. apply nms (e.g. threshold = 0.7)
+    # 7. take after_nms_topN (e.g. 300)
+    all_keep = []
+    for batch_ind in range(batch_size):
+        keep = torch_nms(torch.cat((proposals[batch_ind],
+                                    scores[batch_ind].unsqueeze(1)), 1),
+                         cfg.NMS_THRESH)
+        if cfg.POST_NMS_TOP_N > 0:
+            keep = keep[:cfg.POST_NMS_TOP_N]
+        all_keep.append(keep)
+
+    # 8. return the top proposals, zero padded to the same number per batch
+    num_keep = max([1] + [keep.numel() for keep in all_keep])
+    all_proposals = proposals.new(batch_size, num_keep, 4).zero_()
+    all_scores = scores.new(batch_size, num_keep, 1).zero_()
+    all_anchor_inds = order.new(batch_size, num_keep, 1).zero_()
+    all_labels = order.new(batch_size, num_keep).zero_()
+
+    if gt_boxes is not None:
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float32)
+        all_gt_boxes = torch.from_numpy(gt_boxes).type_as(proposals)
+
+    for batch_ind, keep in enumerate(all_keep):
+        b_num_keep = max(1, keep.numel())
+        if keep.numel() > 0:
+            all_proposals[batch_ind, :keep.numel()] = proposals[batch_ind][keep]
+            all_scores[batch_ind, :keep.numel(), 0] = scores[batch_ind][keep]
+            all_anchor_inds[batch_ind, :keep.numel(), 0] = (
+                        order[batch_ind][keep] + batch_ind * anchors.size(0))
+
+        #match anchor inds with gt boxes
+        b_labels = all_labels[batch_ind, :b_num_keep]
+        if gt_boxes is None:
+            b_labels.fill_(-1)
+        elif gt_boxes[batch_ind, -1] != 0:#this is not a bg box
+            overlaps = _gt_overlaps(all_proposals[batch_ind, :b_num_keep],
+                                    all_gt_boxes[batch_ind, :4])
+            is_fg = (overlaps == overlaps.max()) | (overlaps >= .5)
+            is_fg = is_fg & (overlaps >= .2)
+            b_labels.copy_(is_fg.long())
+
+    return all_proposals, all_scores, all_anchor_inds, all_labels
+
+
+def bbox_transform_inv(anchors, deltas):
+    '''
+    Applies Bx(K*A)x4 bbox deltas to (K*A)x4 anchors, see bbox_transform.py
+    '''
+    widths = anchors[:, 2] - anchors[:, 0] + 1.0
+    heights = anchors[:, 3] - anchors[:, 1] + 1.0
+    ctr_x = anchors[:, 0] + 0.5 * widths
+    ctr_y = anchors[:, 1] + 0.5 * heights
+
+    pred_ctr_x = deltas[:, :, 0] * widths + ctr_x
+    pred_ctr_y = deltas[:, :, 1] * heights + ctr_y
+    pred_w = torch.exp(deltas[:, :, 2]) * widths
+    pred_h = torch.exp(deltas[:, :, 3]) * heights
+
+    return torch.stack((pred_ctr_x - 0.5 * pred_w,
+                        pred_ctr_y - 0.5 * pred_h,
+                        pred_ctr_x + 0.5 * pred_w,
+                        pred_ctr_y + 0.5 * pred_h), 2)
+
+
+def clip_boxes(boxes, im_shape):
+    '''
+    Clip BxNx4 boxes to image boundaries, in place.
+    '''
+    boxes[:, :, 0::2].clamp_(0, im_shape[1] - 1)
+    boxes[:, :, 1::2].clamp_(0, im_shape[0] - 1)
+    return boxes
+
+
+def _filter_boxes(boxes, min_size):
+    """Mask of all boxes with any side smaller than min_size."""
+    ws = boxes[:, :, 2] - boxes[:, :, 0] + 1
+    hs = boxes[:, :, 3] - boxes[:, :, 1] + 1
+    return (ws < min_size) & (hs < min_size)
+
+
+def _gt_overlaps(boxes, gt_box):
+    '''
+    IoU of Nx4 boxes with a single gt box, same as cython bbox_overlaps
+    '''
+    boxes = boxes.double()
+    gt_box = gt_box.double()
+    iw = (torch.min(boxes[:, 2], gt_box[2:3]) -
+          torch.max(boxes[:, 0], gt_box[0:1]) + 1).clamp(min=0)
+    ih = (torch.min(boxes[:, 3], gt_box[3:4]) -
+          torch.max(boxes[:, 1], gt_box[1:2]) + 1).clamp(min=0)
+    inter = iw * ih
+    box_areas = ((boxes[:, 2] - boxes[:, 0] + 1) *
+                 (boxes[:, 3] - boxes[:, 1] + 1))
+    gt_area = (gt_box[2] - gt_box[0] + 1) * (gt_box[3] - gt_box[1] + 1)
+    return inter / (box_areas + gt_area - inter)
@@ -0,0 +1,72 @@
+import math
+import torch
+
+
+class FeatureMapSize(object):
+    '''
+    Computes the output size of a feature extraction network for an input
+    size, without running the network.
+
+    Only the kernel size, stride, padding and dilation of every conv and
+    pooling layer are kept, so instances are small and can be handed to
+    DataLoader workers. Branches that only exist to match sizes (the
+    downsample branch of ResNet blocks) are skipped, parallel branches that
+    keep the size (SqueezeNet Fire modules) are harmless.
+
+    ex) size = FeatureMapSize(net.features)
+        height, width = size(img_height, img_width)
+
+    Input parameters:
+        features: (torch.nn.Module) the feature extraction network
+    '''
+
+    def __init__(self, features):
+        self.layers = []
+        self._add_layers(features)
+
+    def __call__(self, height, width):
+        '''
+        Returns the (height, width) of the feature map for an input image
+        '''
+        for kernel, stride, padding, dilation, ceil_mode in self.layers:
+            height = _output_size(height, kernel[0], stride[0], padding[0],
+                                  dilation[0], ceil_mode)
+            width = _output_size(width, kernel[1], stride[1], padding[1],
+                                 dilation[1], ceil_mode)
+        return height, width
+
+    def _add_layers(self, module):
+        if isinstance(module, (torch.nn.Conv2d, torch.nn.MaxPool2d,
+                               torch.nn.AvgPool2d)):
+            stride = module.stride
+            if stride is None:
+                stride = module.kernel_size
+            dilation = getattr(module, 'dilation', 1)
+            self.layers.append((_pair(module.kernel_size), _pair(stride),
+                                _pair(module.padding), _pair(dilation),
+                                getattr(module, 'ceil_mode', False)))
+            return
+        for name, child in module.named_children():
+            if name == 'downsample':
+                continue
+            self._add_layers(child)
+
+
+def _pair(value):
+    if isinstance(value, (tuple, list)):
+        return tuple(value)
+    return (value, value)
+
+
+def _output_size(size, kernel, stride, padding, dilation, ceil_mode):
+    '''
+    Output size of a conv/pool layer along one dimension, same as pytorch
+    '''
+    span = size + 2 * padding - dilation * (kernel - 1) - 1
+    if not ceil_mode:
+        return span // stride + 1
+    out = int(math.ceil(float(span) / stride)) + 1
+    # the last window has to start inside the image or left padding
+    if (out - 1) * stride >= size + padding:
+        out -= 1
+    return out
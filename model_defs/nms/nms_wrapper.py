@@ -5,18 +5,208 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
-#from faster_rcnn.nms.cpu_nms import cpu_nms
-#from faster_rcnn.nms.gpu_nms import gpu_nms
-from .cpu_nms import cpu_nms
-from .gpu_nms import gpu_nms
+import time
+import numpy as np
+import torch
 
+from .py_cpu_nms import py_cpu_nms
+from .numpy_nms import numpy_nms, numpy_nms_per_class
+from .torch_nms import torch_nms
+try:
+    from .cpu_nms import cpu_nms
+except ImportError:
+    cpu_nms = None
+try:
+    from .gpu_nms import gpu_nms
+except ImportError:
+    gpu_nms = None
 
-def nms(dets, thresh, force_cpu=False):
-    """Dispatch to either CPU or GPU NMS implementations."""
+#with fewer boxes than this, 'auto' keeps nms on the cpu. Copying a few
+#hundred boxes to the gpu costs more than the gpu saves
+GPU_NMS_MIN_BOXES = 1000
+
+#with more same class pairs of boxes than this, nms_per_class runs numpy
+#nms on each class instead of all classes at once, which is then faster
+NUMPY_PER_CLASS_MAX_PAIRS = 500000
+
+#name -> function(dets, thresh) returning indices of kept boxes
+NMS_BACKENDS = {}
+
+#name -> [number of calls, number of boxes, seconds]
+_nms_timings = {}
+
+
+def register_nms_backend(name, nms_fn):
+    '''
+    Makes an nms implementation available to nms()
+
+    Input parameters:
+        name: (str) name used to pick the backend, i.e. in cfg.NMS_BACKEND
+        nms_fn: (function) takes Nx5 float32 dets (x1,y1,x2,y2,score) and an
+                overlap threshold, returns indices of kept boxes with the
+                highest score first
+    '''
+    NMS_BACKENDS[name] = nms_fn
+
+
+def _torch_gpu_nms(dets, thresh):
+    dets = torch.from_numpy(dets)
+    if torch.cuda.is_available():
+        dets = dets.cuda()
+    return torch_nms(dets, thresh).cpu().numpy()
+
+
+def _gpu_nms(dets, thresh):
+    return gpu_nms(dets, thresh, device_id=0)
+
+
+register_nms_backend('python', py_cpu_nms)
+register_nms_backend('numpy', numpy_nms)
+register_nms_backend('torch', _torch_gpu_nms)
+if cpu_nms is not None:
+    #unlike the others, cpu_nms also supresses boxes with an overlap equal
+    #to the threshold, so 'auto' never picks it
+    register_nms_backend('cpu', cpu_nms)
+if gpu_nms is not None:
+    register_nms_backend('gpu', _gpu_nms)
+
+
+def choose_nms_backend(num_boxes, force_cpu=False):
+    '''
+    Picks the backend 'auto' uses for a number of boxes
+
+    Large sets of boxes go to the gpu if there is one, everything else
+    stays on the cpu with numpy_nms. All of these keep a box whose overlap
+    equals the threshold, so results do not depend on the number of boxes.
+    '''
+    if (not force_cpu and num_boxes >= GPU_NMS_MIN_BOXES and
+            torch.cuda.is_available()):
+        return 'gpu' if 'gpu' in NMS_BACKENDS else 'torch'
+    return 'numpy'
+
+
+def nms(dets, thresh, force_cpu=False, backend='auto'):
+    """Dispatch to one of the NMS_BACKENDS, and time it.
+
+    backend is a name from NMS_BACKENDS ('cpu', 'gpu', 'numpy', 'torch',
+    'python'), or 'auto' to pick one from the number of boxes and whether
+    a gpu is available.
+    """
 
     if dets.shape[0] == 0:
         return []
-    if True: #cfg.USE_GPU_NMS and not force_cpu:
-        return gpu_nms(dets, thresh, device_id=0)
+    if backend == 'auto':
+        backend = choose_nms_backend(dets.shape[0], force_cpu=force_cpu)
+    elif backend not in NMS_BACKENDS:
+        raise ValueError('Unknown nms backend {}, available: {}'.format(
+                                       backend, sorted(NMS_BACKENDS.keys())))
+
+    tic = time.time()
+    keep = NMS_BACKENDS[backend](dets, thresh)
+    _add_timing(backend, dets.shape[0], time.time() - tic)
+    return keep
+
+
+def _add_timing(backend, num_boxes, seconds):
+    timing = _nms_timings.setdefault(backend, [0, 0, 0.0])
+    timing[0] += 1
+    timing[1] += num_boxes
+    timing[2] += seconds
+
+
+def get_nms_timings():
+    '''
+    Returns per backend nms timings since the last reset
+
+    Returns:
+        (dict) key=backend name, value=dict with number of 'calls',
+               average number of 'boxes' per call and average 'ms' per call
+    '''
+    timings = {}
+    for backend, (calls, boxes, seconds) in _nms_timings.items():
+        timings[backend] = {'calls': calls,
+                            'boxes': float(boxes) / calls,
+                            'ms': 1000.0 * seconds / calls}
+    return timings
+
+
+def print_nms_timings():
+    for backend, timing in sorted(get_nms_timings().items()):
+        print('nms {}: {:d} calls, {:.0f} boxes/call, {:.3f}ms/call'.format(
+              backend, timing['calls'], timing['boxes'], timing['ms']))
+
+
+def reset_nms_timings():
+    _nms_timings.clear()
+
+
+def nms_per_class(dets, class_ids, thresh, max_per_class=0, backend='auto'):
+    '''
+    Class aware nms over the detections of many classes at once
+
+    On the gpu, boxes of each class are shifted to their own region of the
+    image plane, so boxes of different classes never overlap and a single
+    nms call handles all classes. With numpy on the cpu, numpy_nms_per_class
+    does all classes in one pass. With more than NUMPY_PER_CLASS_MAX_PAIRS
+    pairs of boxes of the same class, or other cpu backends, boxes are
+    sorted by class once and nms runs on each class segment. The
+    highest scoring max_per_class boxes of each class are then kept in one
+    vectorized pass, along with any ties of the last one.
+
+    Input parameters:
+        dets: (ndarray) Nx5 boxes, each row is x1,y1,x2,y2,score
+        class_ids: (ndarray) N class (target) ids, one for each box
+        thresh: (float) overlap threshold
+
+        max_per_class (optional): (int) max boxes to keep for each class, if
+                                  <= 0 all boxes that survive nms are kept.
+                                  Default: 0
+        backend (optional): (str) see nms(). Default: 'auto'
+
+    Returns:
+        (ndarray) indices of kept boxes, grouped by class in order of id,
+        highest score first within each class
+    '''
+    if dets.shape[0] == 0:
+        return np.zeros((0,), dtype=np.int64)
+    dets = dets.astype(np.float32, copy=False)
+    _, class_inds = np.unique(class_ids, return_inverse=True)
+    if backend == 'auto':
+        backend = choose_nms_backend(dets.shape[0])
+
+    if backend in ('gpu', 'torch') and torch.cuda.is_available():
+        boxes = dets[:, :4] - dets[:, :4].min()
+        offsets = class_inds * (boxes.max() + 1)
+        shifted_dets = np.hstack((boxes + offsets[:, np.newaxis],
+                                  dets[:, 4:5])).astype(np.float32)
+        keep = np.asarray(nms(shifted_dets, thresh, backend=backend),
+                          dtype=np.int64)
+        #nms gives boxes by score, a stable sort groups them by class
+        keep = keep[np.argsort(class_inds[keep], kind='mergesort')]
+    elif (backend == 'numpy' and
+            _num_class_pairs(class_inds) <= NUMPY_PER_CLASS_MAX_PAIRS):
+        tic = time.time()
+        keep = numpy_nms_per_class(dets, class_inds, thresh)
+        _add_timing(backend, dets.shape[0], time.time() - tic)
     else:
-        return cpu_nms(dets, thresh)
+        order = np.argsort(class_inds, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(class_inds[order])) + 1
+        keep = []
+        for segment in np.split(order, bounds):
+            seg_keep = nms(dets[segment], thresh, backend=backend)
+            keep.append(segment[np.asarray(seg_keep, dtype=np.int64)])
+        keep = np.concatenate(keep)
+
+    if max_per_class > 0:
+        kept_classes = class_inds[keep]
+        scores = dets[keep, 4]
+        class_starts = np.searchsorted(kept_classes, kept_classes)
+        class_ends = np.searchsorted(kept_classes, kept_classes, side='right')
+        last_ind = np.minimum(class_starts + max_per_class, class_ends) - 1
+        keep = keep[scores >= scores[last_ind]]
+    return keep
+
+
+def _num_class_pairs(class_inds):
+    class_sizes = np.bincount(class_inds).astype(np.int64)
+    return int((class_sizes * (class_sizes - 1) // 2).sum())
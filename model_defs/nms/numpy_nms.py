@@ -0,0 +1,107 @@
+import numpy as np
+
+#rows of the overlap matrix computed at once, bounds temporary memory
+_BLOCK_SIZE = 512
+
+
+def numpy_nms(dets, thresh):
+    '''
+    Non maximum supression with vectorized numpy.
+
+    Overlaps of all pairs of boxes are computed up front, a block of rows at
+    a time, into a boolean suppression matrix. The greedy pass then only
+    visits kept boxes. Boxes are in inclusive pixel coordinates, and a box
+    is supressed if its overlap with a higher scoring kept box is greater
+    than thresh, like in gpu_nms.
+
+    Input parameters:
+        dets: (ndarray) Nx5 boxes, each row is x1,y1,x2,y2,score
+        thresh: (float) overlap threshold
+
+    Returns:
+        (ndarray) indices of kept boxes, highest score first
+    '''
+    num_dets = dets.shape[0]
+    if num_dets == 0:
+        return np.zeros((0,), dtype=np.int64)
+    order = dets[:, 4].argsort()[::-1]
+    dets = dets[order].astype(np.float32, copy=False)
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    suppress = np.empty((num_dets, num_dets), dtype=np.bool_)
+    for start in range(0, num_dets, _BLOCK_SIZE):
+        rows = slice(start, start + _BLOCK_SIZE)
+        w = (np.minimum(x2[rows, None], x2) -
+             np.maximum(x1[rows, None], x1) + 1).clip(min=0)
+        h = (np.minimum(y2[rows, None], y2) -
+             np.maximum(y1[rows, None], y1) + 1).clip(min=0)
+        inter = w * h
+        suppress[rows] = inter / (areas[rows, None] + areas - inter) > thresh
+
+    # boxes are sorted, so each kept box can only supress later boxes. Only
+    # boxes that supress any are visited, the rest are kept if not removed
+    suppress = np.triu(suppress, 1)
+    removed = np.zeros((num_dets,), dtype=np.bool_)
+    for i in np.flatnonzero(suppress.any(1)):
+        if not removed[i]:
+            removed |= suppress[i]
+    return order[np.flatnonzero(~removed)]
+
+
+def numpy_nms_per_class(dets, class_ids, thresh):
+    '''
+    Non maximum supression of many classes in one pass with numpy.
+
+    Boxes are sorted by class and then score, and overlaps are computed at
+    once for every pair of boxes of the same class, so boxes of different
+    classes never supress each other. The greedy pass then only visits
+    boxes that supress others. Overlaps are the same as in numpy_nms.
+
+    Input parameters:
+        dets: (ndarray) Nx5 boxes, each row is x1,y1,x2,y2,score
+        class_ids: (ndarray) N class ids, one for each box
+        thresh: (float) overlap threshold
+
+    Returns:
+        (ndarray) indices of kept boxes, grouped by class in order of id,
+        highest score first within each class
+    '''
+    num_dets = dets.shape[0]
+    if num_dets == 0:
+        return np.zeros((0,), dtype=np.int64)
+    order = np.lexsort((-dets[:, 4], class_ids))
+    dets = dets[order].astype(np.float32, copy=False)
+    class_ids = np.asarray(class_ids)[order]
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    # pair each box with the later boxes of its class, ordered by first box
+    num_later = (np.searchsorted(class_ids, class_ids, side='right') -
+                 np.arange(num_dets) - 1)
+    first = np.repeat(np.arange(num_dets), num_later)
+    pair_starts = np.repeat(np.cumsum(num_later) - num_later, num_later)
+    second = first + 1 + np.arange(first.shape[0]) - pair_starts
+
+    w = (np.minimum(x2[first], x2[second]) -
+         np.maximum(x1[first], x1[second]) + 1).clip(min=0)
+    h = (np.minimum(y2[first], y2[second]) -
+         np.maximum(y1[first], y1[second]) + 1).clip(min=0)
+    inter = w * h
+    suppress = inter / (areas[first] + areas[second] - inter) > thresh
+    first = first[suppress]
+    second = second[suppress]
+
+    # the boxes each box supresses are next to each other
+    removed = np.zeros((num_dets,), dtype=np.bool_)
+    starts = np.flatnonzero(np.diff(first)) + 1
+    for boxes in np.split(np.stack((first, second)), starts, axis=1):
+        if boxes.shape[1] > 0 and not removed[boxes[0, 0]]:
+            removed[boxes[1]] = True
+    return order[np.flatnonzero(~removed)]
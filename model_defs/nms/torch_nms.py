@@ -0,0 +1,53 @@
+import torch
+
+try:
+    from torchvision.ops import nms as _torchvision_nms
+except ImportError:
+    _torchvision_nms = None
+
+
+def torch_nms(dets, thresh):
+    '''
+    Non maximum supression on torch tensors, on the device of dets.
+
+    Boxes are in inclusive pixel coordinates, so areas and intersections get
+    a +1 like in cpu_nms and gpu_nms. A box is supressed if its overlap with
+    a higher scoring kept box is greater than thresh, like in gpu_nms.
+
+    Input parameters:
+        dets: (torch.FloatTensor) Nx5 boxes, each row is x1,y1,x2,y2,score
+        thresh: (float) overlap threshold
+
+    Returns:
+        (torch.LongTensor) indices of kept boxes, highest score first
+    '''
+    if dets.size(0) == 0:
+        return dets.new(0).long()
+    scores = dets[:, 4].contiguous()
+
+    if _torchvision_nms is not None:
+        #shift the far corner so the +1 is included in widths and heights
+        boxes = dets[:, :4].clone()
+        boxes[:, 2:] += 1
+        return _torchvision_nms(boxes, scores, thresh)
+
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.sort(0, descending=True)[1]
+
+    keep = []
+    while order.numel() > 0:
+        i = order[:1]
+        keep.append(i)
+        if order.numel() == 1:
+            break
+        rest = order[1:]
+        w = (torch.min(x2[rest], x2[i]) - torch.max(x1[rest], x1[i]) + 1).clamp(min=0)
+        h = (torch.min(y2[rest], y2[i]) - torch.max(y1[rest], y1[i]) + 1).clamp(min=0)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[rest] - inter)
+        order = rest[(ovr <= thresh).nonzero().view(-1)]
+    return torch.cat(keep)
@@ -0,0 +1,145 @@
+import os
+import json
+import cv2
+import numpy as np
+import torch.utils.data
+
+from utils import get_AVD_dataset, get_dataset_key
+
+
+def build_scene_cache(dataset, cache_dir, scale=1.0):
+    '''
+    Writes the decoded frames and labels of a dataset to a cache
+
+    Every frame of the dataset is decoded once, maybe resized, and
+    appended to images.bin as uint8. index.json gives the image name,
+    offset, shape and gt boxes of each frame. Boxes are scaled with the
+    frame.
+
+    ex) build_scene_cache(get_AVD_dataset(...), 'cache_dir', scale=.5)
+
+    Input parameters:
+        dataset: (AVD) gives (image, [boxes, image_name]) samples, i.e. from
+                 get_AVD_dataset
+        cache_dir: (str) where to write the cache
+
+        scale (optional): (float) resize factor for frames. Default: 1
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    index_file = os.path.join(cache_dir, 'index.json')
+    data_file = os.path.join(cache_dir, 'images.bin')
+
+    frames = []
+    with open(data_file + '.tmp', 'wb') as f:
+        for ind in range(len(dataset)):
+            img, labels = dataset[ind]
+            boxes = np.asarray(labels[0], dtype=np.float32).reshape(-1, 6)
+            if scale != 1:
+                img = cv2.resize(img, (0,0), fx=scale, fy=scale)
+                boxes[:, :4] *= scale
+            frames.append({'name': labels[1],
+                           'offset': f.tell(),
+                           'shape': list(img.shape),
+                           'boxes': boxes.tolist()})
+            f.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+
+    #data first, so an index always points to complete data
+    os.rename(data_file + '.tmp', data_file)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump({'scale': scale, 'frames': frames}, f)
+    os.rename(index_file + '.tmp', index_file)
+
+
+class SceneCacheDataset(torch.utils.data.Dataset):
+    '''
+    Serves frames from build_scene_cache, in place of an AVD dataset.
+
+    Samples are (image, [boxes, image_name]) like from AVD, with the image
+    copied from the memory mapped cache, so there is no jpeg decoding.
+    Images are writable, like decoded ones, since callers draw on them.
+    Each worker maps the file on first use.
+
+    Input parameters:
+        cache_dir: (str) directory given to build_scene_cache
+
+        fraction_of_no_box (optional): (float) if given, only this
+                                       fraction of frames without boxes is
+                                       used, picked at random. If None all
+                                       cached frames are used. Default: None
+        seed (optional): (int) seed for picking frames without boxes.
+                         Default: None
+    '''
+
+    def __init__(self, cache_dir, fraction_of_no_box=None, seed=None):
+        with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.data_file = os.path.join(cache_dir, 'images.bin')
+        self.scale = index['scale']
+        self.frames = index['frames']
+        if fraction_of_no_box is not None:
+            has_box = np.array([len(frame['boxes']) > 0
+                                for frame in self.frames], dtype=np.bool_)
+            no_box_inds = np.flatnonzero(~has_box)
+            rng = np.random.RandomState(seed)
+            keep = has_box
+            keep[rng.choice(no_box_inds,
+                            int(fraction_of_no_box * no_box_inds.size),
+                            replace=False)] = True
+            self.frames = [frame for frame, k in zip(self.frames, keep) if k]
+        self._data = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getstate__(self):
+        #workers map the file again instead of getting a copy of it
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __getitem__(self, index):
+        if self._data is None:
+            self._data = np.memmap(self.data_file, dtype=np.uint8, mode='r')
+        frame = self.frames[index]
+        shape = frame['shape']
+        start = frame['offset']
+        img = np.array(self._data[start:start + int(np.prod(shape))]
+                       .reshape(shape))
+        return img, [frame['boxes'], frame['name']]
+
+
+def get_cached_AVD_dataset(cache_root, root, scene_list, chosen_ids,
+                           max_difficulty=4, fraction_of_no_box=.1,
+                           scale=1.0):
+    '''
+    Like get_AVD_dataset, but serves frames from a scene cache
+
+    The cache is built on first use, with all frames of the scenes, in a
+    directory named by the scenes, ids, difficulty and scale. Frames
+    without boxes are then sampled from it as get_AVD_dataset would.
+
+    Input parameters:
+        cache_root: (str) directory that holds all scene caches
+        root, scene_list, chosen_ids, max_difficulty, fraction_of_no_box:
+            see get_AVD_dataset
+
+        scale (optional): (float) resize factor for cached frames. Boxes are
+                          scaled too, so detections from scaled frames do
+                          not match the original gt boxes. Default: 1
+
+    Returns:
+        (SceneCacheDataset)
+    '''
+    cache_dir = os.path.join(cache_root, get_dataset_key(root,
+                                                         scene_list,
+                                                         chosen_ids,
+                                                         max_difficulty,
+                                                         scale))
+    if not os.path.isfile(os.path.join(cache_dir, 'index.json')):
+        print('Building scene cache in {} ...'.format(cache_dir))
+        dataset = get_AVD_dataset(root, scene_list, chosen_ids,
+                                  max_difficulty=max_difficulty,
+                                  fraction_of_no_box=1)
+        build_scene_cache(dataset, cache_dir, scale=scale)
+    return SceneCacheDataset(cache_dir, fraction_of_no_box=fraction_of_no_box)
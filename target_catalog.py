@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import importlib
+import cv2
+import numpy as np
+
+from utils import get_target_images, get_target_name, normalize_image
+
+
+def build_target_catalog(target_path, catalog_dir, target_names=None,
+                         cfg=None):
+    '''
+    Packs decoded target images into a single file, with an index
+
+    The catalog holds the same images get_target_images finds. Each image
+    is stored decoded, as uint8 from cv2.imread, or as float32 from
+    normalize_image if cfg is given. index.json gives the target type lists
+    of each object, and the offset and shape of each image.
+
+    ex) build_target_catalog(cfg.TARGET_IMAGE_DIR, cfg.TARGET_CATALOG_DIR)
+
+    Input parameters:
+        target_path: (str) path that holds directories of all targets, see
+                     get_target_images
+        catalog_dir: (str) where to write the catalog
+
+        target_names (optional): (list of str) objects to include, if None
+                                 every object with a target image is.
+                                 Default: None
+        cfg (optional): (Config) if given, images are normalized with it.
+                        Normalized images can not be augmented, so only use
+                        them for testing. Default: None
+    '''
+    if target_names is None:
+        target_names = set()
+        for t_dir in os.listdir(target_path):
+            for name in os.listdir(os.path.join(target_path, t_dir)):
+                target_names.add(get_target_name(name))
+    target_images = get_target_images(target_path, target_names)
+
+    if not os.path.isdir(catalog_dir):
+        os.makedirs(catalog_dir)
+    index_file = os.path.join(catalog_dir, 'index.json')
+    data_file = os.path.join(catalog_dir, 'images.bin')
+    index = {'target_path': target_path,
+             'normalized': cfg is not None,
+             'dtype': 'float32' if cfg is not None else 'uint8',
+             'targets': {}}
+
+    with open(data_file + '.tmp', 'wb') as f:
+        for name in sorted(target_images.keys()):
+            type_lists = []
+            for type_list in target_images[name]:
+                entries = []
+                for img_path in type_list:
+                    img = cv2.imread(img_path)
+                    if cfg is not None:
+                        img = normalize_image(img, cfg).astype(np.float32)
+                    entries.append({
+                           'key': os.path.relpath(img_path, target_path),
+                           'offset': f.tell(),
+                           'shape': list(img.shape)})
+                    f.write(np.ascontiguousarray(img).tobytes())
+                type_lists.append(entries)
+            index['targets'][name] = type_lists
+
+    #data first, so an index always points to complete data
+    os.rename(data_file + '.tmp', data_file)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.rename(index_file + '.tmp', index_file)
+
+
+class TargetCatalog(object):
+    '''
+    Memory mapped target images from build_target_catalog.
+
+    Stands in for get_target_images and a TargetImageCache:
+    get_target_images gives the usual dict of target image paths, and get
+    returns the image for one of those paths as a read only view of the
+    mapped file. No directories are listed and no image files are opened.
+
+    ex) catalog = TargetCatalog(cfg.TARGET_CATALOG_DIR)
+        target_images = catalog.get_target_images(cfg.NAME_TO_ID.keys())
+        img = catalog.get(target_images[name][0][0])
+
+    Input parameters:
+        catalog_dir: (str) directory given to build_target_catalog
+
+        target_path (optional): (str) prefix of returned image paths. If
+                                None, the target_path the catalog was built
+                                from. Default: None
+    '''
+
+    def __init__(self, catalog_dir, target_path=None):
+        with open(os.path.join(catalog_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.data_file = os.path.join(catalog_dir, 'images.bin')
+        self.normalized = index['normalized']
+        self.dtype = np.dtype(index['dtype'])
+        if target_path is None:
+            target_path = index['target_path']
+
+        self.targets = {}
+        self._entries = {}
+        for name, type_lists in index['targets'].items():
+            self.targets[name] = []
+            for entries in type_lists:
+                img_paths = []
+                for entry in entries:
+                    img_path = os.path.join(target_path, entry['key'])
+                    self._entries[img_path] = (
+                                       entry['offset'] // self.dtype.itemsize,
+                                       tuple(entry['shape']))
+                    img_paths.append(img_path)
+                self.targets[name].append(img_paths)
+        self._data = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, img_path):
+        return img_path in self._entries
+
+    def __getstate__(self):
+        #workers map the file again instead of getting a copy of it
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def get_target_images(self, target_names):
+        '''
+        Returns paths to the target images of some objects
+
+        Input parameters:
+            target_names: (list of str) object names
+
+        Returns:
+            (dict) same as get_target_images, an object with no images
+            has an empty list
+        '''
+        return {name: [list(img_paths) for img_paths in
+                       self.targets.get(name, [])]
+                for name in target_names}
+
+    def get(self, img_path):
+        '''
+        Returns the image, a read only view into the catalog file
+        '''
+        if self._data is None:
+            self._data = np.memmap(self.data_file, dtype=self.dtype,
+                                   mode='r')
+        start, shape = self._entries[img_path]
+        return self._data[start:start + int(np.prod(shape))].reshape(shape)
+
+
+if __name__ == '__main__':
+
+    #load config file
+    cfg_file = 'configAVD2' #NO EXTENSTION!
+    cfg = importlib.import_module('configs.'+cfg_file)
+    cfg = cfg.get_config()
+
+    if cfg.TARGET_CATALOG_DIR is None:
+        print('Set TARGET_CATALOG_DIR in the config!')
+        sys.exit()
+    print('Building target catalog in {} ...'.format(cfg.TARGET_CATALOG_DIR))
+    build_target_catalog(cfg.TARGET_IMAGE_DIR, cfg.TARGET_CATALOG_DIR,
+                         cfg=cfg if cfg.TARGET_CATALOG_NORMALIZED else None)
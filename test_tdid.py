@@ -1,5 +1,6 @@
 import os
 import torch
+import torch.nn.functional as F
 import torchvision.models as models
 import cv2
 #import cPickle
@@ -8,8 +9,10 @@ import importlib
 import json
 
 from model_defs.TDID import TDID
-from model_defs.nms.nms_wrapper import nms
+from model_defs.nms.nms_wrapper import nms_per_class, print_nms_timings
 from utils import * 
+from target_catalog import TargetCatalog
+from scene_cache import get_cached_AVD_dataset
 
 import active_vision_dataset_processing.data_loading.active_vision_dataset as AVD  
 
@@ -45,9 +48,90 @@ def im_detect(net, target_data,im_data, im_info, features_given=True):
     return scores, boxes
 
 
+def im_detect_targets(net, target_features, img_features, im_info,
+                      max_targets_per_pass):
+    """
+    Detect many target objects in a single scene image.
+
+    The scene feature map is scored against up to max_targets_per_pass
+    targets in a single forward pass, instead of one pass per target.
+    Targets are only grouped with others whose feature maps have the same size.
+
+    Input Parameters:
+        net: (TDID) the network
+        target_features: (list) one (torch Variable) per target, the 
+                         stacked features of that target's images 
+        img_features: (torch Variable) 1xCxHxW features of the scene image
+        im_info: (tuple) (height,width,channels) of the scene image
+        max_targets_per_pass: (int) max number of targets in one forward pass
+
+    Returns:
+        all_scores (list): N x 2 ndarray of class scores for each target.
+                           Zero score rows may be padded on the end.
+        all_boxes (list): N x 4 ndarray of predicted boxes for each target
+    """
+    all_scores = [None]*len(target_features)
+    all_boxes = [None]*len(target_features)
+
+    #only targets with the same feature map size can be stacked
+    size_groups = {}
+    for t_ind, t_features in enumerate(target_features):
+        size_groups.setdefault(tuple(t_features.size()), []).append(t_ind)
+
+    for group in size_groups.values():
+        for start in range(0, len(group), max_targets_per_pass):
+            chunk = group[start:start+max_targets_per_pass]
+            chunk_target_features = torch.cat([target_features[t_ind] 
+                                               for t_ind in chunk], 0)
+            chunk_img_features = img_features.expand(len(chunk), 
+                                                   *img_features.size()[1:])
+            cls_prob, rois = net(chunk_target_features, chunk_img_features,
+                                 im_info, features_given=True)
+            cls_prob = cls_prob.data.cpu().numpy()
+            rois = rois.data.cpu().numpy()
+
+            for chunk_ind, t_ind in enumerate(chunk):
+                scores = cls_prob[chunk_ind,:,:]
+                zs = np.zeros((scores.size, 1))
+                all_scores[t_ind] = np.concatenate((zs,scores),1)
+                all_boxes[t_ind] = rois[chunk_ind,:,:]
+
+    return all_scores, all_boxes
+
+
+def get_max_targets_per_pass(img_features, cfg):
+    """
+    Number of targets that can be scored in one pass within a memory budget.
+
+    Estimates the float32 activations the TDID head needs for a single
+    target on a scene feature map of this size, and fits as many targets 
+    as possible in cfg.TEST_BATCH_TARGETS_MEMORY_MB.
+
+    Input Parameters:
+        img_features: (torch Variable) 1xCxHxW features of the scene image
+        cfg: (Config) config file
+
+    Returns:
+        (int) max number of targets per forward pass, at least 1
+    """
+    _, num_channels, height, width = img_features.size()
+    num_anchors = len(cfg.ANCHOR_SCALES)*3
+    #corrs and diffs, corr/diff convs, concatenated feats
+    channels_per_target = (2*cfg.NUM_TARGETS + 5)*num_channels
+    if not cfg.CORR_WITH_POOLED:
+        #scene features are copied for each target in the correlation
+        channels_per_target += cfg.NUM_TARGETS*num_channels
+    #embedding, scores, probs, and bbox preds
+    channels_per_target += 512 + 8*num_anchors
+    bytes_per_target = 4*channels_per_target*height*width
+
+    budget = cfg.TEST_BATCH_TARGETS_MEMORY_MB*1024*1024
+    return max(1, int(budget/bytes_per_target))
+
+
 def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
              max_dets_per_target=5, score_thresh=0.1,
-             output_dir=None):
+             output_dir=None, target_cache=None, use_target_bank=None):
     """
     Test a TDID network.
 
@@ -67,8 +151,19 @@ def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
         output_dir (optional): (str) full path of directory to save results in
                                if None, nothing will be saved. 
                                Default: None. 
+        target_cache (optional): (TargetImageCache or TargetCatalog) decoded
+                                 target images, if None images are read
+                                 from disk.
+                                 Default: None
+        use_target_bank (optional): (bool) whether to load target features
+                                    from cfg.TARGET_BANK_DIR. The bank is
+                                    kept per set of backbone weights, so
+                                    only use it if they are fixed. If None,
+                                    cfg.USE_TARGET_BANK. Default: None
          
-
+    Returns:
+        (ndarray) Nx7 detections, each row is [image_id, xmin, ymin, width,
+        height, score, category_id]. See COCO.loadResArray.
     """
     results = []
     num_images = len(dataloader)
@@ -84,25 +179,53 @@ def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
     #load targets, maybe compute features
     target_features_dict = {}
     target_data_dict = {}
+    target_bank = None
+    normalizer = ImageNormalizer(cfg)
+    if use_target_bank is None:
+        use_target_bank = cfg.USE_TARGET_BANK
+    if use_target_bank and not cfg.TEST_ONE_AT_A_TIME:
+        target_bank = TargetFeatureBank(cfg.TARGET_BANK_DIR, net, cfg)
     for id_ind,t_id in enumerate(chosen_ids):
         target_name = id_to_name[t_id]
         if target_name == 'background':
             continue
-        target_data = []
+        target_paths = []
         for t_type,_ in enumerate(target_images[target_name]):
             img_ind = np.random.choice(np.arange(
                                   len(target_images[target_name][t_type])))
-            target_img = cv2.imread(target_images[target_name][t_type][img_ind])
-            target_img = normalize_image(target_img,cfg)
-            target_data.append(target_img)
+            target_paths.append(target_images[target_name][t_type][img_ind])
 
-        target_data = match_and_concat_images_list(target_data)
+        if target_bank is not None:
+            target_features_dict[target_name] = np_to_variable(
+                                       target_bank.get_features(target_paths),
+                                       is_cuda=True)
+            continue
+
+        target_data = []
+        for target_path in target_paths:
+            if target_cache is not None:
+                target_img = target_cache.get(target_path)
+            else:
+                target_img = cv2.imread(target_path)
+            target_data.append(limit_image_size(target_img,
+                                                cfg.TARGET_MAX_SIDE))
+
+        if target_cache is not None and target_cache.normalized:
+            target_data = match_and_concat_images_list(target_data)
+        else:
+            #no buffer_name, target data is kept for all images
+            target_data = normalizer(target_data)
         target_data = np_to_variable(target_data, is_cuda=True)
         target_data = target_data.permute(0, 3, 1, 2)
         if cfg.TEST_ONE_AT_A_TIME:
             target_data_dict[target_name] = target_data
         else:
-            target_features_dict[target_name] = net.features(target_data)
+            target_features = net.features(target_data)
+            if cfg.CORR_WITH_POOLED:
+                #only the pooled features are used, so all targets stack
+                target_features = F.max_pool2d(target_features,
+                                               target_features.size()[2:])
+            target_features_dict[target_name] = target_features
 
     for i,batch in enumerate(dataloader):
         im_data= batch[0]
@@ -110,9 +233,8 @@ def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
         im_info = im_data.shape[:]
         if cfg.TEST_RESIZE_IMG_FACTOR > 0:
             im_data = cv2.resize(im_data,(0,0),fx=cfg.TEST_RESIZE_IMG_FACTOR, fy=cfg.TEST_RESIZE_IMG_FACTOR)
-        im_data = normalize_image(im_data,cfg)
+        im_data = normalizer([im_data], buffer_name='scene')
         im_data = np_to_variable(im_data, is_cuda=True)
-        im_data = im_data.unsqueeze(0)
         im_data = im_data.permute(0, 3, 1, 2)
 
         #get image name and index
@@ -123,70 +245,96 @@ def test_net(model_name, net, dataloader, target_images, chosen_ids, cfg,
         if not cfg.TEST_ONE_AT_A_TIME:
             img_features = net.features(im_data)
 
+        batch_targets = cfg.TEST_BATCH_TARGETS and not cfg.TEST_ONE_AT_A_TIME
+        if batch_targets:
+            target_names = [id_to_name[t_id] for t_id in chosen_ids
+                            if id_to_name[t_id] != 'background']
+            _t['im_detect'].tic()
+            all_scores, all_boxes = im_detect_targets(net, 
+                              [target_features_dict[target_name] 
+                               for target_name in target_names],
+                              img_features, im_info,
+                              get_max_targets_per_pass(img_features, cfg))
+            detect_time = _t['im_detect'].toc(average=False)
+            all_scores = dict(zip(target_names, all_scores))
+            all_boxes = dict(zip(target_names, all_boxes))
+
+        #gather foreground detections of all targets
+        if not batch_targets:
+            detect_time = 0
+        all_dets = []
+        all_target_ids = []
         for id_ind,t_id in enumerate(chosen_ids):
             target_name = id_to_name[t_id]
             if target_name == 'background':
                 continue
 
-            if cfg.TEST_ONE_AT_A_TIME:
+            if batch_targets:
+                scores = all_scores[target_name]
+                boxes = all_boxes[target_name]
+            elif cfg.TEST_ONE_AT_A_TIME:
                 target_data = target_data_dict[target_name]
                 _t['im_detect'].tic()
                 scores, boxes = im_detect(net, target_data, im_data, im_info,
                                           features_given=False)
-                detect_time = _t['im_detect'].toc(average=False)
+                detect_time += _t['im_detect'].toc(average=False)
             else:
                 target_features = target_features_dict[target_name]
                 _t['im_detect'].tic()
                 scores, boxes = im_detect(net, target_features, img_features,
                                           im_info, features_given=True)
-                detect_time = _t['im_detect'].toc(average=False)
-            _t['misc'].tic()
+                detect_time += _t['im_detect'].toc(average=False)
 
             if cfg.TEST_RESIZE_IMG_FACTOR > 0:
                 boxes *= (1.0/cfg.TEST_RESIZE_IMG_FACTOR) 
             if cfg.TEST_RESIZE_BOXES_FACTOR > 0:
                 boxes *= cfg.TEST_RESIZE_BOXES_FACTOR
 
-            #get scores for foreground, non maximum supression
             inds = np.where(scores[:, 1] > score_thresh)[0]
-            fg_scores = scores[inds, 1]
-            fg_boxes = boxes[inds,:]
-            fg_dets = np.hstack((fg_boxes, fg_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            keep = nms(fg_dets, cfg.TEST_NMS_OVERLAP_THRESH)
-            fg_dets = fg_dets[keep, :]
-
-            # Limit to max_per_target detections *over all classes*
-            if max_dets_per_target > 0:
-                image_scores = np.hstack([fg_dets[:, -1]])
-                if len(image_scores) > max_dets_per_target:
-                    image_thresh = np.sort(image_scores)[-max_dets_per_target]
-                    keep = np.where(fg_dets[:, -1] >= image_thresh)[0]
-                    fg_dets = fg_dets[keep, :]
-            nms_time = _t['misc'].toc(average=False)
-
-            print( 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
-                .format(i + 1, num_images, detect_time, nms_time))
-
-            #put class id in the box
-            fg_dets = np.insert(fg_dets,4,t_id,axis=1)
-
-            for box in fg_dets:
-                cid = int(box[4])
-                xmin = int(box[0])
-                ymin = int(box[1])
-                width = int(box[2]-box[0] + 1)
-                height = int(box[3]-box[1] + 1)
-                score = float(box[5])
-                results.append({'image_id':img_id, 'category_id':cid, 
-                                'bbox':[xmin,ymin,width,height],'score':score})
-
-                org_img = cv2.rectangle(org_img, (box[0], box[1]), (box[2],box[3]), (255,0,0), 2)
+            all_dets.append(np.hstack((boxes[inds,:],
+                                       scores[inds, 1][:, np.newaxis])))
+            all_target_ids.append(np.full(inds.shape[0], t_id,
+                                          dtype=np.int64))
+
+        #non maximum supression for all targets at once, then limit to
+        #max_dets_per_target detections for each target
+        _t['misc'].tic()
+        #no targets to detect if every chosen id is background
+        fg_dets = (np.concatenate(all_dets).astype(np.float32, copy=False)
+                   if all_dets else np.zeros((0, 5), np.float32))
+        target_ids = (np.concatenate(all_target_ids)
+                      if all_target_ids else np.zeros((0,), np.int64))
+        keep = nms_per_class(fg_dets, target_ids,
+                             cfg.TEST_NMS_OVERLAP_THRESH,
+                             max_per_class=max_dets_per_target,
+                             backend=cfg.NMS_BACKEND)
+        #put class id in the box
+        fg_dets = np.insert(fg_dets[keep, :], 4, target_ids[keep], axis=1)
+        nms_time = _t['misc'].toc(average=False)
+
+        print( 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
+            .format(i + 1, num_images, detect_time, nms_time))
+
+        #coco results, with the box corner and size truncated to ints
+        img_results = np.empty((fg_dets.shape[0], 7))
+        img_results[:, 0] = img_id
+        img_results[:, 1:3] = np.trunc(fg_dets[:, :2])
+        img_results[:, 3:5] = np.trunc(fg_dets[:, 2:4] - fg_dets[:, :2] + 1)
+        img_results[:, 5] = fg_dets[:, 5]
+        img_results[:, 6] = fg_dets[:, 4]
+        results.append(img_results)
+
+        for box in fg_dets:
+            org_img = cv2.rectangle(org_img, (box[0], box[1]), (box[2],box[3]), (255,0,0), 2)
 
         cv2.imwrite('./out_img.jpg', org_img)
+    print_nms_timings()
+    results = np.concatenate(results + [np.zeros((0, 7))])
     if output_dir is not None:
         with open(det_file, 'w') as f:
-            json.dump(results,f)
+            json.dump([{'image_id':int(det[0]), 'category_id':int(det[6]),
+                        'bbox':[int(v) for v in det[1:5]],
+                        'score':float(det[5])} for det in results], f)
     return results
 
 
@@ -200,7 +348,13 @@ if __name__ == '__main__':
 
     ##prepare target images (gather paths to the images)
     target_images ={}
-    if cfg.PYTORCH_FEATURE_NET:
+    target_catalog = None
+    if cfg.TARGET_CATALOG_DIR is not None:
+        target_catalog = TargetCatalog(cfg.TARGET_CATALOG_DIR,
+                                       target_path=cfg.TARGET_IMAGE_DIR)
+        target_images = target_catalog.get_target_images(
+                                                 cfg.NAME_TO_ID.keys())
+    elif cfg.PYTORCH_FEATURE_NET:
         target_images = get_target_images(cfg.TARGET_IMAGE_DIR, 
                                           cfg.NAME_TO_ID.keys())
     else:
@@ -213,12 +367,24 @@ if __name__ == '__main__':
         print('Invalid IDS!')
         sys.exit()
 
-    testset = get_AVD_dataset(cfg.AVD_ROOT_DIR,
+    if cfg.USE_SCENE_CACHE:
+        testset = get_cached_AVD_dataset(cfg.SCENE_CACHE_DIR,
+                              cfg.AVD_ROOT_DIR,
+                              cfg.TEST_LIST,
+                              test_ids,
+                              max_difficulty=cfg.MAX_OBJ_DIFFICULTY,
+                              fraction_of_no_box=cfg.TEST_FRACTION_OF_NO_BOX_IMAGES)
+    else:
+        testset = get_AVD_dataset(cfg.AVD_ROOT_DIR,
                               cfg.TEST_LIST,
                               test_ids,
                               max_difficulty=cfg.MAX_OBJ_DIFFICULTY,
                               fraction_of_no_box=cfg.TEST_FRACTION_OF_NO_BOX_IMAGES)
 
+    target_cache = target_catalog
+    if target_cache is None:
+        target_cache = get_target_image_cache(target_images, cfg)
+
     #create train/test loaders, with CUSTOM COLLATE function
     testloader = torch.utils.data.DataLoader(testset,
                                               batch_size=1,
@@ -241,7 +407,8 @@ if __name__ == '__main__':
     	 target_images,test_ids,cfg, 
     	 max_dets_per_target=cfg.MAX_DETS_PER_TARGET,
     	 score_thresh=cfg.SCORE_THRESH, 
-    	 output_dir=cfg.TEST_OUTPUT_DIR)
+    	 output_dir=cfg.TEST_OUTPUT_DIR,
+    	 target_cache=target_cache)
 
 
 
@@ -43,6 +43,7 @@ def test_net(model_name, net, dataloader, id_to_name, target_images, chosen_ids,
     #pre compute features for all targets
     target_features_dict = {}
     target_data_dict = {}
+    normalizer = ImageNormalizer(cfg)
     for id_ind,t_id in enumerate(chosen_ids):
         target_name = id_to_name[t_id]
         if target_name == 'background':
@@ -52,10 +53,10 @@ def test_net(model_name, net, dataloader, id_to_name, target_images, chosen_ids,
             img_ind = np.random.choice(np.arange(
                                   len(target_images[target_name][t_type])))
             target_img = cv2.imread(target_images[target_name][t_type][img_ind])
-            target_img = normalize_image(target_img,cfg)
-            target_data.append(target_img)
+            target_data.append(limit_image_size(target_img,
+                                                cfg.TARGET_MAX_SIDE))
 
-        target_data = match_and_concat_images_list(target_data)
+        target_data = normalizer(target_data)
         target_data = np_to_variable(target_data, is_cuda=True)
         target_data = target_data.permute(0, 3, 1, 2)
         if cfg.TEST_ONE_AT_A_TIME:
@@ -72,9 +73,8 @@ def test_net(model_name, net, dataloader, id_to_name, target_images, chosen_ids,
     for i,batch in enumerate(dataloader):
         im_data= batch[0]
         im_info = im_data.shape[:]
-        im_data=normalize_image(im_data,cfg)
+        im_data = normalizer([im_data], buffer_name='scene')
         im_data = np_to_variable(im_data, is_cuda=True)
-        im_data = im_data.unsqueeze(0)
         im_data = im_data.permute(0, 3, 1, 2)
 
         #get image name and index
@@ -0,0 +1,234 @@
+import copy
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('evaluation.cocoapi.PythonAPI.pycocotools._mask')
+from evaluation.cocoapi.PythonAPI.pycocotools.coco import COCO
+from evaluation.cocoapi.PythonAPI.pycocotools.cocoeval import COCOeval
+
+
+def make_dataset(seed, num_imgs=30, num_cats=4, max_dets=25):
+    '''
+    Seeded synthetic gt and detections, with crowd gts, duplicate gts and
+    detections (equal ious) and scores rounded so they tie
+    '''
+    rng = np.random.RandomState(seed)
+    images = [{'id': i + 1} for i in range(num_imgs)]
+    cats = [{'id': c + 1} for c in range(num_cats)]
+    anns = []
+    dets = []
+    for img in images:
+        img_anns = []
+        for _ in range(rng.randint(0, 8)):
+            x, y = rng.rand(2) * 300
+            w, h = rng.rand(2) * 150 + 2
+            img_anns.append({'bbox': [x, y, w, h], 'area': w * h,
+                             'category_id': int(rng.randint(1, num_cats + 1)),
+                             'iscrowd': int(rng.rand() < .2)})
+            if rng.rand() < .1:
+                img_anns.append(dict(img_anns[-1], iscrowd=0))
+        for ann in img_anns:
+            anns.append(dict(ann, id=len(anns) + 1, image_id=img['id']))
+        for _ in range(rng.randint(0, max_dets)):
+            if img_anns and rng.rand() < .6:
+                ann = img_anns[rng.randint(len(img_anns))]
+                bbox = [v + rng.randn() * 5 for v in ann['bbox']]
+                bbox[2] = abs(bbox[2]) + 1
+                bbox[3] = abs(bbox[3]) + 1
+                cat_id = ann['category_id']
+                if rng.rand() < .2:
+                    cat_id = int(rng.randint(1, num_cats + 1))
+            else:
+                x, y = rng.rand(2) * 300
+                w, h = rng.rand(2) * 150 + 2
+                bbox = [x, y, w, h]
+                cat_id = int(rng.randint(1, num_cats + 1))
+            dets.append({'image_id': img['id'], 'category_id': cat_id,
+                         'bbox': bbox, 'score': float(np.round(rng.rand(), 1))})
+            if rng.rand() < .1:
+                dets.append(dict(dets[-1]))
+    dataset = {'images': images, 'categories': cats, 'annotations': anns}
+    return dataset, dets
+
+
+def load_gt(dataset):
+    gt = COCO()
+    gt.dataset = copy.deepcopy(dataset)
+    gt.createIndex()
+    return gt
+
+
+def loop_evaluate_img(E, imgId, catId, aRng, maxDet):
+    '''
+    COCOeval.evaluateImg as it was before matching used array ops, with a
+    loop over thresholds, dts and gts
+    '''
+    p = E.params
+    if p.useCats:
+        gt = E._gts[imgId,catId]
+        dt = E._dts[imgId,catId]
+    else:
+        gt = [_ for cId in p.catIds for _ in E._gts[imgId,cId]]
+        dt = [_ for cId in p.catIds for _ in E._dts[imgId,cId]]
+    if len(gt) == 0 and len(dt) ==0:
+        return None
+
+    for g in gt:
+        if g['ignore'] or (g['area']<aRng[0] or g['area']>aRng[1]):
+            g['_ignore'] = 1
+        else:
+            g['_ignore'] = 0
+
+    gtind = np.argsort([g['_ignore'] for g in gt], kind='mergesort')
+    gt = [gt[i] for i in gtind]
+    dtind = np.argsort([-d['score'] for d in dt], kind='mergesort')
+    dt = [dt[i] for i in dtind[0:maxDet]]
+    iscrowd = [int(o['iscrowd']) for o in gt]
+    ious = E.ious[imgId, catId][:, gtind] if len(E.ious[imgId, catId]) > 0 else E.ious[imgId, catId]
+
+    T = len(p.iouThrs)
+    G = len(gt)
+    D = len(dt)
+    gtm  = np.zeros((T,G))
+    dtm  = np.zeros((T,D))
+    gtIg = np.array([g['_ignore'] for g in gt])
+    dtIg = np.zeros((T,D))
+    if not len(ious)==0:
+        for tind, t in enumerate(p.iouThrs):
+            for dind, d in enumerate(dt):
+                iou = min([t,1-1e-10])
+                m   = -1
+                for gind, g in enumerate(gt):
+                    if gtm[tind,gind]>0 and not iscrowd[gind]:
+                        continue
+                    if m>-1 and gtIg[m]==0 and gtIg[gind]==1:
+                        break
+                    if ious[dind,gind] < iou:
+                        continue
+                    iou=ious[dind,gind]
+                    m=gind
+                if m ==-1:
+                    continue
+                dtIg[tind,dind] = gtIg[m]
+                dtm[tind,dind]  = gt[m]['id']
+                gtm[tind,m]     = d['id']
+    a = np.array([d['area']<aRng[0] or d['area']>aRng[1] for d in dt]).reshape((1, len(dt)))
+    dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
+    return {
+            'image_id':     imgId,
+            'category_id':  catId,
+            'aRng':         aRng,
+            'maxDet':       maxDet,
+            'dtIds':        [d['id'] for d in dt],
+            'gtIds':        [g['id'] for g in gt],
+            'dtMatches':    dtm,
+            'gtMatches':    gtm,
+            'dtScores':     [d['score'] for d in dt],
+            'gtIgnore':     gtIg,
+            'dtIgnore':     dtIg,
+        }
+
+
+def loop_evaluate(E):
+    '''
+    COCOeval.evaluate with loop_evaluate_img for every image, category and
+    area range
+    '''
+    p = E.params
+    p.imgIds = list(np.unique(p.imgIds))
+    if p.useCats:
+        p.catIds = list(np.unique(p.catIds))
+    p.maxDets = sorted(p.maxDets)
+    E._prepare()
+    catIds = p.catIds if p.useCats else [-1]
+    E.ious = {(imgId, catId): E.computeIoU(imgId, catId)
+              for imgId in p.imgIds
+              for catId in catIds}
+    maxDet = p.maxDets[-1]
+    E.evalImgs = [loop_evaluate_img(E, imgId, catId, areaRng, maxDet)
+                  for catId in catIds
+                  for areaRng in p.areaRng
+                  for imgId in p.imgIds]
+    E._paramsEval = copy.deepcopy(p)
+
+
+def to_array(dets):
+    return np.array([[d['image_id']] + list(d['bbox']) +
+                     [d['score'], d['category_id']] for d in dets])
+
+
+def set_params(E, single_thresh, use_cats):
+    E.params.useCats = use_cats
+    if single_thresh:
+        #one threshold as in evaluation/coco_det_eval.py, and few maxDets so
+        #some dts are cut
+        E.params.iouThrs = np.array([.5])
+        E.params.maxDets = [1, 5, 10]
+    return E
+
+
+def assert_same_evals(ref, E):
+    assert len(ref.evalImgs) == len(E.evalImgs)
+    for ref_img, img in zip(ref.evalImgs, E.evalImgs):
+        if ref_img is None:
+            assert img is None
+            continue
+        assert set(ref_img) == set(img)
+        for key in ref_img:
+            ref_value, value = np.asarray(ref_img[key]), np.asarray(img[key])
+            assert ref_value.shape == value.shape, key
+            assert np.array_equal(ref_value, value), key
+    for key in ['precision', 'recall', 'scores']:
+        assert np.array_equal(ref.eval[key], E.eval[key]), key
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('single_thresh', [False, True])
+@pytest.mark.parametrize('use_cats', [1, 0])
+@pytest.mark.parametrize('num_procs', [1, 3])
+@pytest.mark.parametrize('array_results', [False, True])
+def test_evaluate_matches_loop(seed, single_thresh, use_cats, num_procs,
+                               array_results):
+    dataset, dets = make_dataset(seed)
+    gt = load_gt(dataset)
+    ref = set_params(COCOeval(gt, gt.loadRes(copy.deepcopy(dets)), 'bbox'),
+                     single_thresh, use_cats)
+    loop_evaluate(ref)
+    ref.accumulate()
+
+    gt = load_gt(dataset)
+    if array_results:
+        results = gt.loadResArray(to_array(dets))
+    else:
+        results = gt.loadRes(copy.deepcopy(dets))
+    E = set_params(COCOeval(gt, results, 'bbox'), single_thresh, use_cats)
+    E.evaluate(numProcs=num_procs)
+    E.accumulate()
+
+    assert_same_evals(ref, E)
+    if not single_thresh:
+        ref.summarize()
+        E.summarize()
+        assert np.array_equal(ref.stats, E.stats)
+
+
+def test_evaluate_subset_of_images_and_categories():
+    dataset, dets = make_dataset(3)
+    gt = load_gt(dataset)
+    ref = COCOeval(gt, gt.loadRes(copy.deepcopy(dets)), 'bbox')
+    ref.params.imgIds = list(range(1, 25, 2)) + [999]
+    ref.params.catIds = [1, 3]
+    loop_evaluate(ref)
+    ref.accumulate()
+
+    gt = load_gt(dataset)
+    E = COCOeval(gt, gt.loadResArray(to_array(dets)), 'bbox')
+    E.params.imgIds = list(range(1, 25, 2)) + [999]
+    E.params.catIds = [1, 3]
+    E.evaluate(numProcs=2)
+    E.accumulate()
+
+    assert_same_evals(ref, E)
@@ -0,0 +1,28 @@
+import os
+import sys
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scene_cache import build_scene_cache, SceneCacheDataset
+
+
+def test_cached_frames_can_be_drawn_on(tmp_path):
+    rng = np.random.RandomState(0)
+    frames = [(rng.randint(0, 256, (40, 60, 3)).astype(np.uint8),
+               [[[5, 6, 20, 30, 1, 1]], '000110000010101.jpg']),
+              (rng.randint(0, 256, (30, 50, 3)).astype(np.uint8),
+               [[], '000110000020101.jpg'])]
+    cache_dir = str(tmp_path / 'cache')
+    build_scene_cache(frames, cache_dir)
+    dataset = SceneCacheDataset(cache_dir)
+
+    img, labels = dataset[0]
+    assert np.array_equal(img, frames[0][0])
+    assert labels == [[[5, 6, 20, 30, 1, 1]], '000110000010101.jpg']
+
+    #as test_net does with each detection
+    img = cv2.rectangle(img, (5, 6), (20, 30), (255, 0, 0), 2)
+    assert np.array_equal(img[6, 5], [255, 0, 0])
+    #the cache itself is unchanged
+    assert np.array_equal(dataset[0][0], frames[0][0])
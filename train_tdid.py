@@ -10,7 +10,10 @@ import cv2
 import time
 
 from model_defs.TDID import TDID 
+from model_defs.feature_map_size import FeatureMapSize
 from utils import *
+from target_catalog import TargetCatalog
+from scene_cache import get_cached_AVD_dataset
 from evaluation.coco_det_eval import coco_det_eval 
 
 import active_vision_dataset_processing.data_loading.active_vision_dataset as AVD  
@@ -26,7 +29,8 @@ else:
     test_net = importlib.import_module('test_tdid').test_net
 
 
-def validate_and_save(cfg,net,valset,target_images, epoch, total_iterations):
+def validate_and_save(cfg,net,valset,target_images, epoch, total_iterations,
+                      target_cache=None):
     '''
     Test on validation data, and save a snapshot of model
     '''
@@ -36,19 +40,30 @@ def validate_and_save(cfg,net,valset,target_images, epoch, total_iterations):
                                           collate_fn=AVD.collate)
     model_name = cfg.MODEL_BASE_SAVE_NAME + '_{}'.format(epoch)
     net.eval()
+    #detections are evaluated in memory, saving them is optional
+    output_dir = None
+    if cfg.SAVE_VAL_DETECTIONS:
+        output_dir = cfg.TEST_OUTPUT_DIR
     all_results = test_net(model_name, net, valloader, 
                            target_images, cfg.VAL_OBJ_IDS, cfg, 
                            max_dets_per_target=cfg.MAX_DETS_PER_TARGET,
-                           output_dir=cfg.TEST_OUTPUT_DIR,
-                           score_thresh=cfg.SCORE_THRESH)
+                           output_dir=output_dir,
+                           score_thresh=cfg.SCORE_THRESH,
+                           target_cache=target_cache,
+                           #a bank for weights still in training is never
+                           #used again
+                           use_target_bank=(cfg.USE_TARGET_BANK and
+                                            cfg.FREEZE_FEATURES))
 
     if len(all_results) == 0:
         #coco code can't handle no detections?
         m_ap = 0
     else:
         m_ap = coco_det_eval(cfg.VAL_GROUND_TRUTH_BOXES,
-                             cfg.TEST_OUTPUT_DIR+model_name+'.json',
-                             catIds=cfg.VAL_OBJ_IDS)
+                             all_results,
+                             catIds=cfg.VAL_OBJ_IDS,
+                             num_procs=cfg.EVAL_NUM_WORKERS,
+                             gt_cache_dir=cfg.GT_CACHE_DIR)
 
     save_name = os.path.join(cfg.SNAPSHOT_SAVE_DIR, 
                              (cfg.MODEL_BASE_SAVE_NAME+
@@ -62,7 +77,13 @@ def validate_and_save(cfg,net,valset,target_images, epoch, total_iterations):
 
 #prepare target images (gather paths to the images)
 target_images ={} 
-if cfg.PYTORCH_FEATURE_NET:
+target_catalog = None
+if cfg.TARGET_CATALOG_DIR is not None:
+    #prebuilt with target_catalog.py, no need to list target dirs
+    target_catalog = TargetCatalog(cfg.TARGET_CATALOG_DIR,
+                                   target_path=cfg.TARGET_IMAGE_DIR)
+    target_images = target_catalog.get_target_images(cfg.NAME_TO_ID.keys())
+elif cfg.PYTORCH_FEATURE_NET:
     target_images = get_target_images(cfg.TARGET_IMAGE_DIR,cfg.NAME_TO_ID.keys())
 else:
     raise NotImplementedError
@@ -79,23 +100,39 @@ if train_ids==-1 or val_ids==-1:
 
 
 print('Setting up training data...')
-train_set = get_AVD_dataset(cfg.AVD_ROOT_DIR,
+#decoded target images, shared with the DataLoader workers if preloaded
+target_cache = target_catalog
+if target_cache is None:
+    #the main process reads target images for validation
+    target_cache = get_target_image_cache(target_images, cfg,
+                                          num_processes=cfg.NUM_WORKERS + 1)
+if cfg.USE_SCENE_CACHE:
+    #decoded frames from memory mapped caches, built on first use
+    train_set = get_cached_AVD_dataset(cfg.SCENE_CACHE_DIR,
+                            cfg.AVD_ROOT_DIR,
+                            cfg.TRAIN_LIST,
+                            train_ids,
+                            max_difficulty=cfg.MAX_OBJ_DIFFICULTY,
+                            fraction_of_no_box=cfg.FRACTION_OF_NO_BOX_IMAGES,
+                            scale=cfg.SCENE_CACHE_SCALE)
+    valset = get_cached_AVD_dataset(cfg.SCENE_CACHE_DIR,
+                         cfg.AVD_ROOT_DIR,
+                         cfg.VAL_LIST,
+                         val_ids, 
+                         max_difficulty=cfg.MAX_OBJ_DIFFICULTY,
+                         fraction_of_no_box=cfg.VAL_FRACTION_OF_NO_BOX_IMAGES)
+else:
+    train_set = get_AVD_dataset(cfg.AVD_ROOT_DIR,
                             cfg.TRAIN_LIST,
                             train_ids,
                             max_difficulty=cfg.MAX_OBJ_DIFFICULTY,
                             fraction_of_no_box=cfg.FRACTION_OF_NO_BOX_IMAGES)
-valset = get_AVD_dataset(cfg.AVD_ROOT_DIR,
+    valset = get_AVD_dataset(cfg.AVD_ROOT_DIR,
                          cfg.VAL_LIST,
                          val_ids, 
                          max_difficulty=cfg.MAX_OBJ_DIFFICULTY,
                          fraction_of_no_box=cfg.VAL_FRACTION_OF_NO_BOX_IMAGES)
 
-trainloader = torch.utils.data.DataLoader(train_set,
-                                          batch_size=cfg.BATCH_SIZE,
-                                          shuffle=True,
-                                          num_workers=cfg.NUM_WORKERS,
-                                          collate_fn=AVD.collate)
-
 print('Loading network...')
 net = TDID(cfg)
 if cfg.LOAD_FULL_MODEL:
@@ -115,8 +152,54 @@ if not os.path.exists(cfg.META_SAVE_DIR):
 net.cuda()
 net.train()
 
+if cfg.FREEZE_FEATURES:
+    #only the head is trained, on features computed once and stored
+    for param in net.features.parameters():
+        param.requires_grad = False
+    net.features.eval()
+    scales = [1]
+    if cfg.RESIZE_IMG > 0:
+        scales.append(cfg.RESIZE_IMG_FACTOR)
+    scene_bank = SceneFeatureBank(cfg.SCENE_FEATURE_BANK_DIR, net, cfg)
+    dataset_key = get_dataset_key(cfg.AVD_ROOT_DIR, cfg.TRAIN_LIST, train_ids,
+                                  cfg.MAX_OBJ_DIFFICULTY)
+    print('Computing scene features...')
+    scene_bank.update(get_AVD_dataset(cfg.AVD_ROOT_DIR,
+                                      cfg.TRAIN_LIST,
+                                      train_ids,
+                                      max_difficulty=cfg.MAX_OBJ_DIFFICULTY,
+                                      fraction_of_no_box=1),
+                      dataset_key, scales=scales)
+    target_bank = TargetFeatureBank(cfg.TARGET_BANK_DIR, net, cfg)
+    target_bank.update(target_images)
+    train_set = TDIDFeatureTrainSet(scene_bank, dataset_key, target_bank,
+                            train_ids, target_images, cfg,
+                            feat_stride=net._feat_stride,
+                            fraction_of_no_box=cfg.FRACTION_OF_NO_BOX_IMAGES,
+                            seed=cfg.AUGMENT_SEED)
+else:
+    #anchor targets can be computed in the DataLoader workers, with the batch
+    feature_map_size = None
+    if cfg.ANCHOR_TARGETS_IN_WORKERS:
+        feature_map_size = FeatureMapSize(net.features)
+    train_set = TDIDTrainSet(train_set, train_ids, target_images, cfg,
+                             feature_map_size=feature_map_size,
+                             feat_stride=net._feat_stride,
+                             seed=cfg.AUGMENT_SEED,
+                             target_cache=target_cache)
+if cfg.AUGMENT_SEED is not None:
+    #DataLoader workers are seeded from torch
+    torch.manual_seed(cfg.AUGMENT_SEED)
+trainloader = torch.utils.data.DataLoader(train_set,
+                                          batch_size=cfg.BATCH_SIZE,
+                                          shuffle=True,
+                                          num_workers=cfg.NUM_WORKERS,
+                                          collate_fn=train_set.collate,
+                                          worker_init_fn=train_set.seed_worker,
+                                          drop_last=True)
+
 #setup optimizer
-params = list(net.parameters())
+params = [param for param in net.parameters() if param.requires_grad]
 optimizer = torch.optim.SGD(params, lr=cfg.LEARNING_RATE,
                                     momentum=cfg.MOMENTUM, 
                                     weight_decay=cfg.WEIGHT_DECAY)
@@ -137,78 +220,40 @@ for epoch in range(1,cfg.MAX_NUM_EPOCHS+1):
     epoch_step_cnt = 0
     for step,batch in enumerate(trainloader):
         total_iterations += 1
-        if cfg.BATCH_SIZE == 1:
-            batch[0] = [batch[0]]
-            batch[1] = [batch[1]]
-        if type(batch[0]) is not list or len(batch[0]) < cfg.BATCH_SIZE:
-            continue
-
-        batch_im_data = []
-        batch_target_data = []
-        batch_gt_boxes = []
-        for batch_ind in range(cfg.BATCH_SIZE):
-            im_data=batch[0][batch_ind]
-            im_data=normalize_image(im_data,cfg)
-            gt_boxes = np.asarray(batch[1][batch_ind][0],dtype=np.float32) 
-
-            if np.random.rand() < cfg.RESIZE_IMG:
-                im_data = cv2.resize(im_data,(0,0),fx=cfg.RESIZE_IMG_FACTOR,
-                                     fy=cfg.RESIZE_IMG_FACTOR)
-                if gt_boxes.shape[0] >0:
-                    gt_boxes[:,:4] *= cfg.RESIZE_IMG_FACTOR
-
-            #if there are no boxes for this image, add a dummy background box
-            if gt_boxes.shape[0] == 0:
-                gt_boxes = np.asarray([[0,0,1,1,0]])
-
-            objects_present = gt_boxes[:,4]
-            objects_present = objects_present[np.where(objects_present!=0)[0]]
-            not_present = np.asarray([ind for ind in train_ids 
-                                      if ind not in objects_present and 
-                                      ind != 0]) 
-
-            #pick a target 
-            if ((np.random.rand() < cfg.CHOOSE_PRESENT_TARGET or 
-                    not_present.shape[0]==0) and 
-                    objects_present.shape[0]!=0):
-                target_ind = int(np.random.choice(objects_present))
-                gt_boxes = gt_boxes[np.where(gt_boxes[:,4]==target_ind)[0],:-1] 
-                gt_boxes[0,4] = 1
+        if cfg.FREEZE_FEATURES:
+            (im_data, target_data, gt_boxes, target_inds, anchor_data,
+                    im_info, scene_inds) = batch
+            target_padding = 0
+            num_buckets = 1
+        else:
+            (im_data, target_data, gt_boxes, target_inds, anchor_data,
+                    target_padding, scene_inds) = batch
+            num_buckets = len(target_data)
+
+        #one entry for each scene/target pairing
+        for pair_ind, target_ind in enumerate(target_inds):
+            if gt_boxes[pair_ind,4] != 0:
                 target_use_cnt[target_ind][0] += 1 
-            else:#the target is not in the image, give a dummy background box
-                target_ind = int(np.random.choice(not_present))
-                gt_boxes = np.asarray([[0,0,1,1,0]])
             target_use_cnt[target_ind][1] += 1 
-            
-            #get target images
-            target_name = cfg.ID_TO_NAME[target_ind]
-            target_data = []
-            for t_type,_ in enumerate(target_images[target_name]):
-                img_ind = np.random.choice(np.arange(
-                                      len(target_images[target_name][t_type])))
-                target_img = cv2.imread(target_images[target_name][t_type][img_ind])
-                if np.random.rand() < cfg.AUGMENT_TARGET_IMAGES:
-                    target_img = augment_image(target_img, 
-                                           do_illum=cfg.AUGMENT_TARGET_ILLUMINATION)
-                target_img = normalize_image(target_img,cfg)
-                batch_target_data.append(target_img)
-
-            batch_im_data.append(im_data)
-            batch_gt_boxes.extend(gt_boxes)
 
         #prep data for input to network
-        target_data = match_and_concat_images_list(batch_target_data,
-                                                   min_size=cfg.MIN_TARGET_SIZE)
-        im_data = match_and_concat_images_list(batch_im_data)
-        gt_boxes = np.asarray(batch_gt_boxes) 
-        im_info = im_data.shape[1:]
-        im_data = np_to_variable(im_data, is_cuda=True)
-        im_data = im_data.permute(0, 3, 1, 2)
-        target_data = np_to_variable(target_data, is_cuda=True)
-        target_data = target_data.permute(0, 3, 1, 2)
-
-        # forward
-        net(target_data, im_data, im_info, gt_boxes=gt_boxes)
+        if cfg.FREEZE_FEATURES:
+            im_data = np_to_variable(im_data, is_cuda=True)
+            target_data = np_to_variable(target_data, is_cuda=True)
+            net(target_data, im_data, im_info, gt_boxes=gt_boxes,
+                features_given=True, anchor_data=anchor_data,
+                scene_inds=scene_inds)
+        else:
+            im_info = im_data.shape[1:]
+            im_data = np_to_variable(im_data, is_cuda=True)
+            im_data = im_data.permute(0, 3, 1, 2)
+            target_data = [(np_to_variable(data, is_cuda=True).permute(0, 3,
+                                                                       1, 2),
+                            inds) for data, inds in target_data]
+
+            # forward
+            net(target_data, im_data, im_info, gt_boxes=gt_boxes,
+                anchor_data=anchor_data, scene_inds=scene_inds)
  #       if cfg.USE_ROI_LOSS_ONLY:
  #           loss = net.roi_cross_entropy_loss
  #       else:
@@ -231,17 +276,24 @@ for epoch in range(1,cfg.MAX_NUM_EPOCHS+1):
             fps = step+1.0 / duration
 
             log_text = 'step %d, epoch_avg_loss: %.4f, fps: %.2f (%.2fs per batch) ' \
-                       'epoch:%d loss: %.4f tot_avg_loss: %.4f %s' % (
+                       'epoch:%d loss: %.4f tot_avg_loss: %.4f ' \
+                       'target padding: %.2f (%d buckets) %s' % (
                 step,  epoch_loss/epoch_step_cnt, fps, 1./fps, 
-                epoch, loss.data[0],train_loss/(step+1), cfg.MODEL_BASE_SAVE_NAME)
+                epoch, loss.data[0],train_loss/(step+1), target_padding,
+                num_buckets, cfg.MODEL_BASE_SAVE_NAME)
             print(log_text)
             print(target_use_cnt)
+            if isinstance(target_cache, TargetImageCache):
+                print('target image cache: {}'.format(
+                                                   target_cache.get_stats()))
 
         if (not cfg.SAVE_BY_EPOCH) and  total_iterations % cfg.SAVE_FREQ==0:
-            validate_and_save(cfg,net,valset,target_images,epoch,total_iterations)
+            validate_and_save(cfg,net,valset,target_images,epoch,total_iterations,
+                              target_cache=target_cache)
         
     ######################################################
     #epoch over
     if cfg.SAVE_BY_EPOCH and epoch % cfg.SAVE_FREQ == 0:
-        validate_and_save(cfg,net,valset,target_images, epoch, total_iterations)
+        validate_and_save(cfg,net,valset,target_images, epoch, total_iterations,
+                          target_cache=target_cache)
 
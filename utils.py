@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.data
 from torch.autograd import Variable
 import torchvision.models as models
 import os
@@ -9,14 +11,29 @@ import math
 import sys
 import h5py
 import json
+import hashlib
+from collections import OrderedDict
 
 import active_vision_dataset_processing.data_loading.active_vision_dataset as AVD
 import active_vision_dataset_processing.data_loading.transforms as AVD_transforms
 
+from model_defs.anchors.anchor_target_layer import anchor_target_layer
+
 #TODO check gradient clipping
 
 
 
+def get_target_name(file_name):
+    """
+    Returns the object name of a target image file
+
+    ex) get_target_name('crystal_hot_sauce_1.jpg') -> 'crystal_hot_sauce'
+    """
+    if file_name.find('N') == -1:
+        return file_name[:file_name.rfind('_')]
+    return file_name[:file_name.find('N')-1]
+
+
 def get_target_images(target_path, target_names,preload_images=False):
     """
     Returns dict with path to each target image, or loaded image
@@ -55,10 +72,7 @@ def get_target_images(target_path, target_names,preload_images=False):
     for type_ind, t_dir in enumerate(target_dirs):
         for name in os.listdir(os.path.join(target_path,t_dir)):
 
-            if name.find('N') == -1:
-                obj_name = name[:name.rfind('_')]
-            else:
-                obj_name = name[:name.find('N')-1]
+            obj_name = get_target_name(name)
 
             #make sure object is valid, and load the image or store path
             if obj_name in target_names:
@@ -75,6 +89,203 @@ def get_target_images(target_path, target_names,preload_images=False):
 
 
 
+class TargetImageCache(object):
+    """
+    Decoded target images, kept in memory up to a byte budget.
+
+    Target images are small and read over and over, by every DataLoader
+    worker and by the test loop. preload() decodes a set of images into one
+    shared memory buffer, which forked (or spawned) workers map instead of
+    copying. Images that are not preloaded, or do not fit in the budget
+    after preloading, are decoded on first use and kept in a per process
+    LRU cache. Each of the num_processes processes gets an equal part of
+    the rest of the budget for its LRU cache.
+
+    Hit and miss counts and LRU bytes of all processes are kept in shared
+    memory, so get_stats in the main process covers the workers too.
+
+    Returned images are read only views, copy them before changing them.
+
+    ex) cache = TargetImageCache(512 * 2**20, num_processes=5)
+        cache.preload(target_paths)
+        img = cache.get(target_paths[0])
+
+    Input parameters:
+        max_bytes: (int) memory budget for decoded images of all processes,
+                   shared and LRU together
+
+        num_processes (optional): (int) number of processes that read
+                                  images, i.e. DataLoader workers plus the
+                                  main process. Default: 1
+    """
+
+    normalized = False
+
+    def __init__(self, max_bytes, num_processes=1):
+        self.max_bytes = max_bytes
+        self.num_processes = num_processes
+        #hits, misses and lru bytes of the main process and each worker
+        self._counters = torch.LongTensor(num_processes, 3).zero_()
+        self._counters.share_memory_()
+        self._slot_pid = None
+        self._buffers = []
+        self._index = {}
+        self._shared = {}
+        self._shared_bytes = 0
+        self._lru = OrderedDict()
+        self._lru_bytes = 0
+
+    def __len__(self):
+        return len(self._shared) + len(self._lru)
+
+    def __contains__(self, img_path):
+        return img_path in self._shared or img_path in self._lru
+
+    def __getstate__(self):
+        #workers get the shared buffers, not this process' lru images
+        state = self.__dict__.copy()
+        state['_shared'] = {}
+        state['_lru'] = OrderedDict()
+        state['_lru_bytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shared = {img_path: self._make_view(*entry)
+                        for img_path, entry in self._index.items()}
+
+    def _make_view(self, buffer_ind, offset, shape):
+        num_bytes = int(np.prod(shape))
+        img = self._buffers[buffer_ind].numpy()[offset:offset + num_bytes]
+        img = img.reshape(shape)
+        img.flags.writeable = False
+        return img
+
+    def preload(self, img_paths):
+        """
+        Decodes images into shared memory, until the budget is used up
+
+        Input parameters:
+            img_paths: (list of str) full paths to images
+
+        Returns:
+            (int) number of images that were preloaded
+        """
+        images = []
+        num_bytes = 0
+        for img_path in img_paths:
+            if img_path in self._shared:
+                continue
+            img = cv2.imread(img_path)
+            if self._shared_bytes + num_bytes + img.nbytes > self.max_bytes:
+                break
+            images.append((img_path, img))
+            num_bytes += img.nbytes
+        if num_bytes == 0:
+            return 0
+
+        buffer_ind = len(self._buffers)
+        self._buffers.append(torch.ByteTensor(num_bytes).share_memory_())
+        buffer = self._buffers[buffer_ind].numpy()
+        offset = 0
+        for img_path, img in images:
+            buffer[offset:offset + img.nbytes] = img.ravel()
+            self._index[img_path] = (buffer_ind, offset, img.shape)
+            self._shared[img_path] = self._make_view(buffer_ind, offset,
+                                                     img.shape)
+            offset += img.nbytes
+            self._drop_lru(img_path)
+        self._shared_bytes += num_bytes
+        self._evict()
+        return len(images)
+
+    def get(self, img_path):
+        """
+        Returns the decoded image, as from cv2.imread, reading it if needed
+        """
+        counters = self._counters[self._get_slot()]
+        img = self._shared.get(img_path)
+        if img is not None:
+            counters[0] += 1
+            return img
+        img = self._lru.pop(img_path, None)
+        if img is not None:
+            counters[0] += 1
+        else:
+            counters[1] += 1
+            img = cv2.imread(img_path)
+            img.flags.writeable = False
+            self._lru_bytes += img.nbytes
+        #most recently used images are last
+        self._lru[img_path] = img
+        self._evict()
+        return img
+
+    def _get_slot(self):
+        #row of this process in the counters, 0 for the main process and
+        #worker id + 1 for DataLoader workers
+        pid = os.getpid()
+        if self._slot_pid != pid:
+            worker_info = torch.utils.data.get_worker_info()
+            slot = 0 if worker_info is None else worker_info.id + 1
+            self._slot = slot % self.num_processes
+            self._slot_pid = pid
+        return self._slot
+
+    def _drop_lru(self, img_path):
+        img = self._lru.pop(img_path, None)
+        if img is not None:
+            self._lru_bytes -= img.nbytes
+
+    def _evict(self):
+        lru_budget = max(self.max_bytes - self._shared_bytes,
+                         0) // self.num_processes
+        while self._lru and self._lru_bytes > lru_budget:
+            _, img = self._lru.popitem(last=False)
+            self._lru_bytes -= img.nbytes
+        self._counters[self._get_slot(), 2] = self._lru_bytes
+
+    def get_stats(self):
+        """
+        Returns:
+            (dict) 'hits', 'misses' and 'bytes' used, of all processes, and
+            number of 'shared' and 'lru' images of this process
+        """
+        hits, misses, lru_bytes = self._counters.sum(0).tolist()
+        return {'hits': hits,
+                'misses': misses,
+                'shared': len(self._shared),
+                'lru': len(self._lru),
+                'bytes': self._shared_bytes + lru_bytes}
+
+
+def get_target_image_cache(target_images, cfg, num_processes=1):
+    """
+    Makes a TargetImageCache, preloading all target images if
+    cfg.PRELOAD_TARGET_IMAGES
+
+    Input parameters:
+        target_images: (dict) paths to target images, from get_target_images
+        cfg: (Config) a config instance from configs/
+
+        num_processes (optional): (int) see TargetImageCache. Default: 1
+
+    Returns:
+        (TargetImageCache)
+    """
+    cache = TargetImageCache(int(cfg.TARGET_IMAGE_CACHE_MB * 2**20),
+                             num_processes=num_processes)
+    if cfg.PRELOAD_TARGET_IMAGES:
+        img_paths = [img_path for type_lists in target_images.values()
+                              for type_list in type_lists
+                              for img_path in type_list]
+        num_loaded = cache.preload(img_paths)
+        print('Preloaded {} of {} target images'.format(num_loaded,
+                                                        len(img_paths)))
+    return cache
+
+
+
 
 def match_and_concat_images_list(img_list, min_size=None):
     """
@@ -90,29 +301,104 @@ def match_and_concat_images_list(img_list, min_size=None):
 
     Returns:
         (ndarray) a single ndarray with first dimension equal to the 
-        number of elements in the inputted img_list    
-    """
-    #find size all images will be
-    max_rows = 0
-    max_cols = 0
-    for img in img_list:
-        max_rows = max(img.shape[0], max_rows)
-        max_cols = max(img.shape[1], max_cols)
+        number of elements in the inputted img_list, same dtype as the
+        first image
+    """
+    max_rows, max_cols = get_padded_size(img_list, min_size)
+
+    #pad the images straight into the stack
+    stacked = np.zeros((len(img_list),max_rows,max_cols,img_list[0].shape[2]),
+                       dtype=img_list[0].dtype)
+    for il,img in enumerate(img_list):
+        stacked[il,0:img.shape[0],0:img.shape[1],:] = img
+    return stacked
+
+
+def limit_image_size(img, max_side=None):
+    """
+    Shrinks an image so its longest side is at most max_side
+
+    The aspect ratio is kept. Smaller images, or any image if max_side is
+    None, are returned as they are.
+
+    Input parameters:
+        img: (ndarray) HxWxC image
+
+        max_side (optional): (int) max rows or cols. Default: None
+
+    Returns:
+        (ndarray) the image, resized or not
+    """
+    rows, cols = img.shape[:2]
+    if max_side is None or max(rows, cols) <= max_side:
+        return img
+    scale = float(max_side) / max(rows, cols)
+    return cv2.resize(img, (max(1, int(round(cols*scale))),
+                            max(1, int(round(rows*scale)))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def group_images_by_size(img_list, max_padding=None, min_size=None):
+    """
+    Groups images into buckets that can each be stacked with little padding
+
+    Images are sorted by size, and a bucket is closed when adding the next
+    image would make its padded pixels more than (1 + max_padding) times
+    its image pixels. Sides shorter than min_size count as min_size, since
+    they are padded in any bucket.
+
+    Input parameters:
+        img_list: (list of ndarray) HxWxC images
+
+        max_padding (optional): (float) max padding ratio of a bucket, if None
+                                all images are in one bucket. Default: None
+        min_size (optional): (int) see match_and_concat_images_list.
+                             Default: None
+
+    Returns:
+        (list of ndarray) sorted indices into img_list of the images in 
+        each bucket
+    """
+    if max_padding is None:
+        return [np.arange(len(img_list))]
+    if min_size is None:
+        min_size = 0
+    rows = np.array([max(img.shape[0], min_size) for img in img_list])
+    cols = np.array([max(img.shape[1], min_size) for img in img_list])
+    order = np.lexsort((cols, rows))[::-1]
+
+    buckets = []
+    bucket = []
+    for ind in order:
+        if bucket:
+            bucket_rows = max(rows[bucket].max(), rows[ind])
+            bucket_cols = max(cols[bucket].max(), cols[ind])
+            image_pixels = (rows[bucket]*cols[bucket]).sum() + rows[ind]*cols[ind]
+            padded_pixels = (len(bucket) + 1) * bucket_rows * bucket_cols
+            if padded_pixels > (1 + max_padding) * image_pixels:
+                buckets.append(np.sort(bucket))
+                bucket = []
+        bucket.append(ind)
+    buckets.append(np.sort(bucket))
+    return buckets
+
+
+def get_padded_size(img_list, min_size=None):
+    """
+    Returns (rows, cols) that fit every image in img_list, and min_size
+    """
+    max_rows = max(img.shape[0] for img in img_list)
+    max_cols = max(img.shape[1] for img in img_list)
     if min_size is not None:
         max_rows = max(max_rows,min_size)
         max_cols = max(max_cols,min_size)
-
-    #resize and stack the images
-    for il,img in enumerate(img_list):
-        resized_img = np.zeros((max_rows,max_cols,img.shape[2]))
-        resized_img[0:img.shape[0],0:img.shape[1],:] = img
-        img_list[il] = resized_img
-    return np.stack(img_list,axis=0) 
+    return max_rows, max_cols
 
 
 
 
-def create_illumination_pattern(rows, cols, center_row,center_col,minI=.1,maxI=1,radius=None):
+def create_illumination_pattern(rows, cols, center_row,center_col,minI=.1,maxI=1,radius=None,
+                                rng=np.random):
     '''
     Creates a random illumination pattern mask
 
@@ -126,30 +412,32 @@ def create_illumination_pattern(rows, cols, center_row,center_col,minI=.1,maxI=1
         maxI (optional): (float) max illum change. Default: 1
         radius (optional): (int) radius of illumination thing. If None
                            a random radius is chosen. Default: None
+        rng (optional): (np.random.RandomState) source of randomness.
+                        Default: np.random
 
     Returns:
-        (ndarray) array to be pixel-wise multiplied with an image to change
-        the images illumination
+        (ndarray) float32 array to be pixel-wise multiplied with an image to
+        change the images illumination
     
     '''
     if radius is None:
-        radius = float(int(20000 + (30000)*np.random.rand(1)))
-    pattern = np.zeros((rows, cols));
-    for row in range(rows):
-        for col in range(cols):
-            dy = row - center_row;
-            dx = col - center_col;
-            pattern[row,col] = (minI + (maxI -minI) 
-                                * math.exp(-(.5)*(dx*dx + dy*dy)/ radius))
-    return pattern
-
-
-def augment_image(img, crop_max=5, rotate_max=30, do_illum=.5):
+        radius = float(int(20000 + (30000)*rng.rand(1)))
+    dy = np.arange(rows, dtype=np.float32) - center_row
+    dx = np.arange(cols, dtype=np.float32) - center_col
+    #the gaussian is separable, so only a row and a column need exp
+    pattern = (np.exp(-.5*dy*dy/radius)[:, np.newaxis] *
+               np.exp(-.5*dx*dx/radius)[np.newaxis, :])
+    return minI + (maxI - minI)*pattern
+
+
+def augment_image(img, crop_max=5, rotate_max=30, do_illum=.5, rng=np.random):
     '''
     Alters an image with some common data augmentation techniques
        
     Imput parameters:
-        img: (ndarray) the image
+        img: (ndarray) the image, uint8 or float32. The "cropped" borders
+             are zeroed in place, unless img is read only, i.e. from a
+             TargetImageCache, then a copy is changed.
 
         crop_max (optional): (int) max length that can be "cropped" from 
                              each side. Cropping does not change image shape,
@@ -159,12 +447,17 @@ def augment_image(img, crop_max=5, rotate_max=30, do_illum=.5):
         do_illum (optional): (float) chance that a random illumination
                              change will be applied. Set to 0 if no 
                              illumination change is desired. Default: .5 
+        rng (optional): (np.random.RandomState) source of randomness, pass
+                        a seeded one for reproducible augmentation.
+                        Default: np.random
 
     Returns:
-        (ndarray) the augmented image
+        (ndarray) the augmented image, float32 if the illumination was changed
     '''
     #crop
-    crops = np.random.choice(crop_max,4)   
+    if not img.flags.writeable:
+        img = img.copy()
+    crops = rng.choice(crop_max,4)   
     start_row = 0 + crops[0]
     end_row = img.shape[0] - crops[1] 
     start_col = 0 + crops[2]
@@ -175,22 +468,132 @@ def augment_image(img, crop_max=5, rotate_max=30, do_illum=.5):
     img[:,end_col:,:] = 0
 
     #rotate
-    rot_angle = np.random.choice(rotate_max*2,1) - rotate_max
+    rot_angle = float(rng.choice(rotate_max*2,1)[0] - rotate_max)
     M = cv2.getRotationMatrix2D((img.shape[1]/2,img.shape[0]/2),rot_angle,1)
     img = cv2.warpAffine(img,M,(img.shape[1],img.shape[0]))
 
 
     #change illumination
-    if np.random.rand() < do_illum:
+    if rng.rand() < do_illum:
         max_side = max(img.shape[:2])
-        xc,yc = np.random.choice(max_side,2)
-        pattern = create_illumination_pattern(max_side,max_side,xc,yc)
-        pattern = pattern[0:img.shape[0],0:img.shape[1]]
-        img = img* np.tile(np.expand_dims(pattern,2),(1,1,3)) 
+        xc,yc = rng.choice(max_side,2)
+        #only the part of the max_side x max_side pattern that is used
+        pattern = create_illumination_pattern(img.shape[0],img.shape[1],
+                                              xc,yc,rng=rng)
+        img = img * pattern[:, :, np.newaxis]
 
     return img
 
 
+def crop_scene_image(img, gt_boxes, crop_size, rng=np.random,
+                     min_visible=.5):
+    '''
+    Crops a fixed size window from a training scene image
+
+    If targets are present (label != 0), the window holds the boxes of
+    all of them at a random position. Along a side where they do not fit
+    together, the window holds the box of the first one instead, or is
+    centered on it if the box does not fit either. Otherwise the window is
+    anywhere in the image. Boxes of present targets are shifted into the
+    window and clipped to it, so the crop can be used as the whole image,
+    i.e. for img_info in proposal_layer and anchor_target_layer. Other
+    present targets with less than min_visible of their box in the window
+    are dropped, as their visible pixels would be trained on as background.
+
+    Input parameters:
+        img: (ndarray) HxWxC scene image
+        gt_boxes: (ndarray) Nx5 boxes, x1,y1,x2,y2,label, one for each
+                  target, background targets have the dummy box
+        crop_size: (tuple of int) (rows, cols) of the window, it is made
+                   smaller if the image is
+
+        rng (optional): (np.random.RandomState) source of randomness.
+                        Default: np.random
+        min_visible (optional): (float) fraction of the box area of a
+                                present target that must be in the window
+                                to keep it. Default: .5
+
+    Returns:
+        (ndarray) the cropped image, a view of img
+        (ndarray) the boxes in the cropped image, of the kept targets
+        (ndarray) indices of the kept targets in gt_boxes
+    '''
+    rows = min(crop_size[0], img.shape[0])
+    cols = min(crop_size[1], img.shape[1])
+    present = np.flatnonzero(gt_boxes[:,4] != 0)
+    keep = np.arange(gt_boxes.shape[0])
+    if present.shape[0] == 0:
+        row = rng.randint(img.shape[0] - rows + 1)
+        col = rng.randint(img.shape[1] - cols + 1)
+        return img[row:row+rows, col:col+cols], gt_boxes, keep
+
+    box = gt_boxes[present[0]]
+    all_box = np.concatenate((gt_boxes[present,:2].min(0),
+                              gt_boxes[present,2:4].max(0)))
+    if _fits_window(all_box[1], all_box[3], rows):
+        row = _get_window_start(all_box[1], all_box[3], rows, img.shape[0], rng)
+    else:
+        row = _get_window_start(box[1], box[3], rows, img.shape[0], rng)
+    if _fits_window(all_box[0], all_box[2], cols):
+        col = _get_window_start(all_box[0], all_box[2], cols, img.shape[1], rng)
+    else:
+        col = _get_window_start(box[0], box[2], cols, img.shape[1], rng)
+    gt_boxes = gt_boxes.copy()
+    boxes = gt_boxes[present,:4] - [col, row, col, row]
+    areas = (boxes[:,2] - boxes[:,0] + 1) * (boxes[:,3] - boxes[:,1] + 1)
+    visible = (np.maximum(np.minimum(boxes[:,2], cols - 1) -
+                          np.maximum(boxes[:,0], 0) + 1, 0) *
+               np.maximum(np.minimum(boxes[:,3], rows - 1) -
+                          np.maximum(boxes[:,1], 0) + 1, 0))
+    boxes[:,[0,2]] = np.clip(boxes[:,[0,2]], 0, cols - 1)
+    boxes[:,[1,3]] = np.clip(boxes[:,[1,3]], 0, rows - 1)
+    gt_boxes[present,:4] = boxes
+    #the window is placed on the first target, so it is always kept
+    dropped = present[1:][visible[1:] < min_visible * areas[1:]]
+    keep = np.setdiff1d(keep, dropped)
+    return img[row:row+rows, col:col+cols], gt_boxes[keep], keep
+
+
+def _fits_window(box_start, box_end, window):
+    return int(np.ceil(box_end)) - int(box_start) + 1 <= window
+
+
+def _get_window_start(box_start, box_end, window, size, rng):
+    #first and last window start that holds the whole (inclusive) box
+    first = max(0, int(np.ceil(box_end)) - window + 1)
+    last = min(int(box_start), size - window)
+    if first <= last:
+        return rng.randint(first, last + 1)
+    center = int((box_start + box_end + 1)/2 - window/2)
+    return min(max(center, 0), size - window)
+
+
+def augment_images(img_list, augment_prob, crop_max=5, rotate_max=30,
+                   do_illum=.5, rng=np.random):
+    '''
+    Augments a batch of images, i.e. all target images of a training step
+
+    All random decisions are made from rng, so a seeded RandomState gives
+    the same augmentation for the same batches.
+
+    Input parameters:
+        img_list: (list of ndarray) the images, uint8 or float32. Writeable
+                  images are changed in place, see augment_image
+        augment_prob: (float) chance that each image is augmented
+
+        crop_max, rotate_max, do_illum (optional): see augment_image
+        rng (optional): (np.random.RandomState) source of randomness.
+                        Default: np.random
+
+    Returns:
+        (list of ndarray) the images, augmented or not
+    '''
+    do_augment = rng.rand(len(img_list)) < augment_prob
+    return [augment_image(img, crop_max=crop_max, rotate_max=rotate_max,
+                          do_illum=do_illum, rng=rng) if augment else img
+            for img, augment in zip(img_list, do_augment)]
+
+
 
 def check_object_ids(chosen_ids,id_to_name,target_images):
     """
@@ -235,14 +638,96 @@ def normalize_image(img,cfg):
         cfg: (Config) config instance from configs/
 
     Returns: 
-        (ndarray) noralized image
+        (ndarray) noralized float32 image
+    """
+    return ImageNormalizer(cfg)([img])[0]
+
+
+def get_normalization(cfg):
+    """
+    Returns the scale and offset that normalize a [0,255] image for cfg
+
+    normalized = img*scale + offset is the same as 
+    (img/255 - mean)/std, with one multiply and one add.
+
+    Returns:
+        scale: (ndarray) float32, one for each channel
+        offset: (ndarray) float32, one for each channel
     """
     if cfg.PYTORCH_FEATURE_NET:
-        return ((img/255.0) - [0.485, 0.456, 0.406])/[0.229, 0.224, 0.225]
+        mean = np.array([0.485, 0.456, 0.406])
+        std = np.array([0.229, 0.224, 0.225])
+        return ((1/(255.0*std)).astype(np.float32),
+                (-mean/std).astype(np.float32))
     else:
         raise NotImplementedError
 
 
+class ImageNormalizer(object):
+    """
+    Normalizes and stacks uint8 images into float32 batch buffers.
+
+    Each image is converted and normalized straight into its place in the
+    zero padded batch, so images stay uint8 until then and there are no
+    float64 or per image temporaries. Like normalize_image followed by 
+    match_and_concat_images_list, padding is 0 after normalization.
+
+    Batches made with a buffer name reuse the memory of the previous batch
+    with that name, so they are only valid until the next such call. 
+    
+    ex) normalizer = ImageNormalizer(cfg)
+        im_data = normalizer([img1, img2], buffer_name='scene')
+
+    Input parameters:
+        cfg: (Config) config instance from configs/
+    """
+
+    def __init__(self, cfg):
+        self.scale, self.offset = get_normalization(cfg)
+        self._buffers = {}
+
+    def __call__(self, img_list, min_size=None, buffer_name=None):
+        """
+        Input parameters:
+            img_list: (list of ndarray) HxWxC images with values in [0,255],
+                      uint8 or float32
+
+            min_size (optional): (int) see match_and_concat_images_list.
+                                 Default: None
+            buffer_name (optional): (str) reuse the buffer with this name,
+                                    if None a new one is made.
+                                    Default: None
+
+        Returns:
+            (ndarray) NxHxWxC float32 normalized images
+        """
+        max_rows, max_cols = get_padded_size(img_list, min_size)
+        shape = (len(img_list), max_rows, max_cols, img_list[0].shape[2])
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(buffer_name)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty((size,), dtype=np.float32)
+            if buffer_name is not None:
+                self._buffers[buffer_name] = buffer
+        batch = buffer[:size].reshape(shape)
+
+        #work on whole rows of pixels, numpy is slow at broadcasting 
+        #over a last axis of only 3 channels
+        row_batch = batch.reshape(shape[0], shape[1], -1)
+        scale = np.tile(self.scale, max_cols)
+        offset = np.tile(self.offset, max_cols)
+        for ind, img in enumerate(img_list):
+            rows = img.shape[0]
+            width = img.shape[1] * img.shape[2]
+            out = row_batch[ind, :rows, :width]
+            out[...] = img.reshape(rows, width)
+            out *= scale[:width]
+            out += offset[:width]
+            row_batch[ind, rows:] = 0
+            row_batch[ind, :rows, width:] = 0
+        return batch
+
+
 
 
 
@@ -319,6 +804,450 @@ def get_AVD_dataset(root, scene_list, chosen_ids,
     return dataset
 
 
+def get_dataset_key(root, scene_list, chosen_ids, max_difficulty, *extra):
+    """
+    Returns a str that names the AVD dataset from get_AVD_dataset with 
+    these arguments, and anything in extra, i.e. for naming caches
+
+    The key includes the absolute root and the mtime and size of the
+    annotation files of each scene, so a changed root or edited annotations
+    give a new key instead of a stale cache.
+    """
+    fnames = [os.path.join(root, 'instance_id_map.txt')]
+    fnames += [os.path.join(root, scene, 'annotations.json')
+               for scene in sorted(scene_list)]
+    fingerprint = []
+    for fname in fnames:
+        if os.path.isfile(fname):
+            stat = os.stat(fname)
+            fingerprint.append([fname, stat.st_mtime, stat.st_size])
+    return hashlib.md5(json.dumps([os.path.abspath(root),
+                                   sorted(scene_list),
+                                   sorted(int(i) for i in chosen_ids),
+                                   max_difficulty, fingerprint] + list(extra)
+                                  ).encode()
+                       ).hexdigest()
+
+
+class TDIDTrainSet(torch.utils.data.Dataset):
+    """
+    Wraps an AVD dataset to give complete TDID training samples.
+
+    Each scene image is maybe resized, and paired with a randomly chosen
+    target object. Its gt boxes are replaced by the box of that object, or
+    a dummy background box if the object is not present. If
+    cfg.TRAIN_CROP_SIZE is set, only a window around the target box, or
+    anywhere if it is not present, is kept, see crop_scene_image. With
+    cfg.TARGETS_PER_SCENE > 1
+    each scene is paired with several targets instead, see pick_targets.
+    One image of each
+    target type of the object is read, shrunk to cfg.TARGET_MAX_SIDE and
+    maybe augmented. collate then normalizes and pads the images into
+    float32 batches with an ImageNormalizer, target images in buckets of
+    similar size. All of this runs in the DataLoader workers instead of
+    the training loop.
+
+    If feature_map_size is given, collate also computes the anchor labels
+    and box regression targets for the batch.
+
+    ex) train_set = TDIDTrainSet(get_AVD_dataset(...), train_ids,
+                                 target_images, cfg)
+        loader = torch.utils.data.DataLoader(train_set,
+                                        collate_fn=train_set.collate,
+                                        worker_init_fn=train_set.seed_worker)
+
+    Input parameters:
+        dataset: (AVD) the scene images, i.e. from get_AVD_dataset
+        train_ids: (list of int) ids of objects that can be targets
+        target_images: (dict) paths to target images, from get_target_images
+        cfg: (Config) a config instance from configs/
+
+        feature_map_size (optional): (FeatureMapSize) gives the size of the
+                                     network score map for an image size. If
+                                     None anchor targets are not computed.
+                                     Default: None
+        feat_stride (optional): (int) scaling factor between the score map
+                                and the image. Default: 16
+        seed (optional): (int) seed for all random choices made in the main
+                         process. Workers are seeded by seed_worker.
+                         Default: None
+        target_cache (optional): (TargetImageCache or TargetCatalog) decoded
+                                 target images, not normalized. If None
+                                 images are read from disk every time.
+                                 Default: None
+    """
+
+    def __init__(self, dataset, train_ids, target_images, cfg,
+                 feature_map_size=None, feat_stride=16, seed=None,
+                 target_cache=None):
+        self.dataset = dataset
+        self.train_ids = np.asarray(train_ids)
+        self.target_images = target_images
+        self.cfg = cfg
+        self.feature_map_size = feature_map_size
+        self.feat_stride = feat_stride
+        self.rng = np.random.RandomState(seed)
+        if target_cache is not None and target_cache.normalized:
+            raise ValueError('Target images are augmented before they are '
+                             'normalized, use a catalog of uint8 images')
+        self.target_cache = target_cache
+        self.normalizer = ImageNormalizer(cfg)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        """
+        Returns:
+            im_data: (ndarray) the uint8 scene image
+            target_data: (list of ndarray) target images, one for each 
+                         target type of each target, uint8 or float32 if
+                         augmented
+            gt_boxes: (ndarray) Kx5 box of each of the K targets, last
+                      column is 1 if the target is present and 0 if not
+            target_inds: (list of int) ids of the chosen target objects
+        """
+        cfg = self.cfg
+        rng = self.rng
+        im_data, labels = self.dataset[index]
+        gt_boxes = np.asarray(labels[0], dtype=np.float32)
+
+        if rng.rand() < cfg.RESIZE_IMG:
+            im_data = cv2.resize(im_data, (0,0), fx=cfg.RESIZE_IMG_FACTOR,
+                                 fy=cfg.RESIZE_IMG_FACTOR)
+            if gt_boxes.shape[0] > 0:
+                gt_boxes[:,:4] *= cfg.RESIZE_IMG_FACTOR
+
+        target_inds, gt_boxes = self.choose_targets(gt_boxes)
+
+        if cfg.TRAIN_CROP_SIZE is not None:
+            im_data, gt_boxes, keep = crop_scene_image(im_data, gt_boxes,
+                                                 cfg.TRAIN_CROP_SIZE, rng=rng)
+            target_inds = [target_inds[ind] for ind in keep]
+
+        #get target images
+        imread = cv2.imread
+        if self.target_cache is not None:
+            imread = self.target_cache.get
+        target_data = []
+        for target_path in self.choose_target_images(target_inds):
+            target_data.append(limit_image_size(imread(target_path),
+                                                cfg.TARGET_MAX_SIDE))
+        target_data = augment_images(target_data, cfg.AUGMENT_TARGET_IMAGES,
+                                     do_illum=cfg.AUGMENT_TARGET_ILLUMINATION,
+                                     rng=rng)
+
+        return im_data, target_data, gt_boxes, target_inds
+
+    def choose_targets(self, gt_boxes):
+        """
+        Picks the target object(s) for a scene, and their gt boxes
+
+        Input parameters:
+            gt_boxes: (ndarray) Nx6 boxes of all objects in the scene
+
+        Returns:
+            target_inds: (list of int) ids of the chosen target objects
+            gt_boxes: (ndarray) Kx5 box of each target, the dummy box
+                      [0,0,1,1,0] for absent targets
+        """
+        cfg = self.cfg
+        rng = self.rng
+
+        #if there are no boxes for this image, add a dummy background box
+        if gt_boxes.shape[0] == 0:
+            gt_boxes = np.asarray([[0,0,1,1,0]], dtype=np.float32)
+
+        objects_present = gt_boxes[:,4]
+        objects_present = objects_present[objects_present != 0]
+        not_present = self.train_ids[np.logical_not(
+                                      np.in1d(self.train_ids, objects_present))]
+        not_present = not_present[not_present != 0]
+
+        #pick a target
+        if cfg.TARGETS_PER_SCENE > 1:
+            target_inds, gt_boxes = self.pick_targets(gt_boxes,
+                                                      objects_present,
+                                                      not_present)
+        elif ((rng.rand() < cfg.CHOOSE_PRESENT_TARGET or
+                not_present.shape[0]==0) and
+                objects_present.shape[0]!=0):
+            target_inds = [int(rng.choice(objects_present))]
+            gt_boxes = gt_boxes[gt_boxes[:,4]==target_inds[0], :-1]
+            gt_boxes[0,4] = 1
+        else:#the target is not in the image, give a dummy background box
+            target_inds = [int(rng.choice(not_present))]
+            gt_boxes = np.asarray([[0,0,1,1,0]], dtype=np.float32)
+        return target_inds, gt_boxes
+
+    def choose_target_images(self, target_inds):
+        """
+        Returns a random path to an image of each type of each target
+        """
+        return [type_paths[self.rng.choice(len(type_paths))]
+                for target_ind in target_inds
+                for type_paths in self.target_images[
+                                          self.cfg.ID_TO_NAME[target_ind]]]
+
+    def pick_targets(self, gt_boxes, objects_present, not_present):
+        """
+        Picks up to cfg.TARGETS_PER_SCENE targets for one scene
+
+        All present objects come first, in random order, up to
+        cfg.TARGETS_PER_SCENE of them. Random absent objects fill the rest.
+        CHOOSE_PRESENT_TARGET is not used. With cfg.TRAIN_CROP_SIZE,
+        present targets mostly outside the crop are dropped later, see
+        crop_scene_image.
+
+        Input parameters:
+            gt_boxes: (ndarray) Nx5 boxes of all objects in the scene
+            objects_present: (ndarray) ids of objects in the scene
+            not_present: (ndarray) ids of train objects not in the scene
+
+        Returns:
+            target_inds: (list of int) ids of the chosen targets
+            gt_boxes: (ndarray) Kx5 box of each target, the dummy box
+                      [0,0,1,1,0] for absent targets
+        """
+        num_targets = self.cfg.TARGETS_PER_SCENE
+        present = self.rng.permutation(np.unique(objects_present))
+        present = present[:num_targets].astype(np.int64)
+        num_absent = min(num_targets - present.shape[0], not_present.shape[0])
+        absent = self.rng.choice(not_present, num_absent, replace=False)
+
+        target_boxes = np.zeros((present.shape[0] + num_absent, 5),
+                                dtype=np.float32)
+        target_boxes[:] = [0,0,1,1,0]
+        for ind, target_ind in enumerate(present):
+            target_boxes[ind,:4] = gt_boxes[gt_boxes[:,4]==target_ind][0,:4]
+            target_boxes[ind,4] = 1
+        return [int(t) for t in present] + [int(t) for t in absent], target_boxes
+
+    def collate(self, batch):
+        """
+        Stacks a list of samples into a batch
+
+        Image batches are new arrays each time, not normalizer buffers,
+        since a worker may still be sending a batch when it makes the next.
+
+        Input parameters:
+            batch: (list) outputs of __getitem__
+
+        Returns:
+            im_data: (ndarray) BxHxWx3 normalized, zero padded float32 scene
+                     images
+            target_data: (list of tuple) the P*T target images, in buckets
+                         of similar size, see group_images_by_size. Each
+                         bucket is (ndarray) nxhxwx3 normalized, zero padded
+                         float32 images, and (ndarray) their indices in the
+                         batch, where the T target images of each 
+                         scene/target pairing are next to each other
+            gt_boxes: (ndarray) Px5 gt boxes, one for each of the P 
+                      scene/target pairings
+            target_inds: (list of int) id of the target of each pairing
+            anchor_data: (tuple of ndarray) output of anchor_target_layer,
+                         None if feature_map_size was not given
+            target_padding: (float) padded target pixels over target image
+                            pixels, minus 1
+            scene_inds: (ndarray) index of the scene image of each pairing
+        """
+        im_data = self.normalizer([sample[0] for sample in batch])
+        target_imgs = [img for sample in batch for img in sample[1]]
+        buckets = group_images_by_size(target_imgs,
+                                       self.cfg.TARGET_BUCKET_MAX_PADDING,
+                                       min_size=self.cfg.MIN_TARGET_SIZE)
+        target_data = []
+        padded_pixels = 0
+        for bucket in buckets:
+            bucket_data = self.normalizer([target_imgs[i] for i in bucket],
+                                  min_size=self.cfg.MIN_TARGET_SIZE)
+            padded_pixels += np.prod(bucket_data.shape[:3])
+            target_data.append((bucket_data, bucket))
+        target_padding = float(padded_pixels) / sum(
+                           img.shape[0]*img.shape[1] for img in target_imgs) - 1
+        gt_boxes = np.concatenate([sample[2] for sample in batch], 0)
+        target_inds = [ind for sample in batch for ind in sample[3]]
+        scene_inds = np.repeat(np.arange(len(batch)),
+                               [len(sample[3]) for sample in batch])
+
+        anchor_data = None
+        if self.feature_map_size is not None:
+            height, width = self.feature_map_size(im_data.shape[1],
+                                                  im_data.shape[2])
+            num_anchors = 3 * len(self.cfg.ANCHOR_SCALES)
+            score_shape = (gt_boxes.shape[0], 2 * num_anchors, height, width)
+            anchor_data = anchor_target_layer(score_shape, gt_boxes,
+                                              im_data.shape[1:], self.cfg,
+                                              self.feat_stride,
+                                              self.cfg.ANCHOR_SCALES)
+        return (im_data, target_data, gt_boxes, target_inds, anchor_data,
+                target_padding, scene_inds)
+
+    def seed_worker(self, worker_id):
+        """
+        Reseeds random choices in a DataLoader worker.
+
+        Workers are forked with a copy of the same random state, so without
+        this they would all make the same random choices. Seeds come from
+        torch, so they differ for every worker and epoch, and are
+        reproducible if torch is seeded.
+
+        Input parameters:
+            worker_id: (int) given by the DataLoader
+        """
+        seed = torch.initial_seed() % 2**32
+        np.random.seed(seed)
+        self.rng.seed(seed)
+
+
+class TDIDFeatureTrainSet(TDIDTrainSet):
+    """
+    Gives TDID training samples made of precomputed backbone features.
+
+    For training only the head of a network with a frozen backbone. Scenes
+    and their boxes come from a SceneFeatureBank, targets are picked as in
+    TDIDTrainSet, and target features come from a TargetFeatureBank. No
+    images are read. The resize factor of each scene is one of the stored
+    ones, scenes are not cropped and targets are not augmented.
+
+    ex) train_set = TDIDFeatureTrainSet(scene_bank, dataset_key, target_bank,
+                                        train_ids, target_images, cfg)
+        net(target_data, im_data, im_info, features_given=True, ...)
+
+    Input parameters:
+        scene_bank: (SceneFeatureBank) holds features of every scene in
+                    the dataset, at scale 1 and cfg.RESIZE_IMG_FACTOR if 
+                    cfg.RESIZE_IMG > 0
+        dataset_key: (str) the dataset given to scene_bank.update
+        target_bank: (TargetFeatureBank) features of the target images,
+                     updated with target_images
+        train_ids: (list of int) ids of objects that can be targets
+        target_images: (dict) paths to target images, from get_target_images
+        cfg: (Config) a config instance from configs/
+
+        feat_stride (optional): (int) scaling factor between the score map
+                                and the image. Default: 16
+        fraction_of_no_box (optional): (float) if given, only this
+                                       fraction of scenes without boxes is
+                                       used, picked at random. If None all
+                                       scenes are used. Default: None
+        seed (optional): (int) seed for all random choices made in the main
+                         process. Workers are seeded by seed_worker.
+                         Default: None
+    """
+
+    def __init__(self, scene_bank, dataset_key, target_bank, train_ids,
+                 target_images, cfg, feat_stride=16, fraction_of_no_box=None,
+                 seed=None):
+        if cfg.TRAIN_CROP_SIZE is not None:
+            raise ValueError('Scene features can not be cropped, set '
+                             'TRAIN_CROP_SIZE to None')
+        self.scene_bank = scene_bank
+        self.target_bank = target_bank
+        self.train_ids = np.asarray(train_ids)
+        self.target_images = target_images
+        self.cfg = cfg
+        self.feat_stride = feat_stride
+        self.rng = np.random.RandomState(seed)
+
+        self.labels = scene_bank.get_labels(dataset_key)
+        self.image_names = sorted(self.labels.keys())
+        if fraction_of_no_box is not None:
+            has_box = np.array([len(self.labels[name]) > 0
+                                for name in self.image_names], dtype=np.bool_)
+            no_box_inds = np.flatnonzero(~has_box)
+            keep = has_box
+            keep[self.rng.choice(no_box_inds,
+                                 int(fraction_of_no_box * no_box_inds.size),
+                                 replace=False)] = True
+            self.image_names = [name for name, k in zip(self.image_names, keep)
+                                if k]
+
+    def __len__(self):
+        return len(self.image_names)
+
+    def __getitem__(self, index):
+        """
+        Returns:
+            im_data: (ndarray) CxHxW float16 scene features
+            target_data: (ndarray) NxCxhxw float32 target features, one for
+                         each target type of each target
+            gt_boxes: (ndarray) Kx5 box of each of the K targets, last
+                      column is 1 if the target is present and 0 if not
+            target_inds: (list of int) ids of the chosen target objects
+            img_shape: (list) shape of the resized scene image
+        """
+        cfg = self.cfg
+        name = self.image_names[index]
+        gt_boxes = np.asarray(self.labels[name], dtype=np.float32)
+        gt_boxes = gt_boxes.reshape(-1, 6)
+
+        scale = 1
+        if self.rng.rand() < cfg.RESIZE_IMG:
+            scale = cfg.RESIZE_IMG_FACTOR
+            gt_boxes[:,:4] *= scale
+        im_data, img_shape = self.scene_bank.get(name, scale)
+
+        target_inds, gt_boxes = self.choose_targets(gt_boxes)
+        target_data = self.target_bank.lookup(
+                                       self.choose_target_images(target_inds))
+        return im_data, target_data, gt_boxes, target_inds, img_shape
+
+    def collate(self, batch):
+        """
+        Stacks a list of samples into a batch
+
+        Input parameters:
+            batch: (list) outputs of __getitem__
+
+        Returns:
+            im_data: (ndarray) BxCxHxW zero padded float32 scene features
+            target_data: (ndarray) (P*T)xCxhxw zero padded float32 target
+                         features, the T of each scene/target pairing next
+                         to each other
+            gt_boxes: (ndarray) Px5 gt boxes, one for each of the P 
+                      scene/target pairings
+            target_inds: (list of int) id of the target of each pairing
+            anchor_data: (tuple of ndarray) output of anchor_target_layer
+            im_info: (tuple) shape of the largest scene image in the batch
+            scene_inds: (ndarray) index of the scene features of each pairing
+        """
+        im_data = np.zeros((len(batch), batch[0][0].shape[0],
+                            max(sample[0].shape[1] for sample in batch),
+                            max(sample[0].shape[2] for sample in batch)),
+                           dtype=np.float32)
+        for ind, sample in enumerate(batch):
+            im_data[ind, :, :sample[0].shape[1], :sample[0].shape[2]] = \
+                                                                     sample[0]
+        target_data = np.zeros((sum(sample[1].shape[0] for sample in batch),
+                                batch[0][1].shape[1],
+                                max(sample[1].shape[2] for sample in batch),
+                                max(sample[1].shape[3] for sample in batch)),
+                               dtype=np.float32)
+        start = 0
+        for sample in batch:
+            features = sample[1]
+            target_data[start:start + features.shape[0], :,
+                        :features.shape[2], :features.shape[3]] = features
+            start += features.shape[0]
+        im_info = (max(sample[4][0] for sample in batch),
+                   max(sample[4][1] for sample in batch), 3)
+        gt_boxes = np.concatenate([sample[2] for sample in batch], 0)
+        target_inds = [ind for sample in batch for ind in sample[3]]
+        scene_inds = np.repeat(np.arange(len(batch)),
+                               [len(sample[3]) for sample in batch])
+
+        num_anchors = 3 * len(self.cfg.ANCHOR_SCALES)
+        score_shape = (gt_boxes.shape[0], 2 * num_anchors,
+                       im_data.shape[2], im_data.shape[3])
+        anchor_data = anchor_target_layer(score_shape, gt_boxes, im_info,
+                                          self.cfg, self.feat_stride,
+                                          self.cfg.ANCHOR_SCALES)
+        return (im_data, target_data, gt_boxes, target_inds, anchor_data,
+                im_info, scene_inds)
+
+
+
 
 
 
@@ -491,6 +1420,23 @@ def load_net(fname, net):
         v.copy_(param)
 
 
+def get_weights_hash(net):
+    '''
+    Gets a hash of a network's weights
+
+    Input parameters:
+        net: (torch.nn.Module) network to hash
+
+    Returns:
+        (str) hex digest that changes whenever any weight changes
+    '''
+    weights_hash = hashlib.sha1()
+    for k, v in net.state_dict().items():
+        weights_hash.update(k.encode('utf-8'))
+        weights_hash.update(np.ascontiguousarray(v.cpu().numpy()).tobytes())
+    return weights_hash.hexdigest()
+
+
 def np_to_variable(np_var, is_cuda=True, dtype=torch.FloatTensor):
     '''
     Converts numpy array to pytorch Variable
@@ -578,3 +1524,294 @@ def get_best_moves_dict(AVD_ROOT, scenes_list):
 
     return all_best_moves
 
+
+
+class TargetFeatureBank(object):
+    '''
+    On-disk store of backbone features for target images.
+
+    Features are stored once per target image file, in a directory for each
+    backbone and set of backbone weights, and are loaded memory-mapped. 
+    Only target images not yet in the bank are run through the network.
+    If cfg.CORR_WITH_POOLED, only the pooled 1x1 features are stored.
+    Target images are shrunk to cfg.TARGET_MAX_SIDE first.
+
+    Each target image is run through the backbone on its own, so unlike 
+    stacking target images with match_and_concat_images_list, no image 
+    padding ends up in the features. 
+
+    Input parameters:
+        bank_dir: (str) directory that holds all banks
+        net: (TDID) the network, net.features is used to compute features
+        cfg: (Config) a config instance from configs/
+    '''
+    def __init__(self, bank_dir, net, cfg):
+        self.net = net
+        self.cfg = cfg
+        self.bank_path = os.path.join(bank_dir, '{}_{}_{}'.format(
+                                    cfg.FEATURE_NET_NAME,
+                                    'pooled' if cfg.CORR_WITH_POOLED else 'full',
+                                    get_weights_hash(net.features)))
+        if cfg.TARGET_MAX_SIDE is not None:
+            #features of shrunk targets are kept apart
+            self.bank_path += '_max{}'.format(cfg.TARGET_MAX_SIDE)
+        if not os.path.isdir(self.bank_path):
+            os.makedirs(self.bank_path)
+        self.index_file = os.path.join(self.bank_path, 'index.json')
+        self.data_file = os.path.join(self.bank_path, 'features.bin')
+
+        self.index = {}
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.index = json.load(f)
+        self._data = None
+
+    def __getstate__(self):
+        #workers only read the bank, see lookup, and map the file again
+        state = self.__dict__.copy()
+        state['net'] = None
+        state['_data'] = None
+        return state
+
+    def update(self, target_images):
+        '''
+        Adds all target images that are missing or changed to the bank
+
+        Input parameters:
+            target_images: (dict) paths to images, as returned from 
+                           get_target_images 
+        '''
+        img_paths = [img_path for type_lists in target_images.values()
+                              for type_list in type_lists
+                              for img_path in type_list]
+        self.add([p for p in img_paths if not self.contains(p)])
+
+    def contains(self, img_path):
+        '''
+        Returns True if the bank has up to date features for the image
+        '''
+        entry = self.index.get(self._get_key(img_path))
+        if entry is None:
+            return False
+        stat = os.stat(img_path)
+        return (entry['mtime'] == stat.st_mtime and 
+                entry['size'] == stat.st_size)
+
+    def add(self, img_paths):
+        '''
+        Computes features for target images and appends them to the bank
+
+        Input parameters:
+            img_paths: (list) full paths to target images
+        '''
+        if len(img_paths) == 0:
+            return
+        if self.net is None:
+            raise ValueError('A bank without its network can not compute '
+                             'features, update it in the main process')
+        with open(self.data_file, 'ab') as f:
+            for img_path in img_paths:
+                img = limit_image_size(cv2.imread(img_path),
+                                       self.cfg.TARGET_MAX_SIDE)
+                img = normalize_image(img, self.cfg)
+                img = np_to_variable(np.expand_dims(img, 0), is_cuda=True)
+                features = self.net.features(img.permute(0, 3, 1, 2))
+                if self.cfg.CORR_WITH_POOLED:
+                    features = F.max_pool2d(features, features.size()[2:])
+                features = features.data.cpu().numpy()[0].astype(np.float32)
+
+                stat = os.stat(img_path)
+                self.index[self._get_key(img_path)] = {
+                                           'offset': f.tell(),
+                                           'shape': list(features.shape),
+                                           'mtime': stat.st_mtime,
+                                           'size': stat.st_size}
+                f.write(features.tobytes())
+
+        #write to a temp file first so readers never see a partial index 
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.rename(self.index_file + '.tmp', self.index_file)
+        self._data = None
+
+    def get_features(self, img_paths):
+        '''
+        Gets features of target images, computing any that are missing
+
+        Input parameters:
+            img_paths: (list) full paths to target images
+
+        Returns:
+            (ndarray) see lookup
+        '''
+        self.add([p for p in img_paths if not self.contains(p)])
+        return self.lookup(img_paths)
+
+    def lookup(self, img_paths):
+        '''
+        Gets features of target images that are in the bank
+
+        Images are not checked for changes and nothing is computed, so
+        DataLoader workers can use this once update ran in the main process.
+
+        Input parameters:
+            img_paths: (list) full paths to target images
+
+        Returns:
+            (ndarray) NxCxHxW float32 features, one for each image. Feature 
+            maps smaller than the largest one are zero padded.
+        '''
+        if self._data is None:
+            self._data = np.memmap(self.data_file, dtype=np.float32, mode='r')
+
+        all_features = []
+        for img_path in img_paths:
+            entry = self.index[self._get_key(img_path)]
+            start = entry['offset'] // 4
+            count = int(np.prod(entry['shape']))
+            all_features.append(self._data[start:start+count].reshape(
+                                                               entry['shape']))
+
+        max_rows = max(features.shape[1] for features in all_features)
+        max_cols = max(features.shape[2] for features in all_features)
+        stacked = np.zeros((len(all_features), all_features[0].shape[0],
+                            max_rows, max_cols), dtype=np.float32)
+        for ind, features in enumerate(all_features):
+            stacked[ind, :, :features.shape[1], :features.shape[2]] = features
+        return stacked
+
+    def _get_key(self, img_path):
+        return os.path.relpath(img_path, self.cfg.TARGET_IMAGE_DIR)
+
+
+class SceneFeatureBank(object):
+    '''
+    On-disk store of backbone features for scene images.
+
+    Like TargetFeatureBank, but for the scene images of AVD datasets, so a
+    network with a frozen backbone can train its head without running the
+    backbone. Features of each scene image are stored once for each resize
+    factor, as float16, and are loaded memory-mapped. The boxes of each
+    dataset are stored with them, so no images are read once a dataset is
+    in the bank.
+
+    ex) bank = SceneFeatureBank(cfg.SCENE_FEATURE_BANK_DIR, net, cfg)
+        bank.update(get_AVD_dataset(...), dataset_key, scales=[1, .5])
+        features, img_shape = bank.get(image_name, .5)
+
+    Input parameters:
+        bank_dir: (str) directory that holds all banks
+        net: (TDID) the network, net.features is used to compute features
+        cfg: (Config) a config instance from configs/
+    '''
+    def __init__(self, bank_dir, net, cfg):
+        self.net = net
+        self.cfg = cfg
+        self.bank_path = os.path.join(bank_dir, '{}_{}_scenes'.format(
+                                    cfg.FEATURE_NET_NAME,
+                                    get_weights_hash(net.features)))
+        if not os.path.isdir(self.bank_path):
+            os.makedirs(self.bank_path)
+        self.index_file = os.path.join(self.bank_path, 'index.json')
+        self.data_file = os.path.join(self.bank_path, 'features.bin')
+
+        self.index = {'features': {}, 'datasets': {}}
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.index = json.load(f)
+        self._data = None
+
+    def __getstate__(self):
+        #workers only read the bank, and map the file again
+        state = self.__dict__.copy()
+        state['net'] = None
+        state['_data'] = None
+        return state
+
+    def update(self, dataset, dataset_key, scales=(1,)):
+        '''
+        Adds the boxes and any missing features of a dataset to the bank
+
+        Input parameters:
+            dataset: (AVD) gives (image, [boxes, image_name]) samples, i.e.
+                     from get_AVD_dataset
+            dataset_key: (str) names the dataset, i.e. from get_dataset_key.
+                         Datasets already in the bank are skipped.
+
+            scales (optional): (list of float) resize factors to store 
+                               features for. Default: (1,)
+        '''
+        labels = self.index['datasets'].get(dataset_key)
+        missing = [scale for scale in scales if labels is None or 
+                   any(self._get_key(name, scale) not in self.index['features']
+                       for name in labels)]
+        if len(missing) == 0:
+            return
+        if self.net is None:
+            raise ValueError('A bank without its network can not compute '
+                             'features, update it in the main process')
+
+        labels = {}
+        with open(self.data_file, 'ab') as f:
+            for ind in range(len(dataset)):
+                img, (boxes, name) = dataset[ind]
+                labels[name] = np.asarray(boxes, dtype=np.float32).tolist()
+                for scale in missing:
+                    key = self._get_key(name, scale)
+                    if key in self.index['features']:
+                        continue
+                    scaled_img = img
+                    if scale != 1:
+                        scaled_img = cv2.resize(img, (0,0), fx=scale, fy=scale)
+                    features = normalize_image(scaled_img, self.cfg)
+                    features = np_to_variable(np.expand_dims(features, 0),
+                                              is_cuda=True)
+                    features = self.net.features(features.permute(0, 3, 1, 2))
+                    features = features.data.cpu().numpy()[0].astype(
+                                                                   np.float16)
+                    self.index['features'][key] = {
+                                           'offset': f.tell(),
+                                           'shape': list(features.shape),
+                                           'img_shape': list(scaled_img.shape)}
+                    f.write(features.tobytes())
+        self.index['datasets'][dataset_key] = labels
+
+        #write to a temp file first so readers never see a partial index 
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.rename(self.index_file + '.tmp', self.index_file)
+        self._data = None
+
+    def get_labels(self, dataset_key):
+        '''
+        Returns the boxes of a dataset given to update
+
+        Returns:
+            (dict) key=image name, value=(list) Nx6 boxes of the image
+        '''
+        return self.index['datasets'][dataset_key]
+
+    def get(self, image_name, scale=1):
+        '''
+        Returns the features of a scene image
+
+        Input parameters:
+            image_name: (str) name of the scene image
+            
+            scale (optional): (float) resize factor of the image. Default: 1
+
+        Returns:
+            features: (ndarray) CxHxW float16 features, a read only view
+                      into the bank file
+            img_shape: (list) shape of the resized image
+        '''
+        if self._data is None:
+            self._data = np.memmap(self.data_file, dtype=np.float16, mode='r')
+        entry = self.index['features'][self._get_key(image_name, scale)]
+        start = entry['offset'] // 2
+        count = int(np.prod(entry['shape']))
+        return (self._data[start:start+count].reshape(entry['shape']),
+                entry['img_shape'])
+
+    def _get_key(self, image_name, scale):
+        return '{}_{}'.format(image_name, float(scale))